@@ -0,0 +1,285 @@
+"""
+Throughput and latency benchmarks for pydvid, run against the mock DVID server.
+
+Each benchmark case is repeated several times (after one untimed warm-up run),
+and the results are written as JSON, so results from different releases can be compared.
+For each case, the output includes the parameters of the case, the number of bytes transferred
+per operation, the throughput (GB/s, computed from the median duration), and latency percentiles.
+
+Usage (from the repository root):
+
+    .. code-block:: bash
+
+        python -m benchmarks.run_benchmarks --output results.json
+        python -m benchmarks.run_benchmarks --quick   # Smaller volumes and fewer repeats
+
+The cases can also be run from python:
+
+    .. code-block:: python
+
+        from benchmarks.run_benchmarks import BenchmarkConfig, run_benchmarks
+        results = run_benchmarks( BenchmarkConfig( volume_edge=64, repeats=3 ) )
+"""
+import os
+import sys
+import json
+import time
+import shutil
+import platform
+import tempfile
+import argparse
+import datetime
+from multiprocessing.pool import ThreadPool
+
+import numpy
+
+from pydvid import voxels, keyvalue
+from pydvid.dvid_connection import DvidConnection
+from mockserver.h5mockserver import H5MockServer, H5MockServerDataFile, SimulatedNetwork
+
+UUID = "abcde"
+DATASET_NAME = "benchmark_dataset"
+KEYVALUE_NAME = "benchmark_keyvalue"
+
+class BenchmarkConfig(object):
+    """
+    The parameters of a benchmark run.  (The defaults describe a full run.)
+    """
+    def __init__(self,
+                 hostname="localhost",
+                 port=8000,
+                 volume_edge=256,
+                 cutout_edges=(32, 64, 128, 256),
+                 dtypes=('uint8', 'float32'),
+                 thread_counts=(1, 4),
+                 keyvalue_sizes=(1024, 4*1024*1024),
+                 repeats=10,
+                 same_process=False,
+                 threaded_server=True,
+                 latency=0.0,
+                 jitter=0.0,
+                 bandwidth=None):
+        """
+        hostname, port: Where to start the mock server.
+        volume_edge: The edge length of the (cubic, single-channel) test volumes.
+        cutout_edges: The edge lengths of the cubic cutouts to read and write.
+                      (Edges larger than the volume are skipped.)
+        dtypes: The volume dtypes to test.
+        thread_counts: The thread counts to test (for VoxelsAccessor num_threads and keyvalue batches).
+        keyvalue_sizes: The value sizes (in bytes) to test for keyvalue get/put.
+        repeats: How many timed repetitions of each case.
+        same_process: If True, run the server in a thread of this process instead of its own process.
+        threaded_server: If True, the server handles requests concurrently, 
+                         so multi-threaded cases aren't limited by the server.
+        latency, jitter, bandwidth: Optional.  Simulate a remote server (see ``SimulatedNetwork``).
+                                    (Faults are not injected, since benchmark cases don't retry.)
+        """
+        self.hostname = hostname
+        self.port = port
+        self.volume_edge = volume_edge
+        self.cutout_edges = [ e for e in cutout_edges if e <= volume_edge ]
+        self.dtypes = list(dtypes)
+        self.thread_counts = list(thread_counts)
+        self.keyvalue_sizes = list(keyvalue_sizes)
+        self.repeats = repeats
+        self.same_process = same_process
+        self.threaded_server = threaded_server
+        self.latency = latency
+        self.jitter = jitter
+        self.bandwidth = bandwidth
+
+    @classmethod
+    def quick(cls, **kwargs):
+        """
+        Return a config for a short run (smaller volumes, fewer repeats).
+        """
+        params = dict( volume_edge=64,
+                       cutout_edges=(32, 64),
+                       keyvalue_sizes=(1024, 256*1024),
+                       repeats=3 )
+        params.update( kwargs )
+        return BenchmarkConfig( **params )
+
+    def to_dict(self):
+        return dict( self.__dict__ )
+
+def run_benchmarks( config ):
+    """
+    Start the mock server, run all benchmark cases, and return the results as a json-serializable dict.
+    """
+    tmp_dir = tempfile.mkdtemp()
+    try:
+        h5filepath = os.path.join( tmp_dir, "benchmark_data.h5" )
+        _generate_testdata_h5( h5filepath, config )
+        network = None
+        if config.latency or config.jitter or config.bandwidth:
+            network = SimulatedNetwork( config.latency, config.jitter, config.bandwidth, seed=0 )
+        server_proc, shutdown_event = H5MockServer.create_and_start( h5filepath, config.hostname, config.port,
+                                                                     config.same_process, True, config.threaded_server,
+                                                                     network=network )
+        try:
+            connection = DvidConnection( "{}:{}".format( config.hostname, config.port ) )
+            try:
+                results = []
+                results += _benchmark_metadata( connection, config )
+                results += _benchmark_voxels( connection, config )
+                results += _benchmark_keyvalue( connection, config )
+            finally:
+                connection.close()
+        finally:
+            shutdown_event.set()
+            server_proc.join()
+    finally:
+        shutil.rmtree( tmp_dir )
+
+    return { "environment" : _environment_info(),
+             "config" : config.to_dict(),
+             "results" : results }
+
+def _volume_name( dtype ):
+    return "volume_" + dtype
+
+def _generate_testdata_h5( h5filepath, config ):
+    shape = (1,) + (config.volume_edge,)*3
+    with H5MockServerDataFile( h5filepath ) as test_h5file:
+        test_h5file.add_node( DATASET_NAME, UUID )
+        for dtype in config.dtypes:
+            data = numpy.random.randint( 0, 100, size=shape ).astype( dtype )
+            metadata = voxels.VoxelsMetadata.create_default_metadata( shape, data.dtype, "cxyz", 1.0, "" )
+            test_h5file.add_volume( DATASET_NAME, _volume_name(dtype), data, metadata )
+        test_h5file.add_keyvalue_group( DATASET_NAME, KEYVALUE_NAME )
+
+def _time_case( name, params, func, bytes_per_op, repeats ):
+    """
+    Call func() once to warm up, and then repeats more times.
+    Return a dict of the case's parameters and timing statistics.
+    """
+    func()
+    durations = []
+    for _ in range(repeats):
+        start = time.time()
+        func()
+        durations.append( time.time() - start )
+
+    durations = numpy.array( durations )
+    median = float( numpy.median( durations ) )
+    result = { "name" : name,
+               "params" : params,
+               "repeats" : repeats,
+               "bytes_per_op" : bytes_per_op,
+               "gbps" : ( bytes_per_op / median / 1e9 ) if median > 0 and bytes_per_op else None,
+               "latency_seconds" : { "min" : float( durations.min() ),
+                                     "mean" : float( durations.mean() ),
+                                     "p50" : median,
+                                     "p90" : float( numpy.percentile( durations, 90 ) ),
+                                     "p99" : float( numpy.percentile( durations, 99 ) ),
+                                     "max" : float( durations.max() ) } }
+    sys.stderr.write( "{:<24} {:<60} p50: {:8.2f} ms\n".format( name, json.dumps(params, sort_keys=True), 1000*median ) )
+    return result
+
+def _benchmark_metadata( connection, config ):
+    volume_name = _volume_name( config.dtypes[0] )
+    func = lambda: voxels.get_metadata( connection, UUID, volume_name )
+    return [ _time_case( "get_metadata", {}, func, 0, config.repeats ) ]
+
+def _benchmark_voxels( connection, config ):
+    results = []
+    for dtype in config.dtypes:
+        for num_threads in config.thread_counts:
+            with voxels.VoxelsAccessor( connection, UUID, _volume_name(dtype), num_threads=num_threads ) as accessor:
+                for edge in config.cutout_edges:
+                    params = { "dtype" : dtype, "edge" : edge, "num_threads" : num_threads }
+                    start = (0,0,0,0)
+                    stop = (1, edge, edge, edge)
+                    nbytes = edge**3 * numpy.dtype(dtype).itemsize
+
+                    out = numpy.empty( stop, dtype=dtype, order='F' )
+                    func = lambda: accessor.get_ndarray( start, stop, out=out )
+                    results.append( _time_case( "get_ndarray", params, func, nbytes, config.repeats ) )
+
+                    data = accessor.get_ndarray( start, stop )
+                    func = lambda: accessor.post_ndarray( start, stop, data )
+                    results.append( _time_case( "post_ndarray", params, func, nbytes, config.repeats ) )
+
+                    # A single z-slice, read via slicing syntax
+                    slice_bytes = edge**2 * numpy.dtype(dtype).itemsize
+                    func = lambda: accessor[:, 0:edge, 0:edge, edge//2]
+                    results.append( _time_case( "getitem_slice", params, func, slice_bytes, config.repeats ) )
+    return results
+
+def _benchmark_keyvalue( connection, config ):
+    results = []
+    for size in config.keyvalue_sizes:
+        # The mock server can't store values that contain NUL bytes.
+        value = ( "0123456789abcdef" * ( size // 16 + 1 ) )[:size]
+        params = { "size" : size }
+
+        put_func = lambda: keyvalue.put_value( connection, UUID, KEYVALUE_NAME, "single_key", value )
+        results.append( _time_case( "keyvalue_put", params, put_func, size, config.repeats ) )
+
+        get_func = lambda: keyvalue.get_value( connection, UUID, KEYVALUE_NAME, "single_key" )
+        results.append( _time_case( "keyvalue_get", params, get_func, size, config.repeats ) )
+
+        # Batches of values, transferred by several threads at once.
+        # The thread pool is created up-front, so its startup and shutdown time isn't measured.
+        for num_threads in config.thread_counts:
+            batch_size = 4 * num_threads
+            mapping = { "batch_key_{}".format(i) : value for i in range(batch_size) }
+            params = { "size" : size, "num_threads" : num_threads, "batch_size" : batch_size }
+            thread_pool = ThreadPool( num_threads )
+            try:
+                def put_batch():
+                    errors = keyvalue.put_values( connection, UUID, KEYVALUE_NAME, mapping, thread_pool=thread_pool )
+                    assert not errors, "Failed to store values: {}".format( errors )
+                results.append( _time_case( "keyvalue_put_values", params, put_batch, size*batch_size, config.repeats ) )
+
+                def get_batch():
+                    _, errors = keyvalue.get_values( connection, UUID, KEYVALUE_NAME, mapping.keys(), thread_pool=thread_pool )
+                    assert not errors, "Failed to retrieve values: {}".format( errors )
+                results.append( _time_case( "keyvalue_get_values", params, get_batch, size*batch_size, config.repeats ) )
+            finally:
+                thread_pool.close()
+                thread_pool.join()
+    return results
+
+def _environment_info():
+    return { "timestamp" : datetime.datetime.utcnow().isoformat(),
+             "python" : sys.version,
+             "platform" : platform.platform(),
+             "numpy" : numpy.__version__ }
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser( description="Benchmark pydvid against the mock DVID server." )
+    parser.add_argument( "--output", help="Write the json results to this file (default: stdout)" )
+    parser.add_argument( "--port", type=int, default=8000, help="The port for the mock server" )
+    parser.add_argument( "--repeats", type=int, help="Timed repetitions of each case" )
+    parser.add_argument( "--quick", action="store_true", help="Use smaller volumes and fewer repeats" )
+    parser.add_argument( "--same-process", action="store_true",
+                         help="Run the mock server in a thread of this process (default: separate process)" )
+    parser.add_argument( "--single-threaded-server", action="store_true",
+                         help="Handle one request at a time in the mock server (default: one thread per request)" )
+    parser.add_argument( "--latency", type=float, default=0.0, help="Simulated latency per request (seconds)" )
+    parser.add_argument( "--jitter", type=float, default=0.0, help="Simulated random extra latency per request (seconds)" )
+    parser.add_argument( "--bandwidth", type=float, help="Simulated bandwidth per request (bytes/second)" )
+    args = parser.parse_args()
+
+    overrides = { "port" : args.port,
+                  "same_process" : args.same_process,
+                  "threaded_server" : not args.single_threaded_server,
+                  "latency" : args.latency,
+                  "jitter" : args.jitter,
+                  "bandwidth" : args.bandwidth }
+    if args.repeats is not None:
+        overrides["repeats"] = args.repeats
+    if args.quick:
+        config = BenchmarkConfig.quick( **overrides )
+    else:
+        config = BenchmarkConfig( **overrides )
+
+    results = run_benchmarks( config )
+    if args.output:
+        with open( args.output, 'w' ) as f:
+            json.dump( results, f, indent=4, sort_keys=True )
+    else:
+        json.dump( results, sys.stdout, indent=4, sort_keys=True )
+        sys.stdout.write("\n")
@@ -30,6 +30,11 @@ Furthermore, each hdf5 volume must:
 - have a "metadata" attribute, which is stored as json according to the dvid metadata schema
 - be in F-order, e.g. cxyz
 
+Volumes are stored with a chunked, resizable hdf5 layout, with chunks aligned to DVID blocks
+(32**3 by default, like the BlockSize sent by ``pydvid.voxels.create_new()``), and optional hdf5 compression.
+Chunks that have never been written occupy no disk space, so even very large volumes
+can be simulated (see ``H5MockServerDataFile.add_volume()``).
+
 LIMITATIONS:
 Obviously, the aim here is not to implement the full DVID API.
 - The user's subvolume queries MUST include all axes 
@@ -37,21 +42,151 @@ Obviously, the aim here is not to implement the full DVID API.
 - The <format> parameter is not supported.
   Data is always returned as binary volume buffer data.
   REST queries including the format parameter will result in error 400 (bad syntax)
+  However, subvolume data may be compressed with any encoding in pydvid.compression
+  (via the Accept-Encoding and Content-Encoding headers).
+
+By default, requests are handled one at a time.
+In threaded mode (see ``H5MockServer.create_and_start()``), each request is handled in its own thread,
+so concurrent clients can be tested.  Access to the hdf5 file is serialized via ``H5MockServer.h5_lock``,
+but sending and receiving request/response bodies is not.
+(Volume writes wait for volume reads that are still being sent, though, so responses are never torn.
+See ``H5MockServer.volume_lock``.)
+
+The server can also simulate a slow or unreliable network (latency, limited bandwidth, 
+server errors and connection resets).  See ``SimulatedNetwork``.
 """
 import re
 import json
+import time
+import random
+import socket
+import struct
+import hashlib
 import httplib
-import collections
 import threading
+import contextlib
 import multiprocessing
+from SocketServer import ThreadingMixIn
 from BaseHTTPServer import HTTPServer, BaseHTTPRequestHandler
 
 import numpy
 import h5py
 
+from pydvid import compression
 from pydvid.voxels import VoxelsMetadata
 from pydvid.voxels import VoxelsNddataCodec
 
+# The default chunk size (along each spatial axis) for volumes in the server's hdf5 file.
+# Matches the BlockSize that pydvid.voxels.create_new() requests.
+DEFAULT_BLOCK_SIZE = 32
+
+def volume_storage_options( shape, block_size=DEFAULT_BLOCK_SIZE, h5_compression=None ):
+    """
+    Return the keyword arguments for ``h5py.Group.create_dataset()`` that 
+    define the storage layout for a volume of the given shape (including the channel axis):
+    The volume is resizable, and each chunk holds all channels of (at most) one DVID block.
+
+    Chunks are clipped to the volume's initial extent, so small volumes don't waste space on padding.
+    (Empty axes, e.g. of a volume that was created via the REST API, get full blocks.)
+    DVID blocks are three-dimensional, so any further axes (e.g. time) are stored one plane per chunk.
+
+    :param block_size: The block size (along each spatial axis), or a tuple of block sizes for each spatial axis.
+    :param h5_compression: Optional.  An hdf5 compression filter, passed to h5py (e.g. 'gzip', 'lzf', or a gzip level).
+    """
+    if isinstance( block_size, int ):
+        block_size = (block_size,) * (len(shape)-1)
+    assert len(block_size) == len(shape)-1, \
+        "Block size {} doesn't match volume shape {}".format( block_size, shape )
+    chunks = [ max(1, shape[0]) ]
+    for axis, (extent, block_extent) in enumerate( zip( shape[1:], block_size ) ):
+        if axis >= 3:
+            chunks.append( 1 )
+        elif extent == 0:
+            chunks.append( block_extent )
+        else:
+            chunks.append( min( extent, block_extent ) )
+    return { 'chunks' : tuple(chunks),
+             'maxshape' : (None,)*len(shape),
+             'compression' : h5_compression }
+
+def _compile_rest_commands():
+    """
+    Build the table of supported REST commands: a list of (compiled regex, { method : handler name }).
+    Called once, when the request handler class is defined.
+    """
+    # Parameter patterns
+    param_patterns = { 'uuid'     : r"[0-9a-fA-F]+",
+                       'shape'    : r"(\d+_)*\d+",
+                       'offset'   : r"(\d+_)*\d+",
+                       'dims'     : r"(\d_)*\d",
+                       'dataname' : r"\w+",
+                       'key'      : r"\w+",
+                       'typename' : r"\w+" }
+    
+    # Surround each pattern with 'named group' regex syntax
+    named_param_patterns = {}
+    for name, pattern in param_patterns.items():
+        named_param_patterns[name] = "(?P<" + name + ">" + pattern + ")" 
+
+    # Supported REST command formats -> methods and handlers
+    # Note that order matters here
+    rest_cmds = [ ("^/api/server/info",                                          { "GET"  : "_do_get_server_info" }),
+                  ("^/api/server/types",                                         { "GET"  : "_do_get_server_types" }),
+                  ("^/api/datasets/list$",                                       { "GET"  : "_do_get_datasets_list" }),
+                  ("^/api/datasets/info$",                                       { "GET"  : "_do_get_datasets_info" }),
+                  ("^/api/node/{uuid}/{dataname}/metadata",                      { "GET"  : "_do_get_volume_schema" }),
+                  ("^/api/dataset/{uuid}/new/{typename}/{dataname}$",            { "POST" : "_do_create_new_data" }),
+                  ("^/api/node/{uuid}/{dataname}/raw/{dims}/{shape}/{offset}$",  { "GET"  : "_do_get_data",
+                                                                                   "POST" : "_do_modify_data" }),
+                  ("^/api/node/{uuid}/{dataname}/{key}$" ,                       { "GET"  : "_do_get_keyvalue",
+                                                                                   "POST" : "_do_set_keyvalue" })
+                ]
+
+    return [ ( re.compile( rest_cmd_format.format( **named_param_patterns ) ), cmd_methods )
+             for rest_cmd_format, cmd_methods in rest_cmds ]
+
+class _RequestBody(object):
+    """
+    A file-like wrapper for reading a request body from the request handler's rfile.
+    Keeps track of whether the client closed the connection before sending all of it.
+
+    If the body length is known, it also provides ``readinto()``, which receives the body
+    straight from the socket into the destination buffer (once the rfile's buffer is used up).
+    (See also ``pydvid.util.get_readinto()``.)
+    """
+    def __init__(self, rfile, sock, length=None):
+        self._rfile = rfile
+        self._sock = sock
+        self._remaining = length
+        self.truncated = False
+        if length is not None and hasattr( rfile, '_rbuf' ):
+            self.readinto = self._readinto
+
+    def read(self, size=-1):
+        data = self._rfile.read( size )
+        if size is not None and size >= 0 and len(data) < size:
+            self.truncated = True
+        if self._remaining is not None:
+            self._remaining -= len(data)
+        return data
+
+    def _readinto(self, buf):
+        nbytes = min( len(buf), self._remaining )
+        if nbytes == 0:
+            return 0
+        # Use up the data the rfile has already buffered (if any) before reading from the socket.
+        buffered_bytes = len( self._rfile._rbuf.getvalue() )
+        if buffered_bytes:
+            data = self._rfile.read( min( nbytes, buffered_bytes ) )
+            buf[:len(data)] = data
+            received = len(data)
+        else:
+            received = self._sock.recv_into( buf, nbytes )
+        if received == 0:
+            self.truncated = True
+        self._remaining -= received
+        return received
+
 class H5CutoutRequestHandler(BaseHTTPRequestHandler):
     """
     The request handler for the H5MockServer.
@@ -62,35 +197,138 @@ class H5CutoutRequestHandler(BaseHTTPRequestHandler):
         def __init__(self, status_code, message):
             self.status_code = status_code
             self.message = message
-    
+
+    # The REST commands we support (compiled once, not per-request)
+    REST_COMMANDS = _compile_rest_commands()
+
+    # Support keep-alive connections (in threaded mode; see end_headers()).
+    protocol_version = "HTTP/1.1"
+
+    # Subvolume data is read from the hdf5 file and sent in slabs of (approximately) this size.
+    STREAM_SLAB_SIZE = 8*1024*1024 # (bytes)
+
+    # Slabs are made thicker (up to this size) so each hdf5 chunk is read only once,
+    #  but for cutouts too wide for that, chunks are re-read for each (thinner) slab instead.
+    MAX_STREAM_SCRATCH_SIZE = 64*1024*1024 # (bytes)
+
+    # Socket timeout (in seconds).  Volume responses hold a shared lock on the volume while they are sent,
+    #  so a client that stops reading must not be able to block writers forever.
+    timeout = 30.0
 
     # Forward all requests to the common entry point
     def do_GET(self):  self._handle_request("GET")
     def do_POST(self): self._handle_request("POST")
 
 
+    def setup(self):
+        """
+        Override from StreamRequestHandler: Apply the simulated network (if any) to the connection.
+        """
+        BaseHTTPRequestHandler.setup(self)
+        network = self.server.network
+        if network is not None:
+            self.rfile = network.throttle( self.rfile )
+            self.wfile = network.throttle( self.wfile )
+
     def _handle_request(self, method):
         """
         Entry point for all request handling.
         Call `_execute_request` and handle any exceptions.
         """
-        try:
-            self._execute_request(method)
-        except H5CutoutRequestHandler.RequestError as ex:
-            self.send_error( ex.status_code, ex.message )
-        except Exception as ex:
-            self.send_error( httplib.INTERNAL_SERVER_ERROR, 
-                             "Server Error: See response body for traceback.  Crashing now..." )
+        with self.server.handling_request( self.connection ):
+            network = self.server.network
+            if network is not None:
+                delay, fault = network.next_request()
+                time.sleep( delay )
+                if fault is not None:
+                    self._inject_fault( fault )
+                    return
+
+            self._headers_sent = False
+            try:
+                self._execute_request(method)
+            except Exception as ex:
+                if self._headers_sent:
+                    # It's too late to send an error status: the client would mistake it for part of the body.
+                    # Close the connection instead, so the client sees an incomplete response.
+                    self.close_connection = 1
+                    if isinstance( ex, socket.error ):
+                        # The client went away (or stopped reading).  Nothing to report.
+                        return
+                    raise
+                if isinstance( ex, H5CutoutRequestHandler.RequestError ):
+                    self.send_error( ex.status_code, ex.message )
+                    return
+
+                self.send_error( httplib.INTERNAL_SERVER_ERROR, 
+                                 "Server Error: See response body for traceback.  Crashing now..." )
             
-            # Write exception traceback to the response body as an html comment.
-            import traceback
-            self.wfile.write("<!-- Server Exception Traceback:\n")
-            traceback.print_exc(file=self.wfile)
-            self.wfile.write("\n-->")
-            self.wfile.flush()
+                # Write exception traceback to the response body as an html comment.
+                import traceback
+                self.wfile.write("<!-- Server Exception Traceback:\n")
+                traceback.print_exc(file=self.wfile)
+                self.wfile.write("\n-->")
+                self.wfile.flush()
             
-            raise # Now crash...
+                raise # Now crash...
+
+    def end_headers(self):
+        """
+        Override from BaseHTTPRequestHandler: Remember that the response has started.
+        Also, in non-threaded mode, close the connection after each response, 
+        since waiting for the client's next request would block all other clients.
+        """
+        if not self.server.threaded and not self.close_connection:
+            self.send_header("Connection", "close")
+        BaseHTTPRequestHandler.end_headers(self)
+        self._headers_sent = True
+
+    def handle_one_request(self):
+        """
+        Override from BaseHTTPRequestHandler: If the client went away (e.g. it reset an idle keep-alive connection,
+        or stopped reading a response), just close the connection.
+        """
+        try:
+            BaseHTTPRequestHandler.handle_one_request(self)
+        except socket.error:
+            self.close_connection = 1
+
+    def log_error(self, format, *args):
+        """
+        Override from BaseHTTPRequestHandler: Idle keep-alive connections time out all the time
+        (see ``timeout``), which isn't worth reporting.
+        """
+        if not format.startswith( "Request timed out" ):
+            BaseHTTPRequestHandler.log_error(self, format, *args)
+
+    def finish(self):
+        """
+        Override from StreamRequestHandler: Don't complain if the client closed the connection early.
+        """
+        try:
+            BaseHTTPRequestHandler.finish(self)
+        except socket.error:
+            # The rest of the response can't be sent.
+            self.rfile.close()
+
 
+    def _inject_fault(self, fault):
+        """
+        Respond to the current request with the given simulated fault (see ``SimulatedNetwork``).
+        """
+        if fault == SimulatedNetwork.SERVER_ERROR:
+            # Discard the request body, so the client can receive the response.
+            self.rfile.read( int( self.headers.get( "Content-Length", 0 ) ) )
+            self.send_error( httplib.SERVICE_UNAVAILABLE, "Simulated server error" )
+        else:
+            assert fault == SimulatedNetwork.CONNECTION_RESET
+            # With SO_LINGER set to 0, closing the socket sends a TCP RST instead of a FIN.
+            # (The socket is only closed when all references to it are closed.)
+            self.connection.setsockopt( socket.SOL_SOCKET, socket.SO_LINGER, struct.pack('ii', 1, 0) )
+            self.rfile.close()
+            self.wfile.close()
+            self.connection.close()
+            self.close_connection = 1
 
     def _execute_request(self, method):
         """
@@ -99,48 +337,19 @@ class H5CutoutRequestHandler(BaseHTTPRequestHandler):
         Support GET queries for dataset info or subvolume data.
         Also support POST for dataset subvolume data.
         """
-        # Parameter patterns
-        param_patterns = { 'uuid'     : r"[0-9a-fA-F]+",
-                           'shape'    : r"(\d+_)*\d+",
-                           'offset'   : r"(\d+_)*\d+",
-                           'dims'     : r"(\d_)*\d",
-                           'dataname' : r"\w+",
-                           'key'      : r"\w+",
-                           'typename' : r"\w+" }
-        
-        # Surround each pattern with 'named group' regex syntax
-        named_param_patterns = {}
-        for name, pattern in param_patterns.items():
-            named_param_patterns[name] = "(?P<" + name + ">" + pattern + ")" 
-
-        # Supported REST command formats -> methods and handlers
-        # Note that order matters here
-        rest_cmds = collections.OrderedDict([ ("^/api/server/info",                                          { "GET"  : self._do_get_server_info }),
-                                              ("^/api/server/types",                                         { "GET"  : self._do_get_server_types }),
-                                              ("^/api/datasets/list$",                                       { "GET"  : self._do_get_datasets_list }),
-                                              ("^/api/datasets/info$",                                       { "GET"  : self._do_get_datasets_info }),
-                                              ("^/api/node/{uuid}/{dataname}/metadata",                      { "GET"  : self._do_get_volume_schema }),
-                                              ("^/api/dataset/{uuid}/new/{typename}/{dataname}$",            { "POST" : self._do_create_new_data }),
-                                              ("^/api/node/{uuid}/{dataname}/raw/{dims}/{shape}/{offset}$",  { "GET"  : self._do_get_data,
-                                                                                                               "POST" : self._do_modify_data }),
-                                              ("^/api/node/{uuid}/{dataname}/{key}$" ,                       { "GET"  : self._do_get_keyvalue,
-                                                                                                               "POST" : self._do_set_keyvalue })
-                                          ])
-
         # Find the matching rest command and execute the handler.
-        for rest_cmd_format, cmd_methods in rest_cmds.items():
-            rst_cmd_pattern = rest_cmd_format.format( **named_param_patterns )
-            match = re.match( rst_cmd_pattern, self.path )
+        for rest_cmd_regex, cmd_methods in self.REST_COMMANDS:
+            match = rest_cmd_regex.match( self.path )
             if match:
                 try:
-                    handler = cmd_methods[method]
+                    handler_name = cmd_methods[method]
                 except KeyError:
                     raise self.RequestError( httplib.METHOD_NOT_ALLOWED,
                                              "Unsupported method for query: {} {}"
                                              "".format( method, self.path ) )
                 else:
                     # Execute the command, passing in the matched parameters
-                    handler( **match.groupdict() )
+                    getattr( self, handler_name )( **match.groupdict() )
                     return
 
         # We couldn't find a command for the user's query.
@@ -185,7 +394,8 @@ class H5CutoutRequestHandler(BaseHTTPRequestHandler):
         """
         # Dataset info is determined by the layout/attributes of the server's hdf5 file.
         # See the docstring above for details.
-        info = self._get_datasets_info_dict()
+        with self.server.h5_lock:
+            info = self._get_datasets_info_dict()
         json_text = json.dumps( info )
         self.send_response(httplib.OK)
         self.send_header("Content-type", "text/json")
@@ -195,7 +405,8 @@ class H5CutoutRequestHandler(BaseHTTPRequestHandler):
 
 
     def _do_get_datasets_list(self):
-        datasets_info = self._get_datasets_info_dict()
+        with self.server.h5_lock:
+            datasets_info = self._get_datasets_info_dict()
         
         roots = []
         for d in datasets_info["Datasets"]:
@@ -218,20 +429,21 @@ class H5CutoutRequestHandler(BaseHTTPRequestHandler):
         The http client wants to create a new volume.
         Create it.
         """
-        if uuid not in self.server.h5_file["all_nodes"]:
-            raise self.RequestError( httplib.NOT_FOUND, "No such node with uuid {}".format( uuid ) )
-        
-        # Find the dataset that owns this node.
-        volume_path = None
-        for dataset_name, dataset_group in self.server.h5_file['datasets'].items():
-            for node_uuid, node_group in dataset_group['nodes'].items():
-                if node_uuid == uuid:
-                    volume_path = '/datasets/{dataset_name}/volumes/{dataname}'.format( **locals() )
-                    break
+        # Read the request body (if any) before locking the file.
+        body_len = self.headers.get("Content-Length")
+        message_json = self.rfile.read( int(body_len) ) if body_len else ""
 
-        if volume_path is None:
-            raise self.RequestError( httplib.NOT_FOUND,
-                                     "Cannot create.  Can't find node volumes dir in server hdf5 file." )
+        with self.server.h5_lock:
+            self._create_new_data( uuid, typename, dataname, message_json )
+
+        #self.send_response(httplib.NO_CONTENT)
+        self.send_response(httplib.OK)
+        self.send_header("Content-length", "0" )
+        self.end_headers()
+
+    def _create_new_data(self, uuid, typename, dataname, message_json):
+        dataset_name = self._get_node_dataset_name( uuid )
+        volume_path = '/datasets/{dataset_name}/volumes/{dataname}'.format( **locals() )
         
         if volume_path in self.server.h5_file:
             raise self.RequestError( httplib.CONFLICT,
@@ -245,22 +457,13 @@ class H5CutoutRequestHandler(BaseHTTPRequestHandler):
             self.server.h5_file[linkname] = h5py.SoftLink( volume_path )
             self.server.h5_file.flush()
         else:
-            self._create_volume( dataset_name, uuid, dataname, volume_path, typename )
-
-        #self.send_response(httplib.NO_CONTENT)
-        self.send_response(httplib.OK)
-        self.send_header("Content-length", "0" )
-        self.end_headers()
-
-    def _create_volume( self, dataset_name, uuid, dataname, volume_path, typename ):
-        # Must read exact bytes.
-        # Apparently rfile.read() just hangs.
-        body_len = self.headers.get("Content-Length")
+            self._create_volume( dataset_name, uuid, dataname, volume_path, typename, message_json )
 
+    def _create_volume( self, dataset_name, uuid, dataname, volume_path, typename, message_json ):
         ## Current DVID API does not use metadata json for creating the volume.
         ## This may change soon...
         ## 
-        #metadata_json = self.rfile.read( int(body_len) )
+        #metadata_json = message_json
         #try:
         #    voxels_metadata = VoxelsMetadata( metadata_json )
         #except ValueError as ex:
@@ -278,18 +481,22 @@ class H5CutoutRequestHandler(BaseHTTPRequestHandler):
         # Instead, the json contains some other parameters that we don't really care about...
         # But we need to read at least one of them to determine the dimensionality of the data.
         
-        message_json = self.rfile.read( int(body_len) )
         message_data = json.loads( message_json )
         num_axes = len(message_data["VoxelSize"].split(','))
+
+        # Use the requested block size for the storage layout (if any).
+        block_size = self.server.block_size
+        if "BlockSize" in message_data:
+            block_size = tuple( int(x) for x in message_data["BlockSize"].split(',') )
         
 
         # Create the new volume in the appropriate 'volumes' group,
         #  and then link to it in the node group.
         dtypename, channels = VoxelsMetadata.determine_channels_from_dvid_typename(typename)
         shape = (channels,) + (0,)*num_axes
-        maxshape = (None,)*len(shape) # No maxsize
         dtype = numpy.dtype(dtypename)
-        self.server.h5_file.create_dataset( volume_path, shape=shape, dtype=dtype, maxshape=maxshape )
+        storage_options = volume_storage_options( shape, block_size, self.server.h5_compression )
+        self.server.h5_file.create_dataset( volume_path, shape=shape, dtype=dtype, **storage_options )
         linkname = '/datasets/{dataset_name}/nodes/{uuid}/{dataname}'.format( **locals() )
         self.server.h5_file[linkname] = h5py.SoftLink( volume_path )
         self.server.h5_file.flush()
@@ -299,13 +506,23 @@ class H5CutoutRequestHandler(BaseHTTPRequestHandler):
         """
         Respond to a query for dataset info.
         """
-        dataset = self._get_h5_dataset(uuid, dataname)
-        voxels_metadata = VoxelsMetadata.create_from_h5_dataset(dataset)
-        json_text = json.dumps( voxels_metadata )
+        with self.server.h5_lock:
+            dataset = self._get_h5_dataset(uuid, dataname)
+            voxels_metadata = VoxelsMetadata.create_from_h5_dataset(dataset)
+        json_text = json.dumps( voxels_metadata, sort_keys=True )
+
+        # Support conditional requests
+        etag = '"{}"'.format( hashlib.md5( json_text ).hexdigest() )
+        if self.headers.get( "If-None-Match" ) == etag:
+            self.send_response(httplib.NOT_MODIFIED)
+            self.send_header("ETag", etag)
+            self.end_headers()
+            return
 
         self.send_response(httplib.OK)
         self.send_header("Content-type", "text/json")
         self.send_header("Content-length", str(len(json_text)))
+        self.send_header("ETag", etag)
         self.end_headers()
         self.wfile.write( json_text )
 
@@ -315,25 +532,141 @@ class H5CutoutRequestHandler(BaseHTTPRequestHandler):
         Respond to a query for volume data.
         
         All parameters are strings from the REST string.
+
+        The data is read from the hdf5 file and sent one slab at a time (see ``_iter_slab_buffers()``),
+        so the full subvolume is never held in memory.
+        Compressed responses are compressed slab by slab, and sent with chunked transfer-encoding,
+        since their length isn't known in advance.
         """
-        dataset = self._get_h5_dataset(uuid, dataname)
-        roi_start, roi_stop = self._determine_request_roi( dataset, dims, shape, offset )
-        # Prepend channel slicing
-        slicing = (slice(None),) + tuple( slice(x,y) for x,y in zip(roi_start, roi_stop) )
-        
-        data = dataset[slicing]
-        
-        voxels_metadata = VoxelsMetadata.create_from_h5_dataset(dataset)
-        codec = VoxelsNddataCodec( voxels_metadata )
-        buffer_len = codec.calculate_buffer_len( data.shape )
+        # Writes to the volume must wait until the response has been sent (see H5MockServer.volume_lock).
+        # (If the client stops reading, the socket timeout ends the response and releases the lock.)
+        with self.server.volume_lock.shared():
+            with self.server.h5_lock:
+                dataset = self._get_h5_dataset(uuid, dataname)
+                roi_start, roi_stop = self._determine_request_roi( dataset, dims, shape, offset )
+                # Prepend channel, and clip to the dataset bounds (like slicing would)
+                full_roi_stop = numpy.minimum( (dataset.shape[0],) + roi_stop, dataset.shape )
+                full_roi_start = numpy.minimum( (0,) + roi_start, full_roi_stop )
+            
+                voxels_metadata = VoxelsMetadata.create_from_h5_dataset(dataset)
+
+            codec = VoxelsNddataCodec( voxels_metadata )
+            slab_buffers = self._iter_slab_buffers( dataset, full_roi_start, full_roi_stop )
+
+            # Compress the response if the client asked for a supported encoding.
+            accepted_encodings = [ e.strip() for e in self.headers.get('Accept-Encoding', '').split(',') ]
+            supported_encodings = compression.supported_encodings()
+            encoding = next( ( e for e in accepted_encodings if e in supported_encodings ), None )
+            if encoding is not None:
+                compressor = compression.get_compressor( encoding )
+                def compressed_chunks():
+                    for buf in slab_buffers:
+                        yield compressor.compress( buf )
+                    yield compressor.flush()
+                self._send_streamed_response( compressed_chunks(),
+                                              [ ("Content-type", VoxelsNddataCodec.VOLUME_MIMETYPE),
+                                                ("Content-encoding", encoding) ] )
+                return
+
+            buffer_len = codec.calculate_buffer_len( full_roi_stop - full_roi_start )
+
+            self.send_response(httplib.OK)
+            self.send_header("Content-type", VoxelsNddataCodec.VOLUME_MIMETYPE)
+            self.send_header("Content-length", str(buffer_len) )
+            self.end_headers()
+
+            for buf in slab_buffers:
+                self.wfile.write( buf )
+
+    def _send_streamed_response(self, chunks, headers):
+        """
+        Send a response whose length isn't known in advance, one chunk at a time.
+
+        HTTP/1.1 clients receive the chunks with chunked transfer-encoding.
+        For HTTP/1.0 clients, the end of the response is marked by closing the connection.
 
+        chunks: An iterable of strings (or buffers).  Empty chunks are skipped.
+        headers: A list of (name, value) pairs to send, in addition to the transfer headers.
+        """
+        chunked = ( self.request_version == "HTTP/1.1" )
         self.send_response(httplib.OK)
-        self.send_header("Content-type", VoxelsNddataCodec.VOLUME_MIMETYPE)
-        self.send_header("Content-length", str(buffer_len) )
+        for name, value in headers:
+            self.send_header(name, value)
+        if chunked:
+            self.send_header("Transfer-Encoding", "chunked")
+        else:
+            self.send_header("Connection", "close")
         self.end_headers()
 
-        codec.encode_from_ndarray( self.wfile, data )
-    
+        for chunk in chunks:
+            if not len(chunk):
+                continue
+            if chunked:
+                self.wfile.write( "{:x}\r\n".format( len(chunk) ) )
+                self.wfile.write( chunk )
+                self.wfile.write( "\r\n" )
+            else:
+                self.wfile.write( chunk )
+        if chunked:
+            self.wfile.write( "0\r\n\r\n" )
+
+    def _iter_slab_buffers(self, dataset, full_roi_start, full_roi_stop):
+        """
+        Read the given region of the hdf5 dataset one slab (along the last axis) at a time,
+        and yield the F-order bytes of each slab (as a buffer).
+        Since DVID uses F-order, the concatenated slabs are the encoded subvolume.
+
+        Slabs are aligned to the dataset's chunks, and are roughly STREAM_SLAB_SIZE bytes, 
+        but at least one chunk thick (so each chunk is only read and decompressed once),
+        unless that would exceed MAX_STREAM_SCRATCH_SIZE.
+        Each slab is read into the same scratch buffer, and yielded in pieces of 
+        (at most) STREAM_SLAB_SIZE bytes, so each yielded buffer
+        must be consumed before the next one is requested.
+        (No single plane is split, so very wide cutouts need at least one plane of scratch space.)
+        (The server's h5_lock is only held while each slab is read.)
+        """
+        roi_shape = tuple( full_roi_stop - full_roi_start )
+        if 0 in roi_shape:
+            return
+
+        plane_bytes = numpy.prod( roi_shape[:-1] ) * dataset.dtype.itemsize
+        piece_planes = max( 1, self.STREAM_SLAB_SIZE // plane_bytes )
+        chunk_planes = dataset.chunks[-1] if dataset.chunks else 1
+        if piece_planes >= chunk_planes:
+            slab_planes = piece_planes - piece_planes % chunk_planes
+        elif chunk_planes * plane_bytes <= self.MAX_STREAM_SCRATCH_SIZE:
+            slab_planes = chunk_planes
+        else:
+            slab_planes = piece_planes
+        slab_planes = min( slab_planes, roi_shape[-1] )
+        piece_planes = min( piece_planes, slab_planes )
+
+        # h5py reads into a C-order array (the file is C-order),
+        #  which is then transposed (a piece at a time) into an F-order array for sending.
+        c_scratch = numpy.ndarray( roi_shape[:-1] + (slab_planes,), dtype=dataset.dtype, order='C' )
+        f_scratch = numpy.ndarray( roi_shape[:-1] + (piece_planes,), dtype=dataset.dtype, order='F' )
+
+        spatial_slicing = tuple( slice(x,y) for x,y in zip( full_roi_start[:-1], full_roi_stop[:-1] ) )
+        slab_start = full_roi_start[-1]
+        while slab_start < full_roi_stop[-1]:
+            # End each slab on a chunk boundary.
+            slab_stop = min( full_roi_stop[-1], slab_start + slab_planes )
+            if slab_stop - slab_start >= chunk_planes:
+                slab_stop -= slab_stop % chunk_planes
+            num_planes = slab_stop - slab_start
+
+            with self.server.h5_lock:
+                dataset.read_direct( c_scratch,
+                                     spatial_slicing + ( slice(slab_start, slab_stop), ),
+                                     numpy.s_[..., :num_planes] )
+
+            for piece_start in range( 0, num_planes, piece_planes ):
+                piece_stop = min( num_planes, piece_start + piece_planes )
+                # Slicing the last axis of an F-order array keeps it contiguous.
+                f_piece = f_scratch[..., :piece_stop - piece_start]
+                f_piece[:] = c_scratch[..., piece_start:piece_stop]
+                yield numpy.getbuffer( f_piece )
+            slab_start = slab_stop
 
     def _do_modify_data(self, uuid, dataname, dims, shape, offset):
         """
@@ -341,25 +674,50 @@ class H5CutoutRequestHandler(BaseHTTPRequestHandler):
 
         All parameters are strings from the REST string.
         """
-        dataset = self._get_h5_dataset(uuid, dataname)
-        roi_start, roi_stop = self._determine_request_roi( dataset, dims, shape, offset )
+        with self.server.h5_lock:
+            dataset = self._get_h5_dataset(uuid, dataname)
+            roi_start, roi_stop = self._determine_request_roi( dataset, dims, shape, offset )
+            num_channels = dataset.shape[0]
+            voxels_metadata = VoxelsMetadata.create_from_h5_dataset(dataset)
+
         # Prepend channel to make "full" roi
         full_roi_start = (0,) + roi_start
-        full_roi_stop = (dataset.shape[0],) + roi_stop
+        full_roi_stop = (num_channels,) + roi_stop
         full_roi_shape = numpy.subtract(full_roi_stop, full_roi_start)
         slicing = tuple( slice(x,y) for x,y in zip(full_roi_start, full_roi_stop) )
-        
-        # If the user is writing data beoyond the current extents of the dataset,
-        #  resize the dataset first.
-        if (numpy.array(full_roi_stop) > dataset.shape).any():
-            dataset.resize( full_roi_stop )
-        
-        voxels_metadata = VoxelsMetadata.create_from_h5_dataset(dataset)
-        codec = VoxelsNddataCodec( voxels_metadata )
-        data = codec.decode_to_ndarray(self.rfile, full_roi_shape)
 
-        dataset[slicing] = data
-        self.server.h5_file.flush()
+        # Receive the data before locking the file.
+        codec = VoxelsNddataCodec( voxels_metadata )
+        body_len = self.headers.get("Content-Length")
+        body = _RequestBody( self.rfile, self.connection, int(body_len) if body_len else None )
+        stream = body
+        encoding = self.headers.get('Content-Encoding', 'identity')
+        if encoding != 'identity':
+            try:
+                stream = compression.DecompressingStream( body, encoding, int(self.headers['Content-Length']) )
+            except ValueError as ex:
+                raise self.RequestError( httplib.UNSUPPORTED_MEDIA_TYPE, str(ex) )
+        try:
+            data = codec.decode_to_ndarray(stream, full_roi_shape)
+        except Exception:
+            if not body.truncated:
+                raise
+            # The client closed the connection before sending the whole body (e.g. its request failed).
+            # There's nobody to send a response to.
+            self.close_connection = 1
+            return
+
+        with self.server.volume_lock.exclusive(), self.server.h5_lock:
+            # Look up the dataset again, in case it was replaced in the meantime.
+            dataset = self._get_h5_dataset(uuid, dataname)
+
+            # If the user is writing data beoyond the current extents of the dataset,
+            #  resize the dataset first.
+            if (numpy.array(full_roi_stop) > dataset.shape).any():
+                dataset.resize( numpy.maximum( full_roi_stop, dataset.shape ) )
+
+            dataset[slicing] = data
+            self.server.h5_file.flush()
 
         #self.send_response(httplib.NO_CONTENT) # "No Content" (accepted)
         self.send_response(httplib.OK)
@@ -372,27 +730,13 @@ class H5CutoutRequestHandler(BaseHTTPRequestHandler):
         Retrieve the value for the given key from the node/data given by 
         uuid/dataname, which must be of the keyvalue datatype.
         """
-        if uuid not in self.server.h5_file["all_nodes"]:
-            raise self.RequestError( httplib.NOT_FOUND, "No such node with uuid {}".format( uuid ) )
-        
-        # Find the dataset that owns this node.
-        volume_path = None
-        for dataset_name, dataset_group in self.server.h5_file['datasets'].items():
-            for node_uuid, node_group in dataset_group['nodes'].items():
-                if node_uuid == uuid:
-                    volume_path = '/datasets/{dataset_name}/volumes/{dataname}'.format( **locals() )
-                    break
-
-        if volume_path is None:
-            raise self.RequestError( httplib.NOT_FOUND,
-                                     "Can't access keyvalue store.  Can't find node volumes dir in server hdf5 file." )
-
-        keyvalue_group = self.server.h5_file[volume_path]
+        with self.server.h5_lock:
+            keyvalue_group = self._get_keyvalue_group(uuid, dataname)
 
-        if key not in keyvalue_group:
-            raise self.RequestError( httplib.NOT_FOUND, "Data '{}' has no value for key '{}'".format( dataname, key ) )
+            if key not in keyvalue_group:
+                raise self.RequestError( httplib.NOT_FOUND, "Data '{}' has no value for key '{}'".format( dataname, key ) )
 
-        binary_data = keyvalue_group[key][()]
+            binary_data = keyvalue_group[key][()]
 
         self.send_response(httplib.OK)
         self.send_header("Content-type", "application/octet")
@@ -405,42 +749,47 @@ class H5CutoutRequestHandler(BaseHTTPRequestHandler):
         Set the value for the given key from the node/data given by 
         uuid/dataname, which must be of the keyvalue datatype.
         """
-        if uuid not in self.server.h5_file["all_nodes"]:
-            raise self.RequestError( httplib.NOT_FOUND, "No such node with uuid {}".format( uuid ) )
-        
-        # Find the dataset that owns this node.
-        volume_path = None
-        for dataset_name, dataset_group in self.server.h5_file['datasets'].items():
-            for node_uuid, node_group in dataset_group['nodes'].items():
-                if node_uuid == uuid:
-                    volume_path = '/datasets/{dataset_name}/volumes/{dataname}'.format( **locals() )
-                    break
-
-        if volume_path is None:
-            raise self.RequestError( httplib.NOT_FOUND,
-                                     "Can't access keyvalue store.  Can't find node volumes dir in server hdf5 file." )
-
-        keyvalue_group = self.server.h5_file[volume_path]
-
-        # Prepare to overwrite
-        if key in keyvalue_group:
-            del keyvalue_group[key]
-
         # Must read exact bytes.
         # Apparently rfile.read() just hangs.
         body_len = self.headers.get("Content-Length")
         binary_data = self.rfile.read( int(body_len) )
-        keyvalue_group.create_dataset(key, data=binary_data) 
+
+        with self.server.h5_lock:
+            keyvalue_group = self._get_keyvalue_group(uuid, dataname)
+
+            # Prepare to overwrite
+            if key in keyvalue_group:
+                del keyvalue_group[key]
+            keyvalue_group.create_dataset(key, data=binary_data) 
 
         #self.send_response(httplib.NO_CONTENT) # "No Content" (accepted)
         self.send_response(httplib.OK)
         self.send_header("Content-length", 0 )
         self.end_headers()
 
+    def _get_keyvalue_group(self, uuid, dataname):
+        """
+        Return the server's hdf5 group for the given uuid and keyvalue data name.
+        (The caller must hold the server's h5_lock.)
+        """
+        dataset_name = self._get_node_dataset_name( uuid )
+        volume_path = '/datasets/{dataset_name}/volumes/{dataname}'.format( **locals() )
+        return self.server.h5_file[volume_path]
+
+    def _get_node_dataset_name(self, uuid):
+        """
+        Return the name of the dataset that owns the node with the given uuid.
+        """
+        try:
+            return self.server.node_datasets[uuid]
+        except KeyError:
+            raise self.RequestError( httplib.NOT_FOUND, "No such node with uuid {}".format( uuid ) )
+
 
     def _get_h5_dataset(self, uuid, dataname):
         """
         Return the server's hdf5 dataset for the given uuid and data volume name.
+        (The caller must hold the server's h5_lock.)
         """
         dataset_path = '/all_nodes/' + uuid + '/' + dataname
         try:
@@ -541,28 +890,140 @@ class H5CutoutRequestHandler(BaseHTTPRequestHandler):
         if not self.server.disable_logging:
             BaseHTTPRequestHandler.log_request(self, *args, **kwargs )
     
-class H5MockServer(HTTPServer):
-    def __init__(self, h5filepath, disable_logging, *args, **kwargs):
+class H5MockServer(ThreadingMixIn, HTTPServer):
+    # Don't refuse connections when many clients connect at once.
+    request_queue_size = 128
+
+    # Handler threads must not prevent the process from exiting.
+    daemon_threads = True
+
+    # When shutting down, how long to wait for requests that are still being handled.
+    SHUTDOWN_TIMEOUT = 5.0
+
+    def __init__(self, h5filepath, disable_logging, server_address, RequestHandlerClass, threaded=False,
+                 block_size=DEFAULT_BLOCK_SIZE, h5_compression=None, network=None):
         """
         h5filepath: The hdf5 file to serve data from.
         See docstring above for requirements on the file contents.
+        threaded: If True, handle each request in a separate thread.
+                  Otherwise, handle one request at a time.
+        block_size, h5_compression: The storage layout for new volumes (see ``volume_storage_options()``).
+                                    (Used if the client doesn't request a particular block size.)
+        network: Optional.  A ``SimulatedNetwork``, to simulate a slow or unreliable network.
         """
-        HTTPServer.__init__(self, *args, **kwargs)
+        HTTPServer.__init__(self, server_address, RequestHandlerClass)
         self.h5filepath = h5filepath
         self.disable_logging = disable_logging
+        self.threaded = threaded
+        self.block_size = block_size
+        self.h5_compression = h5_compression
+        self.network = network
         self.shutdown_completed_event = threading.Event()
-    
+
+        # Serializes all access to the hdf5 file.
+        # (Reentrant, so handlers can call helpers that lock it, too.)
+        self.h5_lock = threading.RLock()
+
+        # Volume reads hold this lock (shared) while their response is sent, 
+        #  and volume writes hold it exclusively, so a write can't tear a response in progress.
+        # (Must never be acquired while holding the h5_lock.)
+        self.volume_lock = SharedLock()
+
+        # Requests in progress, and open connections (which may be idle, waiting for the next request).
+        self._active_requests = 0
+        self._active_requests_condition = threading.Condition()
+        self._connections = set()
+        self._busy_connections = set()
+
     def serve_forever(self):
         try:
             with h5py.File( self.h5filepath ) as h5_file:
                 self.h5_file = h5_file
-                HTTPServer.serve_forever(self)
+                self.node_datasets = self._index_nodes( h5_file )
+                try:
+                    HTTPServer.serve_forever(self)
+                finally:
+                    # Don't close the file while requests are still using it.
+                    self._wait_for_active_requests( self.SHUTDOWN_TIMEOUT )
+                    self._close_idle_connections()
         finally:
             self.server_close()
             self.shutdown_completed_event.set()
 
     @classmethod
-    def create_and_start(cls, h5filepath, hostname, port, same_process=False, disable_server_logging=True):
+    def _index_nodes(cls, h5_file):
+        """
+        Return a dict of { uuid : dataset_name } for all nodes in the file.
+        (The mock server can't create new nodes, so this never needs to be updated.)
+        """
+        node_datasets = {}
+        for dataset_name, dataset_group in h5_file['datasets'].items():
+            for node_uuid in dataset_group['nodes'].keys():
+                node_datasets[node_uuid] = dataset_name
+        return node_datasets
+
+    def process_request(self, request, client_address):
+        """
+        Override from ThreadingMixIn: Only start a new thread in threaded mode.
+        """
+        if self.threaded:
+            ThreadingMixIn.process_request(self, request, client_address)
+        else:
+            HTTPServer.process_request(self, request, client_address)
+
+    def finish_request(self, request, client_address):
+        """
+        Override from BaseServer: Keep track of the open connections.
+        """
+        with self._active_requests_condition:
+            self._connections.add( request )
+        try:
+            HTTPServer.finish_request(self, request, client_address)
+        finally:
+            with self._active_requests_condition:
+                self._connections.discard( request )
+
+    @contextlib.contextmanager
+    def handling_request(self, connection):
+        """
+        Context manager.  Used by the request handler to mark a request (on the given connection) as in progress.
+        """
+        with self._active_requests_condition:
+            self._active_requests += 1
+            self._busy_connections.add( connection )
+        try:
+            yield
+        finally:
+            with self._active_requests_condition:
+                self._active_requests -= 1
+                self._busy_connections.discard( connection )
+                self._active_requests_condition.notify_all()
+
+    def _close_idle_connections(self):
+        """
+        Shut down the keep-alive connections that are waiting for their next request,
+        so their handler threads exit instead of serving requests after the server is gone.
+        """
+        with self._active_requests_condition:
+            idle_connections = self._connections - self._busy_connections
+        for connection in idle_connections:
+            try:
+                connection.shutdown( socket.SHUT_RDWR )
+            except socket.error:
+                pass
+
+    def _wait_for_active_requests(self, timeout):
+        deadline = time.time() + timeout
+        with self._active_requests_condition:
+            while self._active_requests > 0:
+                remaining = deadline - time.time()
+                if remaining <= 0:
+                    break
+                self._active_requests_condition.wait( remaining )
+
+    @classmethod
+    def create_and_start(cls, h5filepath, hostname, port, same_process=False, disable_server_logging=True, threaded=False,
+                         block_size=DEFAULT_BLOCK_SIZE, h5_compression=None, network=None):
         """
         Start the mock DVID server in a separate process or thread.
         
@@ -571,27 +1032,33 @@ class H5MockServer(HTTPServer):
                       separate thread (useful for debugging).
                       Otherwise, start the server in its own process (default).
         disable_server_logging: If true, disable the normal HttpServer logging of every request.
+        threaded: If True, the server handles each request in a separate thread,
+                  so it can serve many concurrent clients.
+        block_size, h5_compression: The storage layout for volumes created via the REST API.
+                                    (See ``volume_storage_options()``.)
+        network: Optional.  A ``SimulatedNetwork``, to simulate a slow or unreliable network, e.g.
+                 ``SimulatedNetwork( latency=0.05, bandwidth=10e6, error_rate=0.01, seed=0 )``
         """
         try:    
             if same_process:
                 shutdown_event = threading.Event()
-                server_args = (hostname, port, h5filepath, disable_server_logging, shutdown_event,)
+                server_args = (hostname, port, h5filepath, disable_server_logging, shutdown_event, threaded, block_size, h5_compression, network)
                 server_start_thread = threading.Thread( target=cls._server_main, args=server_args )
                 server_start_thread.start()
                 return server_start_thread, shutdown_event
             else:
                 shutdown_event = multiprocessing.Event()
-                server_args = (hostname, port, h5filepath, disable_server_logging, shutdown_event,)
+                server_args = (hostname, port, h5filepath, disable_server_logging, shutdown_event, threaded, block_size, h5_compression, network)
                 server_proc = multiprocessing.Process( target=cls._server_main, args=server_args )
                 server_proc.start()
                 return server_proc, shutdown_event
         finally:
             # Give the server some time to start up before clients attempt to query it.
-            import time
             time.sleep(0.2)
 
     @classmethod
-    def _server_main(cls, hostname, port, h5filepath, disable_server_logging, shutdown_event):
+    def _server_main(cls, hostname, port, h5filepath, disable_server_logging, shutdown_event, threaded=False,
+                     block_size=DEFAULT_BLOCK_SIZE, h5_compression=None, network=None):
         """
         This function can be used as the target function for either a thread or process.
 
@@ -607,7 +1074,8 @@ class H5MockServer(HTTPServer):
         """
         # Fire up the server in a separate thread
         server_address = (hostname, port)
-        server = H5MockServer( h5filepath, disable_server_logging, server_address, H5CutoutRequestHandler )
+        server = H5MockServer( h5filepath, disable_server_logging, server_address, H5CutoutRequestHandler,
+                               threaded, block_size, h5_compression, network )
         server_thread = threading.Thread( target=server.serve_forever )
         server_thread.start()
         
@@ -620,6 +1088,176 @@ class H5MockServer(HTTPServer):
             server.shutdown_completed_event.wait()
 
 
+class SharedLock(object):
+    """
+    A readers/writer lock: Any number of threads may hold it in shared mode at once,
+    or a single thread may hold it in exclusive mode.  (Not reentrant.)
+    """
+    def __init__(self):
+        self._condition = threading.Condition()
+        self._num_shared = 0
+        self._exclusive = False
+
+    @contextlib.contextmanager
+    def shared(self):
+        """
+        Context manager.  Hold the lock in shared mode.
+        """
+        with self._condition:
+            while self._exclusive:
+                self._condition.wait()
+            self._num_shared += 1
+        try:
+            yield
+        finally:
+            with self._condition:
+                self._num_shared -= 1
+                self._condition.notify_all()
+
+    @contextlib.contextmanager
+    def exclusive(self):
+        """
+        Context manager.  Hold the lock in exclusive mode.
+        """
+        with self._condition:
+            while self._exclusive or self._num_shared > 0:
+                self._condition.wait()
+            self._exclusive = True
+        try:
+            yield
+        finally:
+            with self._condition:
+                self._exclusive = False
+                self._condition.notify_all()
+
+class SimulatedNetwork(object):
+    """
+    Simulates the conditions of a remote server (e.g. across a WAN) for an H5MockServer,
+    so client features such as pooling, retries, and prefetching can be tested and benchmarked locally.
+
+    For each request, the server waits for the latency (plus a random jitter) before handling it.
+    Then, it may inject a fault instead of handling the request: 
+    either a "503 Service Unavailable" response (with probability error_rate), 
+    or a connection reset, without any response (with probability reset_rate).
+    Otherwise, the request and response bodies are transferred at (no more than) the given bandwidth.
+
+    All random choices are made with a private random number generator, 
+    so a given seed always produces the same sequence of faults and delays
+    (as long as requests arrive in the same order).
+    """
+    SERVER_ERROR = 'server-error'
+    CONNECTION_RESET = 'connection-reset'
+
+    def __init__(self, latency=0.0, jitter=0.0, bandwidth=None, error_rate=0.0, reset_rate=0.0, seed=None):
+        """
+        latency: The delay (in seconds) before each request is handled.
+        jitter: A random delay (uniformly distributed between 0 and jitter seconds) added to the latency.
+        bandwidth: The maximum transfer rate (in bytes per second) for each request and response, or None.
+        error_rate: The probability of responding to a request with a simulated server error.
+        reset_rate: The probability of resetting the connection instead of responding to a request.
+        seed: The seed for the random choices.
+        """
+        assert latency >= 0.0 and jitter >= 0.0
+        assert bandwidth is None or bandwidth > 0
+        assert error_rate >= 0.0 and reset_rate >= 0.0 and error_rate + reset_rate <= 1.0
+        self.latency = latency
+        self.jitter = jitter
+        self.bandwidth = bandwidth
+        self.error_rate = error_rate
+        self.reset_rate = reset_rate
+        self._random = random.Random( seed )
+        self._lock = threading.Lock()
+
+    def next_request(self):
+        """
+        Choose the conditions for the next request.
+
+        :returns: A tuple (delay, fault), where fault is SERVER_ERROR, CONNECTION_RESET, or None.
+        """
+        with self._lock:
+            delay = self.latency
+            if self.jitter:
+                delay += self._random.uniform( 0.0, self.jitter )
+            x = self._random.random()
+
+        if x < self.error_rate:
+            return delay, SimulatedNetwork.SERVER_ERROR
+        if x < self.error_rate + self.reset_rate:
+            return delay, SimulatedNetwork.CONNECTION_RESET
+        return delay, None
+
+    def throttle(self, stream):
+        """
+        Return a wrapper around the given file-like object that limits it to this network's bandwidth.
+        (If the bandwidth is unlimited, the stream is returned as-is.)
+        """
+        if self.bandwidth is None:
+            return stream
+        return _ThrottledStream( stream, self.bandwidth )
+
+class _ThrottledStream(object):
+    """
+    Wraps a file-like object, and delays reads and writes so they don't exceed the given bandwidth.
+    """
+    # Data is transferred in pieces of (at most) this many seconds' worth.
+    INTERVAL = 0.01
+
+    def __init__(self, stream, bandwidth):
+        self._stream = stream
+        self._bandwidth = bandwidth
+        self._chunk_size = max( 1, int( bandwidth * _ThrottledStream.INTERVAL ) )
+        self._start_time = None
+        self._transferred = 0
+
+    def read(self, size=-1):
+        if size < 0:
+            data = self._stream.read()
+            self._wait( len(data) )
+            return data
+        chunks = []
+        remaining = size
+        while remaining > 0:
+            chunk = self._stream.read( min( remaining, self._chunk_size ) )
+            if not chunk:
+                break
+            self._wait( len(chunk) )
+            chunks.append( chunk )
+            remaining -= len(chunk)
+        return ''.join( chunks )
+
+    def readline(self, size=-1):
+        line = self._stream.readline( size )
+        self._wait( len(line) )
+        return line
+
+    def write(self, data):
+        data = buffer(data)
+        for offset in range( 0, len(data), self._chunk_size ):
+            chunk = buffer( data, offset, self._chunk_size )
+            self._stream.write( chunk )
+            self._wait( len(chunk) )
+
+    def flush(self):
+        self._stream.flush()
+
+    def close(self):
+        self._stream.close()
+
+    @property
+    def closed(self):
+        return self._stream.closed
+
+    def _wait(self, nbytes):
+        """
+        Account for nbytes more bytes, and sleep until the average rate is within the bandwidth.
+        """
+        if self._start_time is None:
+            self._start_time = time.time()
+        self._transferred += nbytes
+        delay = self._start_time + self._transferred / float(self._bandwidth) - time.time()
+        if delay > 0:
+            time.sleep( delay )
+
 class H5MockServerDataFile(object):
     """
     Convenience class for generating an hdf5 file that 
@@ -627,7 +1265,13 @@ class H5MockServerDataFile(object):
     See file docstring above for format details.
     In the generated file, all nodes in a dataset contain the same volumes.
     """
-    def __init__(self, filepath):
+    def __init__(self, filepath, block_size=DEFAULT_BLOCK_SIZE, h5_compression=None):
+        """
+        filepath: The hdf5 file to create (or add to).
+        block_size, h5_compression: The storage layout for added volumes (see ``volume_storage_options()``).
+        """
+        self.block_size = block_size
+        self.h5_compression = h5_compression
         self._f = h5py.File( filepath )
         if 'datasets' not in self._f:
             self._f.create_group('datasets')
@@ -647,7 +1291,18 @@ class H5MockServerDataFile(object):
         self._f.flush()
 
     def add_volume(self, dataset_name, volume_name, volume, voxels_metadata):
-        assert isinstance( volume, numpy.ndarray )
+        """
+        Add a volume to every node of the given dataset.
+
+        volume: The volume data, or None.  If None, an empty volume (all zeros) is created, 
+                with the shape and dtype from voxels_metadata.  No disk space is used 
+                for the empty volume's chunks until they are written, so it may be arbitrarily large.
+        """
+        if volume is None:
+            shape, dtype = voxels_metadata.shape, voxels_metadata.dtype
+        else:
+            assert isinstance( volume, numpy.ndarray )
+            shape, dtype = volume.shape, volume.dtype
 
         volumes_group, nodes_group = self._get_dataset_groups(dataset_name)
 
@@ -657,7 +1312,10 @@ class H5MockServerDataFile(object):
         #       If we were using this mock server for more than just testing, 
         #        we would transpose to C-order before storing data and transpose 
         #        back to F-order when retrieving data.
-        volume_dset = volumes_group.create_dataset( volume_name, data=volume )
+        storage_options = volume_storage_options( shape, self.block_size, self.h5_compression )
+        volume_dset = volumes_group.create_dataset( volume_name, shape=shape, dtype=dtype, **storage_options )
+        if volume is not None:
+            volume_dset[...] = volume
         volume_dset.attrs['dvid_metadata'] = json.dumps( voxels_metadata )
         
         # Add a link to this volume in every node
@@ -1,10 +1,45 @@
-import errors
-import util
-import general
-import voxels
-import keyvalue
-import dvid_connection
-
-# Note that we DO NOT automatically import gui here, 
-#  since PyQt4 is an optional dependency
-# import gui
\ No newline at end of file
+import sys
+import types
+import importlib
+
+# The submodules are imported lazily, i.e. on first attribute access (e.g. ``pydvid.voxels``),
+#  so clients that only need part of the package (e.g. keyvalue) don't pay for
+#  importing the rest of it (and its dependencies, e.g. numpy).
+# Explicit imports (e.g. ``from pydvid import keyvalue``) work as usual.
+_SUBMODULES = [ 'errors',
+                'util',
+                'compression',
+                'general',
+                'voxels',
+                'keyvalue',
+                'dvid_connection',
+                'nonblocking' ]
+
+# Note that gui is NOT included here, since PyQt4 is an optional dependency.
+#  It must always be imported explicitly:
+# import pydvid.gui
+
+__all__ = list(_SUBMODULES)
+
+class _LazyPackage(types.ModuleType):
+    """
+    Replaces this package's module object in ``sys.modules``,
+    and imports each submodule the first time it is accessed as an attribute.
+    """
+    def __getattr__(self, name):
+        if name not in _SUBMODULES:
+            raise AttributeError( "'module' object has no attribute '{}'".format( name ) )
+        # The import system stores the submodule as an attribute of this package,
+        #  so this is only called once per submodule.
+        return importlib.import_module( self.__name__ + '.' + name )
+
+    def __dir__(self):
+        return sorted( set( self.__dict__.keys() + _SUBMODULES ) )
+
+_package = _LazyPackage( __name__, __doc__ )
+_package.__dict__.update( sys.modules[__name__].__dict__ )
+
+# Keep a reference to the original module object,
+#  since Python clears a module's globals when it is deleted.
+_package._original_module = sys.modules[__name__]
+sys.modules[__name__] = _package
@@ -0,0 +1,191 @@
+"""
+Support for compressed http transfers (i.e. the ``Content-Encoding`` header).
+
+Supported encodings:
+
+* ``'gzip'`` (always available, via zlib)
+* ``'lz4'`` (requires the optional ``lz4`` package, which provides ``lz4.frame``)
+"""
+import zlib
+
+try:
+    import lz4.frame
+    _have_lz4 = True
+except ImportError:
+    _have_lz4 = False
+
+def supported_encodings():
+    """
+    Return the list of content-encodings that can be used in this environment.
+    """
+    encodings = ['gzip']
+    if _have_lz4:
+        encodings.append('lz4')
+    return encodings
+
+def get_compressor( encoding ):
+    """
+    Return a new compressor object for the given encoding, with ``compress(data)`` and ``flush()`` methods.
+    """
+    _check_encoding( encoding )
+    if encoding == 'gzip':
+        # wbits=16+MAX_WBITS produces the gzip format (rather than the raw zlib format).
+        return zlib.compressobj( 1, zlib.DEFLATED, 16 + zlib.MAX_WBITS )
+    return _Lz4Compressor()
+
+def get_response_stream( response, body_stream=None ):
+    """
+    Return a stream from which the (decompressed) body of the given response can be read.
+    If the server didn't compress the response, that's just the response itself.
+
+    :param body_stream: Optional.  Read the response body from this stream instead of the response itself.
+                        (e.g. a ``pydvid.util.PipelinedStream`` that wraps the response)
+    """
+    if body_stream is None:
+        body_stream = response
+    encoding = response.getheader( 'Content-Encoding', 'identity' )
+    if encoding == 'identity':
+        return body_stream
+    return DecompressingStream( body_stream, encoding )
+
+class DecompressingStream(object):
+    """
+    Wraps a stream of compressed data, and provides the decompressed data via ``read()`` and ``readinto()``.
+    The compressed data is read and decompressed in small chunks, so the decompressed data
+    can be written straight into its destination (e.g. a numpy array) via ``readinto()``.
+    """
+
+    # The compressed data is read from the underlying stream in chunks of this size.
+    READ_CHUNK_SIZE = 256*1024 # (bytes)
+
+    def __init__(self, stream, encoding, compressed_length=None):
+        """
+        stream: The compressed stream.  Must have a ``read(n)`` method.
+        encoding: The content-encoding of the stream, e.g. 'gzip'.
+        compressed_length: If given, read no more than this many bytes from the stream.
+                           (Needed for streams that don't end after the compressed data, e.g. sockets.)
+        """
+        _check_encoding( encoding )
+        self._stream = stream
+        self._remaining_compressed = compressed_length
+        if encoding == 'gzip':
+            self._decompressor = _ZlibDecompressor( 16 + zlib.MAX_WBITS )
+        else:
+            self._decompressor = _Lz4Decompressor()
+
+        # Decompressed data that didn't fit in the caller's buffer.
+        self._pending = ''
+        self._pending_pos = 0
+        self._eof = False
+
+    def readinto(self, buf):
+        """
+        Fill the given writable buffer with decompressed data.
+        Returns the number of bytes written, which is less than len(buf) only at the end of the stream.
+        """
+        buf = memoryview(buf)
+        nbytes = len(buf)
+        filled = 0
+        while filled < nbytes:
+            if self._pending_pos < len(self._pending):
+                chunk = self._pending[self._pending_pos:self._pending_pos + nbytes - filled]
+                buf[filled:filled+len(chunk)] = chunk
+                filled += len(chunk)
+                self._pending_pos += len(chunk)
+                continue
+            if self._eof:
+                break
+
+            data = ''
+            if self._decompressor.needs_input:
+                data = self._read_compressed()
+                if not data:
+                    # End of the compressed stream.  Whatever is left might not fit in buf.
+                    self._eof = True
+                    self._pending = self._decompressor.flush()
+                    self._pending_pos = 0
+                    continue
+
+            decompressed = self._decompressor.decompress( data, nbytes - filled )
+            buf[filled:filled+len(decompressed)] = decompressed
+            filled += len(decompressed)
+        return filled
+
+    def read(self, size=-1):
+        """
+        Return up to size bytes of decompressed data (or all of the remaining data, if size is negative).
+        """
+        if size >= 0:
+            buf = bytearray(size)
+            return str( buf[:self.readinto(buf)] )
+
+        chunks = []
+        while True:
+            chunk = self.read( self.READ_CHUNK_SIZE )
+            if not chunk:
+                return ''.join(chunks)
+            chunks.append(chunk)
+
+    def close(self):
+        self._stream.close()
+
+    def _read_compressed(self):
+        if self._remaining_compressed is None:
+            return self._stream.read( self.READ_CHUNK_SIZE )
+        data = self._stream.read( min( self.READ_CHUNK_SIZE, self._remaining_compressed ) )
+        self._remaining_compressed -= len(data)
+        return data
+
+def _check_encoding( encoding ):
+    if encoding == 'lz4' and not _have_lz4:
+        raise ValueError( "The 'lz4' content-encoding requires the lz4 package." )
+    if encoding not in ('gzip', 'lz4'):
+        raise ValueError( "Unsupported content-encoding: '{}'".format( encoding ) )
+
+class _ZlibDecompressor(object):
+    def __init__(self, wbits):
+        self._decompressobj = zlib.decompressobj( wbits )
+        self._tail = ''
+
+    @property
+    def needs_input(self):
+        return not self._tail
+
+    def decompress(self, data, max_length):
+        decompressed = self._decompressobj.decompress( self._tail + data, max_length )
+        self._tail = self._decompressobj.unconsumed_tail
+        return decompressed
+
+    def flush(self):
+        return self._decompressobj.flush()
+
+class _Lz4Compressor(object):
+    def __init__(self):
+        self._compressor = lz4.frame.LZ4FrameCompressor()
+        self._started = False
+
+    def compress(self, data):
+        header = ''
+        if not self._started:
+            header = self._compressor.begin()
+            self._started = True
+        return header + self._compressor.compress( data )
+
+    def flush(self):
+        if not self._started:
+            return self._compressor.begin() + self._compressor.flush()
+        return self._compressor.flush()
+
+class _Lz4Decompressor(object):
+    def __init__(self):
+        self._decompressor = lz4.frame.LZ4FrameDecompressor()
+
+    @property
+    def needs_input(self):
+        return self._decompressor.needs_input
+
+    def decompress(self, data, max_length):
+        return self._decompressor.decompress( data, max_length )
+
+    def flush(self):
+        return ''
@@ -1,43 +1,346 @@
+import time
+import socket
 import httplib
+import weakref
 import threading
+import contextlib
+
+from pydvid.errors import ConnectionPoolTimeoutError
+
+class PooledHTTPConnection(httplib.HTTPConnection):
+    """
+    An HTTPConnection with two extra safety features for long-lived (keep-alive) connections:
+
+    * If the response to the previous request wasn't fully read (e.g. because an error aborted the read),
+      the connection is re-opened before the next request is sent.
+      (Otherwise, the unread data would be mistaken for the response to the new request.)
+    * If an idempotent request (GET/HEAD without a body) fails because the reused socket
+      turned out to be stale (e.g. the server closed it after a keep-alive timeout),
+      the connection is re-opened and the request is sent once more.
+    """
+    IDEMPOTENT_METHODS = ('GET', 'HEAD')
+
+    def __init__(self, *args, **kwargs):
+        httplib.HTTPConnection.__init__(self, *args, **kwargs)
+        self.last_used = time.time()
+        self._last_response = None
+        self._retry_request = None
+
+    def previous_response_finished(self):
+        """
+        Return True if the response to the previous request (if any) has been fully read,
+        or if it doesn't matter because the server closed the connection after sending it.
+        """
+        response = self._last_response
+        if response is None or response.will_close:
+            return True
+        return response.isclosed() and not response.length
+
+    def putrequest(self, method, url, *args, **kwargs):
+        if not self.previous_response_finished():
+            # The rest of the previous response is still waiting in the socket.
+            # Discard it (and the socket) and start over with a fresh one.
+            self.close()
+        self._last_response = None
+        httplib.HTTPConnection.putrequest(self, method, url, *args, **kwargs)
+
+    def request(self, method, url, body=None, headers={}):
+        # Only requests sent over an already-open socket can fail due to a stale socket.
+        reused_socket = self.sock is not None
+        if reused_socket and method in self.IDEMPOTENT_METHODS and body is None:
+            self._retry_request = (method, url, headers)
+        else:
+            self._retry_request = None
+
+        try:
+            httplib.HTTPConnection.request(self, method, url, body, headers)
+        except socket.error:
+            if self._retry_request is None:
+                raise
+            self._resend()
+
+    def getresponse(self, *args, **kwargs):
+        try:
+            response = httplib.HTTPConnection.getresponse(self, *args, **kwargs)
+        except (httplib.BadStatusLine, socket.error):
+            if self._retry_request is None:
+                raise
+            self._resend()
+            response = httplib.HTTPConnection.getresponse(self, *args, **kwargs)
+        self._retry_request = None
+        self._last_response = response
+        self.last_used = time.time()
+        return response
+
+    def _resend(self):
+        """
+        Re-open the connection and send the last (idempotent) request again.
+        Only one retry is attempted.
+        """
+        method, url, headers = self._retry_request
+        self._retry_request = None
+        self.close()
+        httplib.HTTPConnection.request(self, method, url, headers=headers)
+
+    def close(self):
+        httplib.HTTPConnection.close(self)
+        self._last_response = None
+
+class DvidConnectionPool(object):
+    """
+    A pool of keep-alive connections to a single DVID server.
+
+    Connections are obtained with ``checkout()`` and must be returned with ``checkin()``
+    (or just use the ``connection()`` context manager).
+    If max_size is given, at most max_size connections may be checked out at once; further checkouts block.
+    Idle connections are re-used, unless they have been idle for longer than idle_timeout seconds,
+    in which case they are closed (since the server has probably closed them already).
+
+    Example:
+
+        .. code-block:: python
+
+            pool = DvidConnectionPool( "localhost:8000" )
+            with pool.connection() as connection:
+                info = pydvid.general.get_server_info( connection )
+    """
+
+    def __init__(self, hostname, max_size=32, idle_timeout=60.0):
+        """
+        hostname: The DVID server hostname, e.g. 'emdata1' or 'localhost:8000'
+        max_size: The maximum number of connections that may be checked out at once.
+                  If None, there is no limit.
+        idle_timeout: Idle connections older than this (in seconds) are closed instead of re-used.
+        """
+        self.hostname = hostname
+        self.max_size = max_size
+        self.idle_timeout = idle_timeout
+        self._condition = threading.Condition()
+        self._idle_connections = [] # Most recently used last
+        self._num_checked_out = 0
+
+    def checkout(self, timeout=None):
+        """
+        Return a connection from the pool, opening a new one if no idle connection is available.
+        If max_size connections are already checked out, wait for one to be checked in.
+
+        :param timeout: If no connection becomes available within this many seconds,
+                        raise ConnectionPoolTimeoutError.  (By default, wait forever.)
+        """
+        deadline = None
+        if timeout is not None:
+            deadline = time.time() + timeout
+
+        with self._condition:
+            while self.max_size is not None and self._num_checked_out >= self.max_size:
+                if deadline is None:
+                    self._condition.wait()
+                else:
+                    remaining = deadline - time.time()
+                    if remaining <= 0:
+                        raise ConnectionPoolTimeoutError( "All {} connections to {} are in use."
+                                                          "".format( self.max_size, self.hostname ) )
+                    self._condition.wait( remaining )
+
+            self._evict_idle_connections()
+            if self._idle_connections:
+                connection = self._idle_connections.pop()
+            else:
+                connection = PooledHTTPConnection( self.hostname )
+            self._num_checked_out += 1
+            return connection
+
+    def checkin(self, connection):
+        """
+        Return a connection to the pool.
+        If its last response wasn't fully read, it can't be re-used, so it is closed instead.
+        """
+        with self._condition:
+            self._num_checked_out -= 1
+            if connection.previous_response_finished():
+                connection.last_used = time.time()
+                self._idle_connections.append( connection )
+            else:
+                connection.close()
+            self._evict_idle_connections()
+            self._condition.notify()
+
+    @contextlib.contextmanager
+    def connection(self, timeout=None):
+        """
+        Context manager.  Check out a connection and check it back in when the block exits.
+        """
+        connection = self.checkout( timeout )
+        try:
+            yield connection
+        finally:
+            self.checkin( connection )
+
+    @property
+    def num_idle(self):
+        """
+        Property.  The number of idle connections currently held by the pool.
+        """
+        return len(self._idle_connections)
+
+    @property
+    def num_checked_out(self):
+        """
+        Property.  The number of connections that are currently checked out.
+        """
+        return self._num_checked_out
+
+    def close(self):
+        """
+        Close all idle connections.  (Checked-out connections are closed when they are checked in.)
+        """
+        with self._condition:
+            for connection in self._idle_connections:
+                connection.close()
+            self._idle_connections = []
+
+    def _evict_idle_connections(self):
+        # Caller must hold the lock.
+        now = time.time()
+        expired = filter( lambda c: now - c.last_used >= self.idle_timeout, self._idle_connections )
+        for connection in expired:
+            connection.close()
+        self._idle_connections = filter( lambda c: now - c.last_used < self.idle_timeout, self._idle_connections )
 
 class DvidConnection(object):
     """
-    Simple wrapper around a pool of HTTPConnection instances.
-    One connection is maintained for each thread.
-    All attribute access is forwarded to the underlying connection for the current thread.  
-    So, to clients, this class looks just like a normal HTTPConnection, 
+    Simple wrapper around a DvidConnectionPool.
+    Each thread checks out its own connection from the pool the first time it uses this object.
+    All attribute access is forwarded to the underlying connection for the current thread.
+    So, to clients, this class looks just like a normal HTTPConnection,
       but really each thread gets access to its own HTTPConnection.
+
+    A thread keeps its connection until it calls ``release()`` or exits.
+    (The connections of threads that have exited are returned to the pool
+    the next time a new thread needs a connection.)
+    Tasks that run in long-lived worker threads (e.g. in a ``ThreadPool``) should be wrapped
+    with ``releasing()``, so the workers don't hold on to connections between tasks.
+    By default, there is no limit on the number of connections (one per thread).
+    If max_size is given and all connections are held by live threads for longer than checkout_timeout,
+    the thread that is waiting for a connection raises ConnectionPoolTimeoutError.
     """
 
-    def __init__(self, hostname):
+    def __init__(self, hostname, max_size=None, idle_timeout=60.0, checkout_timeout=60.0):
         """
         hostname: The DVID server hostname, e.g. 'emdata1' or 'localhost:8000'
+        max_size, idle_timeout: Passed to the DvidConnectionPool.
+                                (max_size=None means one connection per thread, without limit.)
+        checkout_timeout: How long (in seconds) a thread may wait for a connection in total.
+                          If None, wait forever.
         """
-        # Open a connection to the server
         self.hostname = hostname
-        self._connections = {}
-    
+        self.pool = DvidConnectionPool( hostname, max_size, idle_timeout )
+        self.checkout_timeout = checkout_timeout
+        self._connections = {} # thread ident -> (weakref to thread, connection)
+        self._lock = threading.Lock()
+
     def __getattribute__(self, name):
         try:
-            # If we have this attr, use it. 
+            # If we have this attr, use it.
             # (e.g. self.hostname, self.close, self._connections)
             return object.__getattribute__(self, name)
-        except:
-            # Get/create the HTTPConnection associated with the current thread
-            thread_id = threading.current_thread().ident
+        except AttributeError:
+            # Forward the attribute access to the connection for the current thread.
+            return getattr(self._current_connection(), name)
+
+    def release(self):
+        """
+        Return the current thread's connection to the pool.
+        (The thread will check out a connection again the next time it uses this object.)
+        """
+        thread_id = threading.current_thread().ident
+        with self._lock:
+            entry = self._connections.pop(thread_id, None)
+        if entry is not None:
+            self.pool.checkin( entry[1] )
+
+    def releasing(self, func):
+        """
+        Return a wrapper around func that returns the calling thread's connection 
+        to the pool after each call (see ``release()``).
+        """
+        def wrapper(*args, **kwargs):
             try:
-                return self._connections[thread_id]
-            except:
-                connection = httplib.HTTPConnection(self.hostname)
-                self._connections[thread_id] = connection
-                return self._connections[thread_id]
+                return func(*args, **kwargs)
+            finally:
+                self.release()
+        return wrapper
+
+    def reset(self):
+        """
+        Close the current thread's connection (e.g. after a failed request, 
+        which may have left it in an unusable state).  The next request re-opens it.
+        """
+        self._current_connection().close()
 
     def close(self):
-        # Close all underlying connections for all threads.
-        for conn in self._connections.values():
-            conn.close()
+        """
+        Close the current thread's connection, the connections of threads that have exited, 
+        and all idle connections in the pool.
+        Connections held by other live threads are left alone (they may be in the middle of a request).
+        They are returned to the pool when those threads call ``release()`` or exit, 
+        so stop (or release) other threads first if all connections must be closed.
+        """
+        self._release_dead_threads()
+        thread_id = threading.current_thread().ident
+        with self._lock:
+            entry = self._connections.pop(thread_id, None)
+        if entry is not None:
+            entry[1].close()
+            self.pool.checkin( entry[1] )
+        self.pool.close()
 
-    # TODO: Implement special request() override that ensures the previous request (if any) has already been fully read, and raises an exception otherwise.
-    #       See httplib docs: https://docs.python.org/2/library/httplib.html#httplib.HTTPConnection.getresponse
-    
\ No newline at end of file
+    def _current_connection(self):
+        """
+        Get the connection associated with the current thread, checking one out if necessary.
+        """
+        thread = threading.current_thread()
+        try:
+            thread_ref, connection = self._connections[thread.ident]
+            if thread_ref() is thread:
+                return connection
+        except KeyError:
+            pass
+
+        # If the pool is exhausted, check periodically for connections
+        #  that can be reclaimed from threads that have exited in the meantime.
+        deadline = None
+        if self.checkout_timeout is not None:
+            deadline = time.time() + self.checkout_timeout
+        while True:
+            self._release_dead_threads()
+            timeout = 0.1
+            if deadline is not None:
+                timeout = max( 0.0, min( timeout, deadline - time.time() ) )
+            try:
+                connection = self.pool.checkout( timeout=timeout )
+                break
+            except ConnectionPoolTimeoutError:
+                if deadline is not None and time.time() >= deadline:
+                    raise
+
+        with self._lock:
+            self._connections[thread.ident] = ( weakref.ref(thread), connection )
+        return connection
+
+    def _release_dead_threads(self):
+        """
+        Return the connections of threads that no longer exist to the pool.
+        (Thread idents may be re-used, so the current thread's stale entry is released, too.)
+        """
+        current_thread = threading.current_thread()
+        with self._lock:
+            dead_entries = []
+            for thread_id, (thread_ref, connection) in self._connections.items():
+                thread = thread_ref()
+                if thread is None or not thread.is_alive() or \
+                   (thread_id == current_thread.ident and thread is not current_thread):
+                    dead_entries.append( connection )
+                    del self._connections[thread_id]
+        for connection in dead_entries:
+            self.pool.checkin( connection )
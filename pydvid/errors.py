@@ -31,4 +31,9 @@ class UnexpectedResponseError( Exception ):
     but the response nonetheless does not match our expectations.
     """
     pass
-        
\ No newline at end of file
+
+class ConnectionPoolTimeoutError( Exception ):
+    """
+    Raised when no connection could be checked out of a DvidConnectionPool within the given timeout.
+    """
+    pass
@@ -1,6 +1,12 @@
+import os
 import httplib
 import contextlib
+
 from pydvid.errors import DvidHttpError, UnexpectedResponseError
+from pydvid.util import get_readinto, imap_unordered
+
+# The buffer size for streaming values to/from files.
+STREAM_BUFFER_SIZE = 4*1024*1024
 
 def create_new( connection, uuid, data_name ):
     """
@@ -45,6 +51,175 @@ def put_value( connection, uuid, data_name, key, value ):
         # Something (either dvid or the httplib) gets upset if we don't read the full response.
         response.read()
 
+def get_value_to_file( connection, uuid, data_name, key, path_or_fileobj, 
+                       buffer_size=STREAM_BUFFER_SIZE, progress_callback=None ):
+    """
+    Request the value for the given key and write it to a file, 
+    without ever holding more than buffer_size bytes of it in memory.
+
+    :param path_or_fileobj: A file path (which will be overwritten), or a file-like object with a write() method.
+    :param progress_callback: Optional.  Called as ``progress_callback(bytes_so_far, total_bytes)`` 
+                              after each buffer is written.  (total_bytes is None if the server didn't say.)
+    :returns: The number of bytes written.
+    """
+    if isinstance( path_or_fileobj, basestring ):
+        with open( path_or_fileobj, 'wb' ) as f:
+            return get_value_to_file( connection, uuid, data_name, key, f, buffer_size, progress_callback )
+    f = path_or_fileobj
+
+    response = get_value_response( connection, uuid, data_name, key )
+    with contextlib.closing( response ):
+        total_bytes = response.length
+        bytes_so_far = 0
+        readinto = get_readinto( response )
+        buf = bytearray( buffer_size )
+        buf_view = memoryview( buf )
+        while True:
+            if readinto is not None:
+                nbytes = readinto( buf_view )
+                data = buffer( buf, 0, nbytes )
+            else:
+                data = response.read( buffer_size )
+                nbytes = len(data)
+            if nbytes == 0:
+                break
+            f.write( data )
+            bytes_so_far += nbytes
+            if progress_callback is not None:
+                progress_callback( bytes_so_far, total_bytes )
+
+    if total_bytes is not None and bytes_so_far != total_bytes:
+        raise UnexpectedResponseError( "Value for key '{}' was truncated: expected {} bytes, got {}"
+                                       "".format( key, total_bytes, bytes_so_far ) )
+    return bytes_so_far
+
+def put_value_from_file( connection, uuid, data_name, key, path_or_fileobj, 
+                         buffer_size=STREAM_BUFFER_SIZE, progress_callback=None ):
+    """
+    Store the contents of a file as the value for the given key, 
+    without ever holding more than buffer_size bytes of it in memory.
+
+    :param path_or_fileobj: A file path, or a file-like object with a read() method.
+                            The value is everything from the file's current position to its end.
+                            (The file must either have a fileno() or be seekable, so its size can be determined.)
+    :param progress_callback: Optional.  Called as ``progress_callback(bytes_so_far, total_bytes)`` 
+                              after each buffer is sent.
+    """
+    if isinstance( path_or_fileobj, basestring ):
+        with open( path_or_fileobj, 'rb' ) as f:
+            return put_value_from_file( connection, uuid, data_name, key, f, buffer_size, progress_callback )
+    f = path_or_fileobj
+    total_bytes = _remaining_file_size( f )
+
+    rest_cmd = "/api/node/{uuid}/{data_name}/{key}".format( **locals() )
+    headers = { "Content-Type" : "application/octet-stream",
+                "Content-Length" : str(total_bytes) }
+    connection.putrequest( "POST", rest_cmd )
+    for header, value in headers.items():
+        connection.putheader( header, value )
+    connection.endheaders()
+
+    readinto = getattr( f, 'readinto', None )
+    buf = bytearray( buffer_size )
+    buf_view = memoryview( buf )
+    bytes_so_far = 0
+    while bytes_so_far < total_bytes:
+        # Never send more than the Content-Length we promised (e.g. if the file grows meanwhile).
+        max_bytes = min( buffer_size, total_bytes - bytes_so_far )
+        if readinto is not None:
+            nbytes = readinto( buf_view[:max_bytes] )
+            data = buffer( buf, 0, nbytes )
+        else:
+            data = f.read( max_bytes )
+            nbytes = len(data)
+        if nbytes == 0:
+            raise IOError( "File ended after {} bytes, but {} bytes were expected.".format( bytes_so_far, total_bytes ) )
+        connection.send( data )
+        bytes_so_far += nbytes
+        if progress_callback is not None:
+            progress_callback( bytes_so_far, total_bytes )
+
+    with contextlib.closing( connection.getresponse() ) as response:
+        if response.status != httplib.OK:
+            raise DvidHttpError( 
+                "keyvalue post", response.status, response.reason, response.read(),
+                 "POST", rest_cmd, "<file data>", headers)
+        response.read()
+
+def _remaining_file_size( f ):
+    """
+    Return the number of bytes between the file's current position and its end.
+    """
+    try:
+        file_size = os.fstat( f.fileno() ).st_size
+        return file_size - f.tell()
+    except (AttributeError, IOError, OSError):
+        # Not a real file: seek to the end to find its size.
+        position = f.tell()
+        f.seek( 0, os.SEEK_END )
+        file_size = f.tell()
+        f.seek( position )
+        return file_size - position
+
+def iter_values( connection, uuid, data_name, keys, num_threads=8, thread_pool=None ):
+    """
+    Request the values for many keys at once, using several concurrent requests.
+    Returns an iterator of ``(key, value, error)`` tuples, in the order the requests complete.
+    If the request for a key failed with a DvidHttpError, value is None and error is the exception.
+    (Other exceptions abort the whole batch.)
+
+    :param num_threads: How many requests may be in progress at once.
+                        Unless num_threads is 1, connection must be a ``DvidConnection``.
+    :param thread_pool: Optional.  A ``ThreadPool`` to use instead of creating a temporary one.
+    """
+    def get_one(key):
+        try:
+            return key, get_value( connection, uuid, data_name, key ), None
+        except DvidHttpError as ex:
+            return key, None, ex
+    return imap_unordered( connection, get_one, keys, num_threads, thread_pool )
+
+def get_values( connection, uuid, data_name, keys, num_threads=8, thread_pool=None ):
+    """
+    Request the values for many keys at once.  See ``iter_values()``.
+    
+    :returns: A tuple ``(values, errors)`` of dicts, mapping each key to its value 
+              (or to the DvidHttpError that prevented its retrieval).
+    """
+    values = {}
+    errors = {}
+    for key, value, error in iter_values( connection, uuid, data_name, keys, num_threads, thread_pool ):
+        if error is None:
+            values[key] = value
+        else:
+            errors[key] = error
+    return values, errors
+
+def put_values( connection, uuid, data_name, mapping, num_threads=8, thread_pool=None ):
+    """
+    Store many values at once, using several concurrent requests.
+    A failure to store one value does not prevent the others from being stored.
+
+    :param mapping: A dict of ``{key : value}`` (or an iterable of ``(key, value)`` pairs).
+    :param num_threads: How many requests may be in progress at once.
+                        Unless num_threads is 1, connection must be a ``DvidConnection``.
+    :param thread_pool: Optional.  A ``ThreadPool`` to use instead of creating a temporary one.
+    :returns: A dict of ``{key : DvidHttpError}`` for the values that could not be stored (empty on success).
+    """
+    if isinstance( mapping, dict ):
+        mapping = mapping.iteritems()
+
+    def put_one(item):
+        key, value = item
+        try:
+            put_value( connection, uuid, data_name, key, value )
+            return key, None
+        except DvidHttpError as ex:
+            return key, ex
+
+    results = imap_unordered( connection, put_one, mapping, num_threads, thread_pool )
+    return { key : error for key, error in results if error is not None }
+
 def del_value( connection, uuid, data_name, key, value ):
     assert False, "TODO"
 
@@ -0,0 +1,752 @@
+"""
+Non-blocking versions of the most common pydvid calls.
+
+Each call returns immediately with a ``multiprocessing.pool.AsyncResult`` (or an object with the same interface).
+
+The basic calls (``get_server_info``, ``get_metadata``, ``get_ndarray``, ``post_ndarray``,
+``get_value`` and ``put_value``) don't need a thread per request:
+they are all sent and received by a single I/O thread, which waits on many (keep-alive) sockets at once.
+At most ``max_concurrency`` of them are in flight at once.  (Further requests are queued.)
+Each response is received in full before it is decoded, so this is best suited to many small requests,
+e.g. thousands of block reads or key lookups.
+
+Everything else (``submit()``, and the ``NonBlockingVoxelsAccessor`` methods, which may issue several requests per call)
+runs in a pool of ``max_concurrency`` worker threads (started on first use),
+each of which borrows a keep-alive connection from a shared pool for the duration of a task.
+Each of those tasks occupies a worker thread until it is finished.
+
+Example:
+
+    .. code-block:: python
+
+        with NonBlockingClient( "localhost:8000", max_concurrency=64 ) as client:
+            results = [ client.get_value( uuid, 'my_keyvalue', key ) for key in keys ]
+            values = [ r.get() for r in results ]
+
+            v = client.voxels_accessor( uuid, 'grayscale' )
+            pending_slices = [ v[:, :, :, z] for z in range(100) ]
+            slices = [ r.get() for r in pending_slices ]
+"""
+import io
+import os
+import json
+import time
+import errno
+import select
+import socket
+import httplib
+import threading
+import traceback
+import collections
+import multiprocessing
+from multiprocessing.pool import ThreadPool
+
+from pydvid import general, keyvalue, voxels
+from pydvid.util import validate_json
+from pydvid.errors import DvidHttpError, UnexpectedResponseError
+from pydvid.dvid_connection import DvidConnection, PooledHTTPConnection
+from pydvid.voxels.voxels import _validate_query_bounds, _validate_post_data, _prepare_result_array, \
+                                 _format_subvolume_rest_uri
+from pydvid.voxels.voxels_nddata_codec import VoxelsNddataCodec
+
+class NonBlockingClient(object):
+    """
+    Issues DVID requests without blocking the caller.
+    The basic calls are all handled by one I/O thread, with at most max_concurrency requests in flight at once.
+    Other tasks run in a pool of max_concurrency worker threads (see the module docs).
+
+    Every method returns an ``AsyncResult`` (or an object with the same interface).
+    Call ``.get()`` on it to wait for the result (any exception raised by the request is re-raised there),
+    or pass a callback, which is called with the result when it is ready.
+    (Callbacks are called from the I/O thread or a worker thread, so they must not block.)
+    """
+
+    def __init__(self, hostname, max_concurrency=32):
+        """
+        hostname: The DVID server hostname, e.g. 'emdata1' or 'localhost:8000'
+        max_concurrency: The maximum number of requests that may be in progress at once
+                         (and the number of worker threads, if any are needed).
+        """
+        self.hostname = hostname
+        self.max_concurrency = max_concurrency
+        self.connection = DvidConnection( hostname, max_size=max_concurrency )
+        self._request_loop = _RequestLoop( hostname, max_concurrency )
+        self._thread_pool = None
+        self._lock = threading.Lock()
+
+    def submit(self, func, *args, **kwargs):
+        """
+        Call ``func(connection, *args, **kwargs)`` in a worker thread.
+        This can be used to run any pydvid function that accepts a connection.
+
+        :param callback: Optional keyword argument.  Called with the result when it is ready.
+        """
+        callback = kwargs.pop( 'callback', None )
+        func = self.connection.releasing( func )
+        return self._get_thread_pool().apply_async( func, (self.connection,) + args, kwargs, callback )
+
+    def get_server_info(self, callback=None):
+        """
+        Non-blocking version of ``general.get_server_info()``
+        """
+        def prepare():
+            rest_query = "/api/server/info"
+            return "GET", rest_query, {}, [], _json_handler( rest_query, 'dvid-server-info-v0.01.schema.json' )
+        return self._request_loop.submit( prepare, callback )
+
+    def get_metadata(self, uuid, data_name, callback=None):
+        """
+        Non-blocking version of ``voxels.get_metadata()``
+        """
+        def prepare():
+            rest_query = "/api/node/{uuid}/{data_name}/metadata".format( uuid=uuid, data_name=data_name )
+            parse_json = _json_handler( rest_query )
+            def handle_response( response ):
+                return voxels.VoxelsMetadata( parse_json( response ) )
+            return "GET", rest_query, {}, [], handle_response
+        return self._request_loop.submit( prepare, callback )
+
+    def get_ndarray(self, uuid, data_name, voxels_metadata, start, stop, out=None, callback=None):
+        """
+        Non-blocking version of ``voxels.get_ndarray()``
+        """
+        def prepare():
+            _validate_query_bounds( start, stop, voxels_metadata.shape, allow_channel_subset=True )
+            result = _prepare_result_array( voxels_metadata, start, stop, out )
+            codec = VoxelsNddataCodec( voxels_metadata )
+            rest_query = _format_subvolume_rest_uri( uuid, data_name, start, stop )
+            def handle_response( response ):
+                _check_status( response, "subvolume query", "GET", rest_query, "" )
+                codec.decode_into_ndarray( response, result, channel_start=start[0] )
+                excess_data = response.read()
+                if excess_data:
+                    full_roi_shape = (voxels_metadata.shape[0],) + result.shape[1:]
+                    raise UnexpectedResponseError( "Received data was longer than expected by {} bytes.  (Expected only {} bytes.)"
+                                                   "".format( len(excess_data), codec.calculate_buffer_len(full_roi_shape) ) )
+                return result
+            return "GET", rest_query, {}, [], handle_response
+        return self._request_loop.submit( prepare, callback )
+
+    def post_ndarray(self, uuid, data_name, voxels_metadata, start, stop, new_data, callback=None):
+        """
+        Non-blocking version of ``voxels.post_ndarray()``
+        """
+        def prepare():
+            _validate_query_bounds( start, stop, voxels_metadata.shape, allow_overflow_extents=True )
+            data = _validate_post_data( voxels_metadata, start, stop, new_data )
+            codec = VoxelsNddataCodec( voxels_metadata )
+            rest_query = _format_subvolume_rest_uri( uuid, data_name, start, stop )
+            headers = { "Content-Type" : VoxelsNddataCodec.VOLUME_MIMETYPE }
+            # The body is sent straight from the array's buffer (if it's F-contiguous).
+            body = _ChunkList()
+            codec.encode_from_ndarray( body, data )
+            def handle_response( response ):
+                _check_status( response, "subvolume post", "POST", rest_query, "<binary data>", headers )
+                response.read()
+            return "POST", rest_query, headers, body, handle_response
+        return self._request_loop.submit( prepare, callback )
+
+    def get_value(self, uuid, data_name, key, callback=None):
+        """
+        Non-blocking version of ``keyvalue.get_value()``
+        """
+        def prepare():
+            rest_query = "/api/node/{uuid}/{data_name}/{key}".format( uuid=uuid, data_name=data_name, key=key )
+            def handle_response( response ):
+                _check_status( response, "keyvalue request", "GET", rest_query, "" )
+                return response.read()
+            return "GET", rest_query, {}, [], handle_response
+        return self._request_loop.submit( prepare, callback )
+
+    def put_value(self, uuid, data_name, key, value, callback=None):
+        """
+        Non-blocking version of ``keyvalue.put_value()``
+        (Values that are file-like objects are sent from a worker thread.)
+        """
+        if not isinstance( value, str ):
+            return self.submit( keyvalue.put_value, uuid, data_name, key, value, callback=callback )
+        def prepare():
+            rest_cmd = "/api/node/{uuid}/{data_name}/{key}".format( uuid=uuid, data_name=data_name, key=key )
+            headers = { "Content-Type" : "application/octet-stream" }
+            def handle_response( response ):
+                _check_status( response, "keyvalue post", "POST", rest_cmd, "<binary data>", headers )
+                response.read()
+            return "POST", rest_cmd, headers, [value], handle_response
+        return self._request_loop.submit( prepare, callback )
+
+    def voxels_accessor(self, uuid, data_name):
+        """
+        Return a ``NonBlockingVoxelsAccessor`` for the given volume, which uses this client.
+        (The volume's metadata is requested immediately, i.e. this call blocks.)
+        """
+        return NonBlockingVoxelsAccessor( self, uuid, data_name )
+
+    def close(self):
+        """
+        Wait for all queued requests to finish, then stop the I/O and worker threads and close all connections.
+        """
+        with self._lock:
+            thread_pool = self._thread_pool
+        if thread_pool is not None:
+            thread_pool.close()
+            thread_pool.join()
+        self._request_loop.close()
+        self.connection.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def _get_thread_pool(self):
+        """
+        Return the pool of worker threads, starting it if necessary.
+        """
+        with self._lock:
+            if self._thread_pool is None:
+                self._thread_pool = ThreadPool( self.max_concurrency )
+            return self._thread_pool
+
+class NonBlockingVoxelsAccessor(voxels.VoxelsAccessor):
+    """
+    A ``VoxelsAccessor`` whose data methods (``get_ndarray``, ``post_ndarray``, ``get_sliced``,
+    and slicing reads such as ``v[:, 0:10]``) return an ``AsyncResult`` instead of the data itself.
+    (Slicing assignment still blocks, since it can't return anything.
+    ``iter_blocks()`` also behaves as usual: it yields the data itself, and blocks until each chunk is ready.)
+    Each call may issue several requests, so the calls run in the client's worker threads (not its I/O thread).
+
+    Example:
+
+        .. code-block:: python
+
+            v = client.voxels_accessor( uuid, 'grayscale' )
+            result = v[:, 0:100, 0:100, 10]
+            # ... do other things ...
+            a = result.get()
+    """
+
+    def __init__(self, client, uuid, data_name):
+        # Request the metadata from a worker thread: the workers may already hold 
+        #  all of the client's connections, so this thread might not get one.
+        init = client.connection.releasing( super( NonBlockingVoxelsAccessor, self ).__init__ )
+        client._get_thread_pool().apply( init, (client.connection, uuid, data_name) )
+        self._client = client
+        self._blocking = _BlockingView( self )
+
+    def get_ndarray(self, start, stop, out=None, callback=None):
+        return self._submit( self._blocking.get_ndarray, (start, stop, out), callback )
+
+    def post_ndarray(self, start, stop, new_data, callback=None):
+        return self._submit( self._blocking.post_ndarray, (start, stop, new_data), callback )
+
+    def get_sliced(self, slicing, out=None, callback=None):
+        return self._submit( self._blocking.get_sliced, (slicing, out), callback )
+
+    def iter_blocks(self, roi=None, block_shape=None, order='F', prefetch=2):
+        # An iterator can't usefully yield pending results in order, so this blocks, 
+        #  just like the base class (whose prefetching already overlaps the requests).
+        return self._blocking.iter_blocks( roi, block_shape, order, prefetch )
+
+    def __setitem__(self, slicing, array_data):
+        # Assignment can't return anything, so it waits for the request to finish.
+        # (Use post_ndarray() to write without waiting.)
+        self._submit( self._blocking.__setitem__, (slicing, array_data), None ).get()
+
+    def _submit(self, func, args, callback):
+        func = self._client.connection.releasing( func )
+        return self._client._get_thread_pool().apply_async( func, args, callback=callback )
+
+class _BlockingView(voxels.VoxelsAccessor):
+    """
+    Provides the ordinary (blocking) methods for a NonBlockingVoxelsAccessor.
+    (The base class methods call each other, so they must not be routed back to the worker threads.)
+
+    The view has no state of its own: all attribute access (including assignment) is delegated
+    to the accessor, so the base class methods read and update the accessor's state.
+    """
+    def __init__(self, accessor):
+        object.__setattr__( self, '_accessor', accessor )
+
+    def __getattribute__(self, name):
+        # The accessor's instance attributes take precedence over class attributes
+        #  (e.g. if STRIDED_REQUEST_COST_BYTES was overridden for the accessor).
+        accessor_dict = object.__getattribute__( self, '_accessor' ).__dict__
+        if name in accessor_dict:
+            return accessor_dict[name]
+        return object.__getattribute__( self, name )
+
+    def __getattr__(self, name):
+        return getattr( self._accessor, name )
+
+    def __setattr__(self, name, value):
+        setattr( self._accessor, name, value )
+
+    def __delattr__(self, name):
+        delattr( self._accessor, name )
+
+def _check_status( response, attempted_action_name, method, request_uri, request_body="<unspecified>", request_headers="<unspecified>" ):
+    """
+    Raise a DvidHttpError if the response status isn't 200 (OK).
+    """
+    if response.status != httplib.OK:
+        raise DvidHttpError( attempted_action_name, response.status, response.reason, response.read(),
+                             method, request_uri, request_body, request_headers )
+
+def _json_handler( resource_path, schema=None ):
+    """
+    Return a response handler that parses (and optionally validates) a json response,
+    just like ``pydvid.util.get_json_generic()``.
+    """
+    def handle_response( response ):
+        _check_status( response, "requesting json for: {}".format( resource_path ), "GET", resource_path, "" )
+        try:
+            parsed_response = json.loads( response.read() )
+        except ValueError as ex:
+            raise Exception( "Couldn't parse the dataset info response as json:\n"
+                             "{}".format( ex.args ) )
+        if schema:
+            validate_json( parsed_response, schema )
+        return parsed_response
+    return handle_response
+
+class _ChunkList(list):
+    """
+    A list that can be written to like a stream, e.g. to collect a request body without copying it.
+    """
+    write = list.append
+
+class _PendingResult(object):
+    """
+    The result of a request that is handled by a ``_RequestLoop``.
+    Provides the same interface as ``multiprocessing.pool.AsyncResult``.
+    """
+    def __init__(self, callback=None):
+        self._callback = callback
+        self._event = threading.Event()
+        self._success = None
+        self._value = None
+
+    def ready(self):
+        return self._event.is_set()
+
+    def successful(self):
+        assert self.ready()
+        return self._success
+
+    def wait(self, timeout=None):
+        self._event.wait( timeout )
+
+    def get(self, timeout=None):
+        self.wait( timeout )
+        if not self.ready():
+            raise multiprocessing.TimeoutError
+        if self._success:
+            return self._value
+        raise self._value
+
+    def _set(self, success, value):
+        self._success = success
+        self._value = value
+        try:
+            if self._callback is not None and success:
+                self._callback( value )
+        except Exception:
+            # There's nobody to raise this to (just like an exception in a thread).
+            traceback.print_exc()
+        finally:
+            self._event.set()
+
+class _Exchange(object):
+    """
+    One request (and its response), as handled by a ``_RequestLoop``.
+    Keeps track of how much of the request has been sent,
+    and finds the end of the response as it arrives (so the socket can be re-used).
+    The complete response is then parsed by httplib, and passed to handle_response().
+    """
+    # Same limit as httplib
+    MAX_HEADER_BYTES = 65536
+
+    def __init__(self, host_header, method, url, headers, body_chunks, handle_response, result):
+        self.method = method
+        self.handle_response = handle_response
+        self.result = result
+        self.retried = False
+
+        header_lines = [ "{} {} HTTP/1.1".format( method, url ),
+                         "Host: {}".format( host_header ),
+                         "Accept-Encoding: identity" ]
+        header_lines += [ "{}: {}".format( name, value ) for name, value in headers.items() ]
+        if body_chunks or method == "POST":
+            header_lines.append( "Content-Length: {}".format( sum( map( len, body_chunks ) ) ) )
+        self._request_chunks = [ "\r\n".join( header_lines ) + "\r\n\r\n" ] + list( body_chunks )
+
+    def start(self, reused_socket):
+        """
+        (Re-)start the exchange on a new or re-used socket.
+        """
+        self.reused_socket = reused_socket
+        self.connecting = not reused_socket
+        self.sending = True
+        self.bytes_received = 0
+        self.extra_bytes = False
+        self._send_index = 0
+        self._send_offset = 0
+        self._head = ""
+        self._received = None
+        self._framing = None
+        self._remaining = 0
+        self._chunk_pending = ""
+        self._in_trailer = False
+
+    def can_retry(self):
+        """
+        Return True if the exchange failed in a way that can only be explained by a stale socket,
+        and the request can safely be sent once more (see ``PooledHTTPConnection``).
+        """
+        return ( self.reused_socket and not self.retried and self.bytes_received == 0
+                 and self.method in PooledHTTPConnection.IDEMPOTENT_METHODS )
+
+    def send(self, sock):
+        """
+        Send as much of the request as the socket will take.
+        (Raises socket.error with EAGAIN if the socket isn't ready.)
+        """
+        while self._send_index < len(self._request_chunks):
+            chunk = self._request_chunks[self._send_index]
+            self._send_offset += sock.send( buffer( chunk, self._send_offset ) )
+            if self._send_offset >= len(chunk):
+                self._send_index += 1
+                self._send_offset = 0
+        self.sending = False
+
+    def receive(self, data):
+        """
+        Process the next piece of the response.  Return True if the response is complete.
+        """
+        if not data:
+            # The server closed the connection.
+            if self.bytes_received == 0:
+                raise httplib.BadStatusLine( "" )
+            if self._framing != 'close':
+                raise httplib.IncompleteRead( "" )
+            return True
+
+        self.bytes_received += len(data)
+        if self._framing is None:
+            self._head += data
+            header_end = self._head.find( "\r\n\r\n" )
+            if header_end == -1:
+                if len(self._head) > self.MAX_HEADER_BYTES:
+                    raise httplib.LineTooLong( "header" )
+                return False
+            self._received = io.BytesIO()
+            self._received.write( self._head )
+            data = self._head[header_end+4:]
+            self._parse_head( self._head[:header_end] )
+            self._head = ""
+        else:
+            self._received.write( data )
+
+        if self._framing == 'length':
+            self._remaining -= len(data)
+            self.extra_bytes = ( self._remaining < 0 )
+            return self._remaining <= 0
+        if self._framing == 'chunked':
+            return self._scan_chunks( data )
+        if self._framing == 'none':
+            self.extra_bytes = bool(data)
+            return True
+        return False
+
+    def get_response(self):
+        """
+        Parse the complete response (with httplib).
+        """
+        self._received.seek(0)
+        response = httplib.HTTPResponse( _ReceivedSocket( self._received ), method=self.method )
+        response.begin()
+        return response
+
+    def _parse_head(self, head):
+        """
+        Determine how the end of the response body will be marked.
+        """
+        lines = head.split( "\r\n" )
+        try:
+            status = int( lines[0].split( None, 2 )[1] )
+        except (IndexError, ValueError):
+            raise httplib.BadStatusLine( lines[0] )
+        headers = {}
+        for line in lines[1:]:
+            name, _, value = line.partition( ":" )
+            headers[name.strip().lower()] = value.strip()
+
+        if self.method == "HEAD" or status in (httplib.NO_CONTENT, httplib.NOT_MODIFIED):
+            self._framing = 'none'
+        elif 'chunked' in headers.get( 'transfer-encoding', '' ).lower():
+            self._framing = 'chunked'
+        elif 'content-length' in headers:
+            self._framing = 'length'
+            self._remaining = int( headers['content-length'] )
+        else:
+            self._framing = 'close'
+
+    def _scan_chunks(self, data):
+        """
+        Skip over the chunks of a chunked response body.  Return True after the last chunk (and trailer).
+        """
+        pending = self._chunk_pending + data
+        while True:
+            if self._remaining > 0:
+                skip = min( self._remaining, len(pending) )
+                pending = pending[skip:]
+                self._remaining -= skip
+                if self._remaining > 0:
+                    break
+            line_end = pending.find( "\r\n" )
+            if line_end == -1:
+                break
+            line = pending[:line_end]
+            pending = pending[line_end+2:]
+            if self._in_trailer:
+                if not line:
+                    self.extra_bytes = bool(pending)
+                    return True
+                continue
+            try:
+                chunk_size = int( line.split( ";", 1 )[0], 16 )
+            except ValueError:
+                raise httplib.IncompleteRead( line )
+            if chunk_size == 0:
+                self._in_trailer = True
+            else:
+                self._remaining = chunk_size + 2 # (including the chunk's trailing CRLF)
+        self._chunk_pending = pending
+        return False
+
+class _ReceivedSocket(object):
+    """
+    Provides a received response to ``httplib.HTTPResponse``, as if it were a socket.
+    """
+    def __init__(self, f):
+        self._f = f
+
+    def makefile(self, *args):
+        return self._f
+
+class _RequestLoop(object):
+    """
+    Sends requests to a single server and receives the responses, all from one (background) thread,
+    using non-blocking sockets and ``select()``.  At most max_concurrency requests are in flight at once.
+    Sockets are kept open between requests (unless the server closes them),
+    and idle sockets are closed after idle_timeout seconds.
+    """
+    RECV_SIZE = 256*1024
+
+    def __init__(self, hostname, max_concurrency, idle_timeout=60.0):
+        # (Let httplib parse the hostname and port.)
+        connection = httplib.HTTPConnection( hostname )
+        self.host, self.port = connection.host, connection.port
+        self.host_header = hostname
+        self.max_concurrency = max_concurrency
+        self.idle_timeout = idle_timeout
+
+        self._lock = threading.Lock()
+        self._queue = collections.deque() # Exchanges that haven't been started yet
+        self._closing = False
+        self._wakeup_pending = False
+        self._wakeup_receiver, self._wakeup_sender = socket.socketpair()
+
+        # The rest is only accessed from the loop thread.
+        self._address = None
+        self._active = {} # socket -> exchange
+        self._idle = collections.OrderedDict() # socket -> time it became idle (most recently used last)
+
+        self._thread = threading.Thread( target=self._run, name="DVID request loop ({})".format( hostname ) )
+        self._thread.daemon = True
+        self._thread.start()
+
+    def submit(self, prepare, callback=None):
+        """
+        Queue a request, and return a result object with the ``AsyncResult`` interface.
+
+        prepare: Called immediately (in the calling thread) to build the request.
+                 Must return ``(method, url, headers, body_chunks, handle_response)``.
+                 handle_response is called (from the loop thread) with the complete ``HTTPResponse``,
+                 and its return value (or exception) becomes the result.
+        """
+        result = _PendingResult( callback )
+        try:
+            method, url, headers, body_chunks, handle_response = prepare()
+            exchange = _Exchange( self.host_header, method, url, headers, body_chunks, handle_response, result )
+        except Exception as ex:
+            result._set( False, ex )
+            return result
+
+        with self._lock:
+            assert not self._closing, "Can't send requests after close()"
+            self._queue.append( exchange )
+            self._wakeup()
+        return result
+
+    def close(self):
+        """
+        Wait for all queued requests to finish, then stop the loop thread and close all sockets.
+        """
+        with self._lock:
+            self._closing = True
+            self._wakeup()
+        self._thread.join()
+        self._wakeup_receiver.close()
+        self._wakeup_sender.close()
+
+    def _wakeup(self):
+        # Caller must hold the lock.
+        if not self._wakeup_pending:
+            self._wakeup_pending = True
+            self._wakeup_sender.send( "x" )
+
+    def _run(self):
+        try:
+            while True:
+                with self._lock:
+                    if self._closing and not self._queue and not self._active:
+                        break
+                    new_exchanges = []
+                    while self._queue and len(self._active) + len(new_exchanges) < self.max_concurrency:
+                        new_exchanges.append( self._queue.popleft() )
+                for exchange in new_exchanges:
+                    self._start( exchange )
+                self._close_expired_sockets()
+
+                readers = [ self._wakeup_receiver ] + list( self._idle.keys() )
+                readers += [ sock for sock, exchange in self._active.items() if not exchange.sending ]
+                writers = [ sock for sock, exchange in self._active.items() if exchange.sending ]
+                timeout = self.idle_timeout if self._idle else None
+                try:
+                    readable, writable, _ = select.select( readers, writers, [], timeout )
+                except select.error as ex:
+                    if ex.args[0] == errno.EINTR:
+                        continue
+                    raise
+
+                for sock in writable:
+                    self._on_writable( sock )
+                for sock in readable:
+                    if sock is self._wakeup_receiver:
+                        with self._lock:
+                            self._wakeup_receiver.recv( 4096 )
+                            self._wakeup_pending = False
+                    elif sock in self._idle:
+                        # An idle socket became readable: the server closed it.
+                        del self._idle[sock]
+                        sock.close()
+                    elif sock in self._active:
+                        self._on_readable( sock )
+        except Exception as ex:
+            # Fail the outstanding requests, rather than leave their callers waiting forever.
+            with self._lock:
+                exchanges = self._active.values() + list( self._queue )
+                self._queue.clear()
+                self._closing = True
+            self._active = {}
+            for exchange in exchanges:
+                exchange.result._set( False, ex )
+        finally:
+            for sock in self._active.keys() + self._idle.keys():
+                sock.close()
+            self._active = {}
+            self._idle.clear()
+
+    def _start(self, exchange, fresh_socket=False):
+        """
+        Start sending the given exchange, on an idle socket (if any) or a new one.
+        """
+        if self._idle and not fresh_socket:
+            sock, _ = self._idle.popitem( last=True )
+            exchange.start( reused_socket=True )
+        else:
+            try:
+                sock = self._connect()
+            except socket.error as ex:
+                exchange.result._set( False, ex )
+                return
+            exchange.start( reused_socket=False )
+        self._active[sock] = exchange
+
+    def _connect(self):
+        """
+        Open a new non-blocking socket and start connecting to the server.
+        """
+        if self._address is None:
+            self._address = socket.getaddrinfo( self.host, self.port, 0, socket.SOCK_STREAM )[0]
+        family, socktype, proto, _, sockaddr = self._address
+        sock = socket.socket( family, socktype, proto )
+        sock.setblocking( 0 )
+        sock.setsockopt( socket.IPPROTO_TCP, socket.TCP_NODELAY, 1 )
+        err = sock.connect_ex( sockaddr )
+        if err not in (0, errno.EINPROGRESS, errno.EWOULDBLOCK):
+            sock.close()
+            raise socket.error( err, os.strerror( err ) )
+        return sock
+
+    def _on_writable(self, sock):
+        exchange = self._active[sock]
+        try:
+            if exchange.connecting:
+                err = sock.getsockopt( socket.SOL_SOCKET, socket.SO_ERROR )
+                if err != 0:
+                    raise socket.error( err, os.strerror( err ) )
+                exchange.connecting = False
+            exchange.send( sock )
+        except socket.error as ex:
+            if ex.args[0] not in (errno.EAGAIN, errno.EWOULDBLOCK):
+                self._on_error( sock, exchange, ex )
+
+    def _on_readable(self, sock):
+        exchange = self._active[sock]
+        try:
+            data = sock.recv( self.RECV_SIZE )
+            if not exchange.receive( data ):
+                return
+            response = exchange.get_response()
+        except socket.error as ex:
+            if ex.args[0] not in (errno.EAGAIN, errno.EWOULDBLOCK):
+                self._on_error( sock, exchange, ex )
+            return
+        except (httplib.HTTPException, ValueError) as ex:
+            self._on_error( sock, exchange, ex )
+            return
+
+        del self._active[sock]
+        if data and not response.will_close and not exchange.extra_bytes:
+            self._idle[sock] = time.time()
+        else:
+            sock.close()
+
+        try:
+            result = exchange.handle_response( response )
+        except Exception as ex:
+            exchange.result._set( False, ex )
+        else:
+            exchange.result._set( True, result )
+
+    def _on_error(self, sock, exchange, ex):
+        """
+        Close the socket, and either retry the request (once) on a new socket, or fail it.
+        """
+        del self._active[sock]
+        sock.close()
+        if exchange.can_retry():
+            exchange.retried = True
+            self._start( exchange, fresh_socket=True )
+        else:
+            exchange.result._set( False, ex )
+
+    def _close_expired_sockets(self):
+        now = time.time()
+        for sock, last_used in self._idle.items():
+            if now - last_used >= self.idle_timeout:
+                del self._idle[sock]
+                sock.close()
@@ -1,9 +1,14 @@
 import os
+import sys
 import json
+import errno
+import Queue
+import random
+import socket
 import httplib
+import threading
 import contextlib
-
-import jsonschema
+from multiprocessing.pool import ThreadPool
 
 import pydvid
 
@@ -14,6 +19,7 @@ def get_json_generic( connection, resource_path, schema=None ):
     Request the json data found at the given resource path, e.g. '/api/datasets/info'
     If schema is a dict, validate the response against it.
     If schema is a str, it should be the name of a schema file found in pydvid/schemas.
+    (Validation may be disabled or sampled.  See ``set_schema_validation()``.)
     """
     connection.request( "GET", resource_path )
     with contextlib.closing( connection.getresponse() ) as response:
@@ -30,10 +36,7 @@ def get_json_generic( connection, resource_path, schema=None ):
                              "{}".format( ex.args ) )
         
         if schema:
-            if isinstance( schema, str ):
-                schema = parse_schema( schema )
-            assert isinstance( schema, dict )
-            jsonschema.validate( parsed_response, schema )
+            validate_json( parsed_response, schema )
 
         return parsed_response
 
@@ -65,3 +68,298 @@ def parse_schema( schema_filename ):
     # Parse the json
     with open( schema_path ) as schema_file:
         return json.load( schema_file )
+
+# Schemas and their compiled validators, by schema filename.
+_schemas = {}
+_validators = {}
+_schema_lock = threading.Lock()
+
+# The fraction of json payloads to validate (0.0: none, 1.0: all).
+# The initial value can be set with the PYDVID_SCHEMA_VALIDATION environment variable.
+_schema_validation_rate = float( os.environ.get( 'PYDVID_SCHEMA_VALIDATION', 1.0 ) )
+
+def set_schema_validation( rate ):
+    """
+    Control how many json payloads are validated against their schemas
+    by ``validate_json()`` (and hence by ``get_json_generic()`` and ``VoxelsMetadata``).
+
+    :param rate: The fraction of payloads to validate, chosen at random.
+                 Use True or 1.0 to validate all payloads (the default), 
+                 False or 0.0 to disable validation, or something in between 
+                 to catch schema mismatches in production without paying for every payload.
+    """
+    global _schema_validation_rate
+    rate = float(rate)
+    assert 0.0 <= rate <= 1.0, "Validation rate must be between 0.0 and 1.0, not {}".format( rate )
+    _schema_validation_rate = rate
+
+def get_schema( schema_filename ):
+    """
+    Return the parsed schema with the given schema filename (see ``parse_schema()``).
+    Each schema file is only read once.  The returned schema must not be modified.
+    """
+    try:
+        return _schemas[schema_filename]
+    except KeyError:
+        pass
+    schema = parse_schema( schema_filename )
+    with _schema_lock:
+        return _schemas.setdefault( schema_filename, schema )
+
+def get_validator( schema ):
+    """
+    Return a compiled validator object for the given schema (a schema filename or a dict).
+    Validators for schema files are compiled only once.
+    """
+    # jsonschema is imported on first use, since it is slow to import
+    #  and not needed by clients that never validate anything.
+    import jsonschema
+
+    if not isinstance( schema, basestring ):
+        assert isinstance( schema, dict )
+        return jsonschema.validators.validator_for( schema )( schema )
+
+    try:
+        return _validators[schema]
+    except KeyError:
+        pass
+    schema_dict = get_schema( schema )
+    validator_cls = jsonschema.validators.validator_for( schema_dict )
+    validator_cls.check_schema( schema_dict )
+    with _schema_lock:
+        return _validators.setdefault( schema, validator_cls( schema_dict ) )
+
+def validate_json( data, schema ):
+    """
+    Validate the given (parsed) json data against the given schema (a schema filename or a dict).
+    Raises ``jsonschema.ValidationError`` if the data is invalid.
+    Depending on the current validation rate, validation may be skipped.  See ``set_schema_validation()``.
+    """
+    rate = _schema_validation_rate
+    if rate == 0.0 or ( rate < 1.0 and random.random() >= rate ):
+        return
+    get_validator( schema ).validate( data )
+
+def get_readinto( stream ):
+    """
+    Return a function with the semantics of ``io.RawIOBase.readinto(b)`` for the given stream, 
+    i.e. it reads up to len(b) bytes directly into the writable buffer b and returns 
+    the number of bytes read (0 at the end of the stream).
+
+    Streams that natively support readinto() (e.g. ``io`` objects) just use that.
+    An ``httplib.HTTPResponse`` with a known Content-Length is read with ``socket.recv_into()``, 
+    which copies the data straight from the socket into the destination buffer.
+    For any other stream, returns None.
+    """
+    readinto = getattr( stream, 'readinto', None )
+    if readinto is not None:
+        return readinto
+    if isinstance( stream, httplib.HTTPResponse ):
+        return _http_response_readinto( stream )
+    return None
+
+def _http_response_readinto( response ):
+    """
+    Return a readinto() function for the given httplib.HTTPResponse, or None if 
+    it isn't safe to bypass the response's own read() method.
+
+    This only works because httplib reads the response headers from an unbuffered 
+    socket file, so after the headers have been parsed, the remaining response 
+    body is still waiting in the socket itself.
+    """
+    fp = response.fp
+    if fp is None or response.chunked or response.length is None:
+        return None
+    sock = getattr( fp, '_sock', None )
+    rbuf = getattr( fp, '_rbuf', None )
+    if sock is None or rbuf is None or not hasattr( sock, 'recv_into' ) or rbuf.getvalue():
+        # Some of the body has already been buffered by the file object.
+        return None
+
+    def readinto( buf ):
+        if response.fp is None or response.length == 0:
+            return 0
+        nbytes = min( len(buf), response.length )
+        while True:
+            try:
+                received = sock.recv_into( buf, nbytes )
+                break
+            except socket.error as ex:
+                if ex.args[0] != errno.EINTR:
+                    raise
+        # Keep the response's own bookkeeping up-to-date, 
+        #  so it can still be read() (and closed) as usual.
+        response.length -= received
+        if received == 0 or response.length == 0:
+            response.close()
+        return received
+    return readinto
+
+class PipelinedStream(object):
+    """
+    Wraps a stream, and reads it ahead of time in a background thread, 
+    into a ring of num_buffers buffers of buffer_size bytes each.
+    
+    Meanwhile, the consumer's ``readinto()`` (or ``read()``) calls copy the data out of the filled buffers.
+    That way, receiving data from the network overlaps with whatever the consumer does with it
+    (e.g. copying it into a non-contiguous array, or decompressing it), 
+    at the cost of one extra copy and at most num_buffers*buffer_size bytes of memory.
+    
+    Any exception raised while reading the underlying stream is re-raised in the consumer's thread.
+    """
+    
+    def __init__(self, stream, buffer_size=4*1024*1024, num_buffers=4):
+        assert num_buffers >= 2, "Pipelining requires at least 2 buffers."
+        self._stream = stream
+        self._free_buffers = Queue.Queue()
+        self._filled_buffers = Queue.Queue()
+        for _ in range(num_buffers):
+            self._free_buffers.put( bytearray(buffer_size) )
+
+        # The filled buffer that is currently being consumed (as a memoryview), and the read position within it.
+        self._current_buf = None
+        self._current_view = None
+        self._current_len = 0
+        self._current_pos = 0
+        self._eof = False
+        self._stopped = False
+
+        self._thread = threading.Thread( target=self._receive, name="PipelinedStream" )
+        self._thread.daemon = True
+        self._thread.start()
+
+    def readinto(self, buf):
+        """
+        Fill the given writable buffer with data from the stream.
+        Returns the number of bytes written, which is less than len(buf) only at the end of the stream.
+        """
+        buf = memoryview(buf)
+        filled = 0
+        while filled < len(buf):
+            if self._current_pos == self._current_len:
+                if not self._next_buffer():
+                    break
+            nbytes = min( len(buf) - filled, self._current_len - self._current_pos )
+            buf[filled:filled+nbytes] = self._current_view[self._current_pos:self._current_pos+nbytes]
+            filled += nbytes
+            self._current_pos += nbytes
+        return filled
+
+    def read(self, size=-1):
+        """
+        Return up to size bytes (or all of the remaining data, if size is negative).
+        """
+        if size >= 0:
+            buf = bytearray(size)
+            return str( buf[:self.readinto(buf)] )
+
+        chunks = []
+        while self._current_pos < self._current_len or self._next_buffer():
+            chunks.append( self._current_view[self._current_pos:self._current_len].tobytes() )
+            self._current_pos = self._current_len
+        return ''.join(chunks)
+
+    def close(self):
+        """
+        Stop the background thread (after it finishes filling its current buffer) and close the underlying stream.
+        """
+        self._stopped = True
+        self._free_buffers.put( None ) # Wake up the receiver, if necessary.
+        self._thread.join()
+        self._stream.close()
+
+    def _next_buffer(self):
+        """
+        Recycle the current buffer and wait for the next filled buffer.
+        Returns False at the end of the stream.
+        """
+        if self._eof:
+            return False
+        if self._current_buf is not None:
+            self._free_buffers.put( self._current_buf )
+            self._current_buf = self._current_view = None
+
+        buf, nbytes, exc_info = self._filled_buffers.get()
+        if exc_info is not None:
+            self._eof = True
+            raise exc_info[0], exc_info[1], exc_info[2]
+        if nbytes == 0:
+            self._eof = True
+            return False
+        self._current_buf = buf
+        self._current_view = memoryview(buf)
+        self._current_len = nbytes
+        self._current_pos = 0
+        return True
+
+    def _receive(self):
+        """
+        The background thread: Fill free buffers from the stream until the stream ends.
+        """
+        readinto = get_readinto( self._stream )
+        try:
+            while not self._stopped:
+                buf = self._free_buffers.get()
+                if buf is None or self._stopped:
+                    return
+                nbytes = self._fill( buf, readinto )
+                self._filled_buffers.put( (buf, nbytes, None) )
+                if nbytes < len(buf):
+                    # End of stream.
+                    if nbytes > 0:
+                        self._filled_buffers.put( (None, 0, None) )
+                    return
+        except:
+            self._filled_buffers.put( (None, 0, sys.exc_info()) )
+
+    def _fill(self, buf, readinto):
+        """
+        Fill the given buffer from the stream.  Returns the number of bytes read (less than len(buf) only at the end of the stream).
+        """
+        view = memoryview(buf)
+        filled = 0
+        while filled < len(buf):
+            if readinto is not None:
+                received = readinto( view[filled:] )
+            else:
+                data = self._stream.read( len(buf) - filled )
+                received = len(data)
+                view[filled:filled+received] = data
+            if not received:
+                break
+            filled += received
+        return filled
+
+def imap_unordered( connection, func, items, num_threads, thread_pool=None ):
+    """
+    Return an iterator of func(item) for all items (in the order they complete), 
+    computed using several threads at once.
+    If no thread_pool is given, a temporary pool with num_threads threads is used.
+    Any exception from func is re-raised in the calling thread.
+
+    Unless num_threads is 1, connection must be a ``DvidConnection``.
+    Each thread returns its connection to the pool after each call of func.
+    """
+    if thread_pool is None and num_threads == 1:
+        return ( func(item) for item in items )
+
+    assert isinstance( connection, pydvid.dvid_connection.DvidConnection ), \
+        "Concurrent requests require a DvidConnection, which gives each thread its own HTTPConnection."
+
+    # Pool threads may live much longer than this call, so they must not keep their connections.
+    func = connection.releasing( func )
+    if thread_pool is not None:
+        return thread_pool.imap_unordered( func, items )
+
+    def generate_results():
+        pool = ThreadPool( num_threads )
+        try:
+            for result in pool.imap_unordered( func, items ):
+                yield result
+            pool.close()
+        finally:
+            # If the caller stopped iterating early (or func failed), 
+            #  don't start the remaining items, but let the running ones finish.
+            pool.terminate()
+            pool.join()
+    return generate_results()
@@ -1,4 +1,5 @@
 from voxels import *
 from voxels_metadata import VoxelsMetadata
 from voxels_accessor import VoxelsAccessor
-
+from block_cache import BlockCache, DiskBlockCache
+from metadata_cache import MetadataCache, DEFAULT_METADATA_CACHE
@@ -0,0 +1,314 @@
+import os
+import errno
+import shutil
+import tempfile
+import threading
+import collections
+
+import numpy
+
+class BlockCache(object):
+    """
+    An in-memory cache of voxel blocks with a size budget and least-recently-used eviction.
+
+    Keys are ``(uuid, data_name, block_coord)`` tuples, where block_coord is the
+    index of the block along each (non-channel) axis of the volume, e.g. ``(2,0,5)``.
+    Values are F-order arrays containing all channels of the block.
+    (Blocks at the upper edge of the volume are clipped to the volume's bounds.)
+
+    A single BlockCache may be shared by several VoxelsAccessors (even for different volumes).
+
+    Example:
+
+        .. code-block:: python
+
+            cache = BlockCache( max_bytes=500*1024**2 )
+            v = VoxelsAccessor( connection, uuid, 'grayscale', block_cache=cache )
+            a = v[:, 0:100, 0:100, 10]
+            b = v[:, 0:100, 0:100, 11] # Served from the cache (no http request)
+    """
+
+    def __init__(self, max_bytes, backing_cache=None):
+        """
+        :param max_bytes: The total size of all cached blocks will not exceed this budget.
+        :param backing_cache: Optional.  A slower cache (e.g. a ``DiskBlockCache``) to consult 
+                              for blocks that aren't in memory.  Blocks stored in this cache 
+                              are stored in the backing cache, too.
+        """
+        self.max_bytes = max_bytes
+        self.backing_cache = backing_cache
+        self._blocks = collections.OrderedDict() # Least recently used first
+        self._current_bytes = 0
+        self._lock = threading.Lock()
+
+    @property
+    def requires_locked_node(self):
+        """
+        Property.  True if this cache may only be used for locked (immutable) DVID nodes.
+        """
+        return self.backing_cache is not None and self.backing_cache.requires_locked_node
+
+    @property
+    def current_bytes(self):
+        """
+        Property.  The total size of all blocks currently in the cache.
+        """
+        return self._current_bytes
+
+    def __len__(self):
+        return len(self._blocks)
+
+    def get(self, key):
+        """
+        Return the cached block for the given key (and mark it as recently used),
+        or None if it isn't in the cache.
+        """
+        with self._lock:
+            try:
+                block = self._blocks.pop(key)
+            except KeyError:
+                block = None
+            else:
+                self._blocks[key] = block
+                return block
+
+        if self.backing_cache is not None:
+            block = self.backing_cache.get(key)
+            if block is not None:
+                self._put_in_memory(key, block)
+        return block
+
+    def put(self, key, block):
+        """
+        Store a block in the cache, evicting the least recently used blocks as necessary.
+        Blocks that are larger than the entire budget are not stored.
+        The block is stored as-is (not copied) and marked read-only.
+        """
+        if self.backing_cache is not None:
+            self.backing_cache.put(key, block)
+        self._put_in_memory(key, block)
+
+    def _put_in_memory(self, key, block):
+        if block.nbytes > self.max_bytes:
+            return
+        block.flags.writeable = False
+        with self._lock:
+            old_block = self._blocks.pop(key, None)
+            if old_block is not None:
+                self._current_bytes -= old_block.nbytes
+            self._blocks[key] = block
+            self._current_bytes += block.nbytes
+            while self._current_bytes > self.max_bytes:
+                _, evicted_block = self._blocks.popitem(last=False)
+                self._current_bytes -= evicted_block.nbytes
+
+    def invalidate(self, uuid, data_name, block_coords=None):
+        """
+        Remove the given blocks of a volume from the cache.
+        If block_coords is None, remove all blocks of the volume.
+        """
+        with self._lock:
+            if block_coords is None:
+                keys = [ k for k in self._blocks.keys() if k[:2] == (uuid, data_name) ]
+            else:
+                keys = [ (uuid, data_name, tuple(coord)) for coord in block_coords ]
+            for key in keys:
+                block = self._blocks.pop(key, None)
+                if block is not None:
+                    self._current_bytes -= block.nbytes
+        if self.backing_cache is not None:
+            self.backing_cache.invalidate(uuid, data_name, block_coords)
+
+    def clear(self):
+        """
+        Remove all blocks from the cache (including the backing cache, if any).
+        """
+        with self._lock:
+            self._blocks.clear()
+            self._current_bytes = 0
+        if self.backing_cache is not None:
+            self.backing_cache.clear()
+
+class DiskBlockCache(object):
+    """
+    A persistent, on-disk cache of voxel blocks, with the same interface as ``BlockCache``.
+
+    Each block is stored as a ``.npy`` file in ``<directory>/<uuid>/<data_name>/``,
+    and cached blocks are returned as read-only memory-mapped arrays.
+    Files are written atomically (via rename), so several processes may share the same directory.
+    When the total size of the cached files exceeds max_bytes, 
+    the least recently used files (by modification time) are deleted,
+    until the total size is below a "low-water mark" (a fraction of max_bytes).
+    (Evicting more than necessary means the directory isn't re-scanned on every insert.)
+
+    Since blocks are never re-validated against the server, this cache should only 
+    be used for locked (committed) DVID nodes, whose data can never change.
+    By default, VoxelsAccessor refuses to use this cache for a node that isn't locked.
+
+    Example:
+
+        .. code-block:: python
+
+            # Keep the most recently used blocks in memory, and all others on disk.
+            cache = BlockCache( 500*1024**2, backing_cache=DiskBlockCache( '/scratch/dvid-cache', 50*1024**3 ) )
+            v = VoxelsAccessor( connection, locked_uuid, 'grayscale', block_cache=cache )
+    """
+
+    # How many blocks may be written before the cache directory is re-scanned 
+    # (to account for files written or deleted by other processes).
+    RESCAN_INTERVAL = 1000
+
+    # When the cache is full, evict blocks until the total size is below this fraction of max_bytes.
+    LOW_WATER_FRACTION = 0.9
+
+    def __init__(self, directory, max_bytes, requires_locked_node=True):
+        """
+        :param directory: The cache directory.  Created if necessary.
+        :param max_bytes: The (approximate) maximum total size of all cached block files.
+        :param requires_locked_node: If False, allow this cache to be used for unlocked nodes, too.
+                                     (Only safe if no other client will modify the data.)
+        """
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self.requires_locked_node = requires_locked_node
+        self._lock = threading.Lock()
+        if not os.path.exists(directory):
+            os.makedirs(directory)
+        self._current_bytes = self._scan()[1]
+        self._puts_since_scan = 0
+
+    @property
+    def current_bytes(self):
+        """
+        Property.  The (approximate) total size of all cached block files.
+        """
+        return self._current_bytes
+
+    def __len__(self):
+        return len( self._scan()[0] )
+
+    def get(self, key):
+        """
+        Return the cached block for the given key as a read-only memory-mapped array,
+        or None if it isn't in the cache.
+        """
+        path = self._block_path(key)
+        try:
+            block = numpy.load( path, mmap_mode='r' )
+            # Mark as recently used.
+            os.utime( path, None )
+        except (IOError, OSError):
+            # Not cached (or deleted by another process in the meantime).
+            return None
+        return block
+
+    def put(self, key, block):
+        """
+        Store a block in the cache, evicting the least recently used blocks as necessary.
+        """
+        path = self._block_path(key)
+        block_dir = os.path.dirname(path)
+        if not os.path.exists(block_dir):
+            try:
+                os.makedirs(block_dir)
+            except OSError as ex:
+                # Another process may have created it in the meantime
+                if ex.errno != errno.EEXIST:
+                    raise
+
+        # If the block is already cached, its file is replaced.
+        try:
+            old_size = os.path.getsize(path)
+        except OSError:
+            old_size = 0
+
+        # Write to a temporary file first, so other processes never see a partial block.
+        fd, tmp_path = tempfile.mkstemp( dir=block_dir, suffix='.tmp' )
+        try:
+            with os.fdopen(fd, 'wb') as f:
+                numpy.save( f, block )
+            os.rename( tmp_path, path )
+        except:
+            os.remove( tmp_path )
+            raise
+
+        with self._lock:
+            self._current_bytes += os.path.getsize(path) - old_size
+            self._puts_since_scan += 1
+            if self._puts_since_scan >= self.RESCAN_INTERVAL or self._current_bytes > self.max_bytes:
+                self._evict()
+
+    def invalidate(self, uuid, data_name, block_coords=None):
+        """
+        Remove the given blocks of a volume from the cache.
+        If block_coords is None, remove all blocks of the volume.
+        """
+        removed_bytes = 0
+        if block_coords is None:
+            volume_dir = os.path.join( self.directory, uuid, data_name )
+            removed_bytes = self._scan( volume_dir )[1]
+            shutil.rmtree( volume_dir, ignore_errors=True )
+        else:
+            for block_coord in block_coords:
+                path = self._block_path( (uuid, data_name, tuple(block_coord)) )
+                try:
+                    size = os.path.getsize(path)
+                except OSError:
+                    continue
+                if self._remove( path ):
+                    removed_bytes += size
+        with self._lock:
+            self._current_bytes = max( 0, self._current_bytes - removed_bytes )
+
+    def clear(self):
+        """
+        Remove all blocks from the cache.
+        """
+        for name in os.listdir(self.directory):
+            shutil.rmtree( os.path.join(self.directory, name), ignore_errors=True )
+        with self._lock:
+            self._current_bytes = 0
+
+    def _block_path(self, key):
+        uuid, data_name, block_coord = key
+        filename = "_".join( map(str, block_coord) ) + ".npy"
+        return os.path.join( self.directory, uuid, data_name, filename )
+
+    def _scan(self, directory=None):
+        """
+        Return a list of (mtime, size, path) for all cached block files, and their total size.
+        (Only the files in the given subdirectory, if any.)
+        """
+        entries = []
+        for dirpath, _, filenames in os.walk(directory or self.directory):
+            for filename in filenames:
+                if not filename.endswith('.npy'):
+                    continue
+                path = os.path.join(dirpath, filename)
+                try:
+                    stat = os.stat(path)
+                except OSError:
+                    continue
+                entries.append( (stat.st_mtime, stat.st_size, path) )
+        return entries, sum( entry[1] for entry in entries )
+
+    def _evict(self):
+        # Caller must hold the lock.
+        entries, total_bytes = self._scan()
+        if total_bytes > self.max_bytes:
+            low_water_bytes = self.LOW_WATER_FRACTION * self.max_bytes
+            for _, size, path in sorted(entries):
+                if total_bytes <= low_water_bytes:
+                    break
+                if self._remove(path):
+                    total_bytes -= size
+        self._current_bytes = total_bytes
+        self._puts_since_scan = 0
+
+    def _remove(self, path):
+        try:
+            os.remove(path)
+            return True
+        except OSError:
+            # Already deleted (perhaps by another process).
+            return False
@@ -0,0 +1,140 @@
+import copy
+import json
+import time
+import hashlib
+import httplib
+import threading
+import contextlib
+
+from pydvid.errors import DvidHttpError
+from voxels_metadata import VoxelsMetadata
+
+class MetadataCache(object):
+    """
+    A cache of ``VoxelsMetadata``, keyed by ``(hostname, uuid, data_name)``.
+
+    Cached metadata is returned without contacting the server until it is older than ttl seconds.
+    After that, it is re-validated: if the server provided an ``ETag`` or ``Last-Modified`` header
+    with the metadata, a conditional request is sent, and the cached metadata is kept
+    (and its age reset) if the server responds "304 Not Modified".
+    Otherwise, the metadata is requested again.
+
+    A single cache may be shared by all accessors in a process.  (See ``DEFAULT_METADATA_CACHE``.)
+
+    Example:
+
+        .. code-block:: python
+
+            cache = MetadataCache( ttl=300.0 )
+            v1 = VoxelsAccessor( connection, uuid, 'grayscale', metadata_cache=cache )
+            v2 = VoxelsAccessor( connection, uuid, 'grayscale', metadata_cache=cache ) # No request sent
+    """
+
+    def __init__(self, ttl=60.0, revalidate=True, trusted=False):
+        """
+        :param ttl: How long (in seconds) cached metadata is used without re-validating it.
+        :param revalidate: If True, expired metadata is re-validated with a conditional request
+                           (if possible).  Otherwise, it is always requested again.
+        :param trusted: If True, skip the schema validation of metadata payloads
+                        that are identical to the payload of an entry in this cache.
+        """
+        self.ttl = ttl
+        self.revalidate = revalidate
+        self.trusted = trusted
+        self._entries = {} # key -> _MetadataCacheEntry
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._entries)
+
+    def get_metadata(self, connection, uuid, data_name):
+        """
+        Return the metadata for the given volume, from the cache if possible.
+        Each call returns a new copy, which the caller may modify.
+        """
+        key = ( _connection_hostname(connection), uuid, data_name )
+        with self._lock:
+            entry = self._entries.get(key)
+        if entry is not None and time.time() - entry.timestamp < self.ttl:
+            return entry.copy_metadata()
+
+        rest_query = "/api/node/{uuid}/{data_name}/metadata".format( uuid=uuid, data_name=data_name )
+        headers = {}
+        if entry is not None and self.revalidate:
+            if entry.etag is not None:
+                headers["If-None-Match"] = entry.etag
+            if entry.last_modified is not None:
+                headers["If-Modified-Since"] = entry.last_modified
+
+        connection.request( "GET", rest_query, headers=headers )
+        with contextlib.closing( connection.getresponse() ) as response:
+            if response.status == httplib.NOT_MODIFIED and entry is not None:
+                response.read()
+                entry.timestamp = time.time()
+                return entry.copy_metadata()
+            if response.status != httplib.OK:
+                raise DvidHttpError(
+                    "metadata query", response.status, response.reason, response.read(),
+                    "GET", rest_query, "", headers )
+            json_text = response.read()
+            etag = response.getheader( "ETag" )
+            last_modified = response.getheader( "Last-Modified" )
+
+        # Only the digests of the cached payloads are kept (not the payloads themselves),
+        #  so the memory used doesn't grow beyond the number of entries.
+        payload_digest = hashlib.sha1( json_text ).digest()
+        validate = True
+        if self.trusted:
+            with self._lock:
+                validate = not any( e.payload_digest == payload_digest for e in self._entries.values() )
+        metadata = VoxelsMetadata( json.loads( json_text ), validate=validate )
+        entry = _MetadataCacheEntry( metadata, etag, last_modified, payload_digest )
+        with self._lock:
+            self._entries[key] = entry
+        return entry.copy_metadata()
+
+    def invalidate(self, hostname=None, uuid=None, data_name=None):
+        """
+        Remove the matching entries from the cache.
+        Any parameter that is None matches all entries, so ``invalidate()`` removes everything.
+
+        :param hostname: A hostname (e.g. 'localhost:8000'), or a connection to that host.
+        """
+        if hostname is not None and not isinstance( hostname, basestring ):
+            hostname = _connection_hostname( hostname )
+        pattern = ( hostname, uuid, data_name )
+        with self._lock:
+            for key in self._entries.keys():
+                if all( p is None or p == k for p, k in zip( pattern, key ) ):
+                    del self._entries[key]
+
+    def clear(self):
+        """
+        Remove all entries from the cache.
+        """
+        with self._lock:
+            self._entries.clear()
+
+class _MetadataCacheEntry(object):
+    def __init__(self, metadata, etag, last_modified, payload_digest):
+        self.metadata = metadata
+        self.etag = etag
+        self.last_modified = last_modified
+        self.payload_digest = payload_digest
+        self.timestamp = time.time()
+
+    def copy_metadata(self):
+        # The cached metadata has already been validated.
+        return VoxelsMetadata( copy.deepcopy( dict(self.metadata) ), validate=False )
+
+def _connection_hostname( connection ):
+    """
+    Return the 'host:port' string for the given connection (an HTTPConnection or DvidConnection).
+    """
+    hostname = getattr( connection, 'hostname', None )
+    if hostname is None:
+        hostname = "{}:{}".format( connection.host, connection.port )
+    return hostname
+
+# A cache that may be shared by all accessors in the process.
+DEFAULT_METADATA_CACHE = MetadataCache()
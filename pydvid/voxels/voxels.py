@@ -1,19 +1,38 @@
 import json
+import time
+import socket
 import httplib
+import itertools
 import contextlib
-import StringIO
 
 import numpy
 
 from pydvid.errors import DvidHttpError, UnexpectedResponseError
-from pydvid.util import get_json_generic
+from pydvid.util import get_json_generic, imap_unordered, PipelinedStream
+from pydvid.compression import get_response_stream
+from pydvid.dvid_connection import DvidConnection
 from pydvid.voxels.voxels_metadata import VoxelsMetadata
 from pydvid.voxels.voxels_nddata_codec import VoxelsNddataCodec
 
-def get_metadata( connection, uuid, data_name ):
+# DVID stores voxels in blocks of this width along every (non-channel) axis.
+# For now, this is the BlockSize we always request when creating a new volume.
+DEFAULT_BLOCK_SIZE = 32
+
+# By default, tiled requests use tiles that are this many blocks wide along every axis.
+DEFAULT_TILE_BLOCKS = 4
+
+# Chunked uploads wait this long (in seconds) before the first retry of a failed piece,
+#  and twice as long before each further retry.
+UPLOAD_RETRY_DELAY = 0.5
+
+def get_metadata( connection, uuid, data_name, cache=None ):
     """
     Query the voxels metedata for the given node/data_name.
+
+    :param cache: Optional.  A ``MetadataCache`` to get the metadata from (if possible).
     """
+    if cache is not None:
+        return cache.get_metadata( connection, uuid, data_name )
     rest_query = "/api/node/{uuid}/{data_name}/metadata".format( uuid=uuid, data_name=data_name )
     parsed_json = get_json_generic( connection, rest_query )
     return VoxelsMetadata( parsed_json )
@@ -32,7 +51,7 @@ def create_new( connection, uuid, data_name, voxels_metadata ):
 
     # For now, we simply hard-code these settings.
     n_dims = len(voxels_metadata.shape)-1
-    message_data = { "BlockSize" : ",".join( ("32",)*n_dims ),
+    message_data = { "BlockSize" : ",".join( (str(DEFAULT_BLOCK_SIZE),)*n_dims ),
                      "VoxelSize" : ",".join( ("1.0",)*n_dims ),
                      "VoxelUnits" : ",".join( ("nanometers",)*n_dims ) }
     message_json = json.dumps(message_data) 
@@ -51,36 +70,149 @@ def create_new( connection, uuid, data_name, voxels_metadata ):
         # We can just read it and ignore it.
         response_text = response.read()
 
-def get_ndarray( connection, uuid, data_name, voxels_metadata, start, stop ):
-    _validate_query_bounds( start, stop, voxels_metadata.shape )
+def get_ndarray( connection, uuid, data_name, voxels_metadata, start, stop, out=None, compression=None, pipelined=False ):
+    """
+    Request the subvolume specified by the given start and stop pixel coordinates.
+
+    The channel range (the first axis of start/stop) may select a subset of the channels.
+    DVID always sends all channels, but only the selected channels are decoded, 
+    so the result (and the memory it needs) is only as big as the selected channels.
+
+    :param out: Optional.  A pre-allocated array to decode the data into, instead of allocating a new one.
+                Must have the roi shape (stop - start) and the volume's dtype.
+                It may be any writable ndarray, e.g. a view into a larger array or a ``numpy.memmap``.
+                (For best performance, use an F-contiguous array.)
+    :param compression: Optional.  A content-encoding (e.g. 'gzip') to ask the server to compress the data with.
+                        (See ``pydvid.compression.supported_encodings()``.)
+                        The compressed data is decompressed as it arrives, straight into the result.
+                        If the server sends uncompressed data anyway, that's fine, too.
+    :param pipelined: If True, receive the data in a background thread (see ``pydvid.util.PipelinedStream``), 
+                      while this thread decompresses it and copies it into the result.
+                      This helps for fast networks, if the data is compressed or a copy is needed anyway 
+                      (e.g. for a non-contiguous out array or a subset of the channels).
+                      Otherwise, the extra copy costs more than the overlap gains.
+    :returns: The requested subvolume (i.e. out, if it was provided)
+    """
+    _validate_query_bounds( start, stop, voxels_metadata.shape, allow_channel_subset=True )
+    result = _prepare_result_array( voxels_metadata, start, stop, out )
+    _get_ndarray_into( connection, uuid, data_name, voxels_metadata, start, stop, result, compression, pipelined )
+    return result
+
+def get_ndarray_tiled( connection, uuid, data_name, voxels_metadata, start, stop, 
+                       tile_shape=None, num_threads=4, thread_pool=None, out=None, compression=None, pipelined=False ):
+    """
+    Request the same subvolume as ``get_ndarray()``, but split the request into tiles 
+    that are aligned to the DVID block grid and fetch the tiles concurrently.
+    Each tile is decoded directly into its place within a single preallocated result array.
+
+    :param connection: Must be a ``DvidConnection`` (which provides a separate 
+                       HTTPConnection for each thread), unless num_threads == 1.
+    :param tile_shape: The tile shape, excluding the channel axis.  
+                       Each tile dimension must be a multiple of DEFAULT_BLOCK_SIZE.
+                       By default, tiles are DEFAULT_TILE_BLOCKS blocks wide along every axis.
+    :param num_threads: How many tiles to request at once.
+    :param thread_pool: Optional.  A ``multiprocessing.pool.ThreadPool`` to fetch the tiles with, 
+                        in which case num_threads is ignored.  (Reusing the same pool for many 
+                        requests allows each thread to keep using its own connection.)
+    :param out: Optional.  A pre-allocated array to decode the data into.  See ``get_ndarray()``.
+    :param compression: Optional.  See ``get_ndarray()``.
+    :param pipelined: See ``get_ndarray()``.
+    """
+    _validate_query_bounds( start, stop, voxels_metadata.shape, allow_channel_subset=True )
+    tile_shape = _validate_tile_shape( tile_shape, len(start)-1 )
+    result = _prepare_result_array( voxels_metadata, start, stop, out )
+
+    def fetch_tile( tile ):
+        tile_start, tile_stop = tile
+        result_slicing = tuple( slice(a-s, b-s) for a,b,s in zip( tile_start, tile_stop, start ) )
+        _get_ndarray_into( connection, uuid, data_name, voxels_metadata, 
+                           tile_start, tile_stop, result[result_slicing], compression, pipelined )
+
+    tiles = _block_aligned_tiles( start, stop, tile_shape )
+    _run_in_thread_pool( connection, fetch_tile, tiles, num_threads, thread_pool )
+    return result
+
+def _prepare_result_array( voxels_metadata, start, stop, out=None ):
+    """
+    Allocate the result array for a request with the given start/stop, 
+    or (if provided) check that the given out array has the right shape and dtype.
+    """
+    # Roi shape includes channel axis (and only the requested channels)
+    roi_shape = tuple( numpy.array(stop) - start )
+    if out is None:
+        return numpy.ndarray( roi_shape, dtype=voxels_metadata.dtype, order='F' )
+
+    assert isinstance( out, numpy.ndarray ), \
+        "Expected out to be a numpy.ndarray, not {}".format( type(out) )
+    assert out.shape == roi_shape, \
+        "Wrong shape for out array: expected {}, got {}".format( roi_shape, out.shape )
+    assert out.dtype == voxels_metadata.dtype, \
+        "Wrong dtype for out array: expected {}, got {}".format( voxels_metadata.dtype, out.dtype )
+    return out
+
+def _get_ndarray_into( connection, uuid, data_name, voxels_metadata, start, stop, out, compression=None, pipelined=False ):
+    """
+    Request the given subvolume and decode it directly into the given array, 
+    which must already have the roi shape (including the requested channels).
+    """
     codec = VoxelsNddataCodec( voxels_metadata )
-    response = get_subvolume_response( connection, uuid, data_name, start, stop )
-    with contextlib.closing(response):
-        # "Full" roi shape includes channel axis and ALL channels
-        full_roi_shape = numpy.array(stop) - start
-        full_roi_shape[0] = voxels_metadata.shape[0]
-        decoded_data = codec.decode_to_ndarray( response, full_roi_shape )
+    response = get_subvolume_response( connection, uuid, data_name, start, stop, compression=compression )
+    body_stream = response
+    if pipelined:
+        body_stream = PipelinedStream( response )
+    with contextlib.closing(body_stream):
+        stream = get_response_stream( response, body_stream )
+        codec.decode_into_ndarray( stream, out, channel_start=start[0] )
     
         # Was the response fully consumed?  Check.
         # NOTE: This last read() is not optional.
         # Something in the http implementation gets upset if we read out the exact amount we needed.
         # That is, we MUST read beyond the end of the stream.  So, here we go. 
-        excess_data = response.read()
+        excess_data = stream.read()
         if excess_data:
             # Uh-oh, we expected it to be empty.
+            full_roi_shape = (voxels_metadata.shape[0],) + out.shape[1:]
             raise UnexpectedResponseError( "Received data was longer than expected by {} bytes.  (Expected only {} bytes.)"
-                                           "".format( len(excess_data), len(numpy.getbuffer(decoded_data)) ) ) 
-        # Select the requested channels from the returned data.
-        return decoded_data
+                                           "".format( len(excess_data), codec.calculate_buffer_len(full_roi_shape) ) ) 
+    return out
+
+def post_ndarray( connection, uuid, data_name, voxels_metadata, start, stop, new_data, compression=None ):
+    """
+    Overwrite the subvolume specified by the given start and stop pixel coordinates with new_data.
 
-def post_ndarray( connection, uuid, data_name, voxels_metadata, start, stop, new_data ):
+    :param compression: Optional.  A content-encoding (e.g. 'gzip') to compress the data with before sending it.
+                        (The server must support the encoding.)
+    """
     _validate_query_bounds( start, stop, voxels_metadata.shape, allow_overflow_extents=True )
+    new_data = _validate_post_data( voxels_metadata, start, stop, new_data )
     codec = VoxelsNddataCodec( voxels_metadata )
     rest_query = _format_subvolume_rest_uri( uuid, data_name, start, stop )
-    body_data_stream = StringIO.StringIO()
-    codec.encode_from_ndarray(body_data_stream, new_data)
     headers = { "Content-Type" : VoxelsNddataCodec.VOLUME_MIMETYPE }
-    connection.request( "POST", rest_query, body=body_data_stream.getvalue(), headers=headers )
+    if compression is None:
+        headers["Content-Length"] = str( codec.calculate_buffer_len( new_data.shape ) )
+    else:
+        # The Content-Length must be known in advance, so compress the whole body first.
+        compressed_chunks = codec.encode_compressed( new_data, compression )
+        headers["Content-Length"] = str( sum( map( len, compressed_chunks ) ) )
+        headers["Content-Encoding"] = compression
+
+    # Instead of encoding the whole body into a string first, 
+    #  send the headers and then stream the array data straight to the socket.
+    try:
+        connection.putrequest( "POST", rest_query )
+        for header, value in headers.items():
+            connection.putheader( header, value )
+        connection.endheaders()
+        if compression is None:
+            codec.encode_from_ndarray( connection, new_data )
+        else:
+            for chunk in compressed_chunks:
+                connection.send( chunk )
+    except:
+        # The request was only partially sent, so the connection can't be used any more.
+        _reset_connection( connection )
+        raise
+
     with contextlib.closing( connection.getresponse() ) as response:
         #if response.status != httplib.NO_CONTENT:
         if response.status != httplib.OK:
@@ -91,12 +223,85 @@ def post_ndarray( connection, uuid, data_name, voxels_metadata, start, stop, new
         # Something (either dvid or the httplib) gets upset if we don't read the full response.
         response.read()
 
-def get_subvolume_response( connection, uuid, data_name, start, stop, format="" ):
+def post_ndarray_chunked( connection, uuid, data_name, voxels_metadata, start, stop, new_data, 
+                          chunk_shape=None, num_threads=4, thread_pool=None, max_retries=3, compression=None ):
+    """
+    Same as ``post_ndarray()``, but split the data into pieces that are aligned to the DVID block grid, 
+    and upload the pieces concurrently.  If a piece fails due to a network error or a server error (5xx), 
+    only that piece is sent again (up to max_retries times).
+
+    Note: Unlike a single ``post_ndarray()``, the upload is not atomic: 
+          if it fails, some of the pieces may have been written already.
+
+    :param connection: Must be a ``DvidConnection`` (which provides a separate 
+                       HTTPConnection for each thread), unless num_threads == 1.
+    :param chunk_shape: The piece shape, excluding the channel axis.  See ``get_ndarray_tiled()``.
+    :param num_threads: How many pieces to upload at once.
+    :param thread_pool: Optional.  A ``multiprocessing.pool.ThreadPool`` to upload the pieces with, 
+                        in which case num_threads is ignored.
+    :param max_retries: How many times to retry each failed piece.
+    :param compression: Optional.  See ``post_ndarray()``.
+    """
+    _validate_query_bounds( start, stop, voxels_metadata.shape, allow_overflow_extents=True )
+    chunk_shape = _validate_tile_shape( chunk_shape, len(start)-1 )
+    new_data = _validate_post_data( voxels_metadata, start, stop, new_data )
+
+    def post_chunk( chunk ):
+        chunk_start, chunk_stop = chunk
+        data_slicing = tuple( slice(a-s, b-s) for a,b,s in zip( chunk_start, chunk_stop, start ) )
+        for attempt in range( max_retries+1 ):
+            try:
+                post_ndarray( connection, uuid, data_name, voxels_metadata, 
+                              chunk_start, chunk_stop, new_data[data_slicing], compression )
+                return
+            except (socket.error, httplib.HTTPException, DvidHttpError) as ex:
+                transient = not isinstance( ex, DvidHttpError ) or ex.status_code >= 500
+                if not transient or attempt == max_retries:
+                    raise
+            # The failed request may have left the connection in an unusable state.
+            _reset_connection( connection )
+            time.sleep( UPLOAD_RETRY_DELAY * 2**attempt )
+
+    chunks = _block_aligned_tiles( start, stop, chunk_shape )
+    _run_in_thread_pool( connection, post_chunk, chunks, num_threads, thread_pool )
+
+def _validate_post_data( voxels_metadata, start, stop, new_data ):
+    """
+    Check that new_data can be posted to the roi [start, stop), and return it with the roi shape.
+    (Data with singleton axes dropped is accepted, too.)
+    Called before anything is sent, so bad data doesn't leave a request half-sent.
+    """
+    assert isinstance( new_data, numpy.ndarray ), \
+        "Expected a numpy.ndarray, not {}".format( type(new_data) )
+    assert new_data.dtype == voxels_metadata.dtype, \
+        "Wrong dtype.  Expected {}, got {}".format( voxels_metadata.dtype, new_data.dtype )
+    roi_shape = tuple( int(n) for n in numpy.subtract( stop, start ) )
+    assert filter( lambda n: n != 1, new_data.shape ) == filter( lambda n: n != 1, roi_shape ), \
+        "Data shape {} doesn't match the roi [{}, {})".format( new_data.shape, start, stop )
+    return new_data.reshape( roi_shape, order='F' )
+
+def _reset_connection( connection ):
+    """
+    Close the connection (or, for a DvidConnection, just the current thread's connection),
+    after a failed request may have left it in an unusable state.  The next request re-opens it.
+    """
+    if isinstance( connection, DvidConnection ):
+        connection.reset()
+    else:
+        connection.close()
+
+def get_subvolume_response( connection, uuid, data_name, start, stop, format="", compression=None ):
     """
     Request a subvolume from the server and return the raw HTTPResponse stream it returns.
+
+    :param compression: Optional.  A content-encoding (e.g. 'gzip') the server may use to compress the response.
+                        Check the response's ``Content-Encoding`` header (or use ``pydvid.compression.get_response_stream()``).
     """
     rest_query = _format_subvolume_rest_uri( uuid, data_name, start, stop, format )
-    connection.request( "GET", rest_query )
+    headers = {}
+    if compression is not None:
+        headers["Accept-Encoding"] = compression
+    connection.request( "GET", rest_query, headers=headers )
     response = connection.getresponse()
     if response.status != httplib.OK:
         raise DvidHttpError( 
@@ -132,18 +337,97 @@ def _format_subvolume_rest_uri( uuid, data_name, start, stop, format="" ):
         rest_query += "/" + format
     return rest_query
 
-def _validate_query_bounds( start, stop, volume_shape, allow_overflow_extents=False ):
+def _validate_tile_shape( tile_shape, num_spatial_axes ):
+    """
+    Return the given tile_shape (or the default tile shape) as a tuple, 
+    after checking that it is aligned to the DVID block grid.
+    """
+    if tile_shape is None:
+        return (DEFAULT_TILE_BLOCKS*DEFAULT_BLOCK_SIZE,) * num_spatial_axes
+    tile_shape = tuple( map(int, tile_shape) )
+    assert len(tile_shape) == num_spatial_axes, \
+        "tile_shape must not include the channel axis: {}".format( tile_shape )
+    assert all( t > 0 and t % DEFAULT_BLOCK_SIZE == 0 for t in tile_shape ), \
+        "tile_shape must be a multiple of the block size ({}): {}".format( DEFAULT_BLOCK_SIZE, tile_shape )
+    return tile_shape
+
+def _block_aligned_tiles( start, stop, tile_shape, order='F' ):
+    """
+    Split the roi [start, stop) into tiles whose boundaries fall on a grid with 
+    the given tile_shape (in volume coordinates), clipped to the roi itself.
+    The channel axis (the first axis) is never split.
+
+    Returns a list of (tile_start, tile_stop) tuples, with the first spatial axis varying fastest
+    (or, if order is 'C', the last spatial axis varying fastest).
+    """
+    assert order in ('F', 'C'), "Invalid order: {}".format( order )
+    axis_spans = []
+    for a, b, t in zip( start[1:], stop[1:], tile_shape ):
+        a, b = int(a), int(b)
+        edges = [a] + range( (a//t + 1)*t, b, t ) + [b]
+        axis_spans.append( zip( edges[:-1], edges[1:] ) )
+
+    if order == 'C':
+        # itertools.product varies the LAST sequence fastest.
+        return [ ( (int(start[0]),) + tuple( span[0] for span in spans ),
+                   (int(stop[0]),) + tuple( span[1] for span in spans ) )
+                 for spans in itertools.product( *axis_spans ) ]
+
+    tiles = []
+    # itertools.product varies the LAST sequence fastest, so reverse the axes (twice).
+    for spans in itertools.product( *axis_spans[::-1] ):
+        spans = spans[::-1]
+        tile_start = (int(start[0]),) + tuple( span[0] for span in spans )
+        tile_stop = (int(stop[0]),) + tuple( span[1] for span in spans )
+        tiles.append( (tile_start, tile_stop) )
+    return tiles
+
+def _block_coords( start, stop, block_size=DEFAULT_BLOCK_SIZE ):
+    """
+    Return the coordinates (block indexes, excluding the channel axis) 
+    of all blocks that overlap the roi [start, stop), with the first axis varying fastest.
+    """
+    block_ranges = [ range( int(a)//block_size, (int(b)-1)//block_size + 1 )
+                     for a, b in zip( start[1:], stop[1:] ) ]
+    # itertools.product varies the LAST sequence fastest, so reverse the axes (twice).
+    return [ coord[::-1] for coord in itertools.product( *block_ranges[::-1] ) ]
+
+def _block_bounds( block_coord, volume_shape, block_size=DEFAULT_BLOCK_SIZE ):
+    """
+    Return the (start, stop) of the given block (including all channels),
+    clipped to the given volume shape.
+    """
+    block_start = (0,) + tuple( c*block_size for c in block_coord )
+    block_stop = (volume_shape[0],) + tuple( min( (c+1)*block_size, s ) 
+                                             for c, s in zip( block_coord, volume_shape[1:] ) )
+    return block_start, block_stop
+
+def _run_in_thread_pool( connection, func, items, num_threads, thread_pool=None ):
+    """
+    Call func(item) for every item, using several threads at once.
+    See ``pydvid.util.imap_unordered()``.
+    """
+    for _ in imap_unordered( connection, func, items, num_threads, thread_pool ):
+        pass
+
+def _validate_query_bounds( start, stop, volume_shape, allow_overflow_extents=False, allow_channel_subset=False ):
     """
     Assert if the given start, stop, and volume_shape are not a valid combination. 
     If allow_overflow_extents is True, then this function won't complain if the 
     start/stop fields exceed the current bounds of the dataset.
     (For writing, it's okay to exceed the bounds.  
     For reading, that would probably be an error.)
+    If allow_channel_subset is True, the start/stop may select a subset of the channels.
+    (Only permitted for reading.)
     """
     shape = volume_shape
     start, stop, shape = map( numpy.array, (start, stop, shape) )
-    assert start[0] == 0, "Subvolume get/post must include all channels."
-    assert stop[0] == shape[0], "Subvolume get/post must include all channels."
+    if not allow_channel_subset:
+        assert start[0] == 0, "Subvolume post must include all channels."
+        assert stop[0] == shape[0], "Subvolume post must include all channels."
+    else:
+        assert 0 <= start[0] < stop[0] <= shape[0], \
+            "Invalid channel range: [{}, {}) for a volume with {} channels".format( start[0], stop[0], shape[0] )
     assert len(start) == len(stop) == len(shape), \
         "start/stop/shape mismatch: {}/{}/{}".format( start, stop, shape )
     assert (start < stop).all(), "Invalid start/stop: {}/{}".format( start, stop )
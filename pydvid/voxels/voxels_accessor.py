@@ -1,4 +1,10 @@
+import itertools
+import collections
+from multiprocessing.pool import ThreadPool
+
 import numpy
+
+import pydvid.general
 import voxels
 
 class VoxelsAccessor(object):
@@ -6,22 +12,90 @@ class VoxelsAccessor(object):
     Http client for retrieving a voxels volume data from a DVID server.
     An instance of VoxelsAccessor is capable of retrieving data from only one remote data volume.
     To retrieve data from multiple remote volumes, instantiate multiple DvidClient objects.
-    
-    **TODO**:
-    
-    * Allow users to provide a pre-allocated array when requesting data
     """
-    def __init__(self, connection, uuid, data_name):
+    # The estimated cost of each extra request, expressed as the number of bytes 
+    # that could have been transferred in the same time (i.e. latency x bandwidth).
+    # Step-sliced reads are only split if that saves more than this many bytes per extra request.
+    STRIDED_REQUEST_COST_BYTES = 1024**2
+
+    def __init__(self, connection, uuid, data_name, num_threads=1, tile_shape=None, block_cache=None, compression=None, pipelined=False, 
+                 metadata_cache=None):
         """
         :param uuid: The node uuid
         :param data_name: The name of the volume
+        :param num_threads: If greater than 1, requests are split into block-aligned tiles, 
+                            which are fetched (or uploaded) concurrently using this many threads.
+                            (In that case, connection must be a ``DvidConnection``.)
+                            Call ``close()`` (or use the accessor as a context manager) to stop the threads.
+        :param tile_shape: The tile shape to use when num_threads > 1, excluding the channel axis.
+                           See ``voxels.get_ndarray_tiled()``.
+        :param block_cache: Optional.  A ``BlockCache`` (or ``DiskBlockCache``) to serve reads from.
+                            Only the blocks that aren't already cached are requested from DVID.
+                            Blocks overwritten via this accessor are removed from the cache.
+                            Persistent caches may only be used for locked nodes.
+        :param compression: Optional.  A content-encoding (e.g. 'gzip') to use for transferring voxel data
+                            in both directions.  See ``voxels.get_ndarray()`` and ``voxels.post_ndarray()``.
+        :param pipelined: If True, receive data in a background thread while decoding it.  See ``voxels.get_ndarray()``.
+        :param metadata_cache: Optional.  A ``MetadataCache`` to get this volume's metadata from, 
+                               e.g. ``voxels.DEFAULT_METADATA_CACHE`` (which is shared by the whole process).
         """
         self.uuid = uuid
         self.data_name = data_name
         self._connection = connection
+        self._num_threads = num_threads
+        self._tile_shape = tile_shape
+        self._thread_pool = None
+        self._block_cache = block_cache
+        self._compression = compression
+        self._pipelined = pipelined
+        self._metadata_cache = metadata_cache
 
         # Request this volume's metadata from DVID
-        self.voxels_metadata = voxels.get_metadata( self._connection, uuid, data_name )
+        self.voxels_metadata = voxels.get_metadata( self._connection, uuid, data_name, metadata_cache )
+
+        if block_cache is not None and block_cache.requires_locked_node:
+            assert self._is_node_locked(), \
+                "Can't use a persistent block cache for node {}, because it isn't locked.".format( uuid )
+
+    def _get_thread_pool(self):
+        if self._thread_pool is None:
+            self._thread_pool = ThreadPool( self._num_threads )
+        return self._thread_pool
+
+    def close(self):
+        """
+        Stop this accessor's worker threads (if any), and return their connections to the connection pool.
+        (The connection itself is not closed.  If the accessor is used again, new threads are started.)
+        """
+        if self._thread_pool is not None:
+            self._thread_pool.close()
+            self._thread_pool.join()
+            self._thread_pool = None
+            self._release_thread_connections()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def _release_thread_connections(self):
+        """
+        Return the connections held by worker threads that have exited to the connection pool,
+        so they can be used by other threads right away.
+        """
+        if isinstance( self._connection, voxels.DvidConnection ):
+            self._connection._release_dead_threads()
+
+    def _is_node_locked(self):
+        """
+        Return True if DVID reports that this accessor's node is locked (i.e. its data can't change).
+        """
+        datasets_info = pydvid.general.get_datasets_info( self._connection )
+        for dataset_info in datasets_info["Datasets"]:
+            if self.uuid in dataset_info["Nodes"]:
+                return dataset_info["Nodes"][self.uuid]["Locked"]
+        return False
 
     @property
     def shape(self):
@@ -58,22 +132,160 @@ class VoxelsAccessor(object):
         """
         return self.voxels_metadata.axiskeys
 
-    def get_ndarray( self, start, stop ):
+    def get_ndarray( self, start, stop, out=None ):
         """
         Request the subvolume specified by the given start and stop pixel coordinates.
+
+        :param out: Optional.  A pre-allocated array (with the roi shape, including the channel axis) 
+                    to store the data in.  See ``voxels.get_ndarray()``.
+        """
+        if self._block_cache is not None:
+            return self._get_ndarray_cached( start, stop, out )
+        return self._get_ndarray_uncached( start, stop, out )
+
+    def _get_ndarray_uncached( self, start, stop, out=None ):
+        if self._num_threads > 1:
+            return voxels.get_ndarray_tiled( self._connection, self.uuid, self.data_name, self.voxels_metadata, 
+                                             start, stop, self._tile_shape, thread_pool=self._get_thread_pool(), 
+                                             out=out, compression=self._compression, pipelined=self._pipelined )
+        return voxels.get_ndarray( self._connection, self.uuid, self.data_name, self.voxels_metadata, 
+                                   start, stop, out, self._compression, self._pipelined )
+
+    def _get_ndarray_cached( self, start, stop, out=None ):
+        """
+        Assemble the requested subvolume from the blocks in the block cache.
+        Only the missing blocks are fetched from DVID (one request for each run of
+        consecutive missing blocks along the first spatial axis) and added to the cache.
+        """
+        shape = self.voxels_metadata.shape
+        voxels._validate_query_bounds( start, stop, shape, allow_channel_subset=True )
+        result = voxels._prepare_result_array( self.voxels_metadata, start, stop, out )
+
+        def copy_into_result( block_coord, block ):
+            # Copy the relevant part of the block into the result.
+            block_start, block_stop = voxels._block_bounds( block_coord, shape )
+            overlap_start = numpy.maximum( block_start, start )
+            overlap_stop = numpy.minimum( block_stop, stop )
+            result_slicing = tuple( slice(a-s, b-s) for a,b,s in zip( overlap_start, overlap_stop, start ) )
+            block_slicing = tuple( slice(a-s, b-s) for a,b,s in zip( overlap_start, overlap_stop, block_start ) )
+            result[result_slicing] = block[block_slicing]
+
+        missing_runs = []
+        for block_coord in voxels._block_coords( start, stop ):
+            block_start, block_stop = voxels._block_bounds( block_coord, shape )
+            block = self._block_cache.get( (self.uuid, self.data_name, block_coord) )
+            # Blocks at the edge of the volume are stale if the volume has grown since they were cached.
+            if block is not None and block.shape == tuple( numpy.subtract( block_stop, block_start ) ):
+                copy_into_result( block_coord, block )
+            elif missing_runs and missing_runs[-1][-1][1:] == block_coord[1:] \
+                              and missing_runs[-1][-1][0] + 1 == block_coord[0]:
+                # Block coords are ordered with the first axis varying fastest.
+                missing_runs[-1].append( block_coord )
+            else:
+                missing_runs.append( [block_coord] )
+
+        def fetch_run( run ):
+            run_start = voxels._block_bounds( run[0], shape )[0]
+            run_stop = voxels._block_bounds( run[-1], shape )[1]
+            run_volume = voxels.get_ndarray( self._connection, self.uuid, self.data_name, self.voxels_metadata, 
+                                             run_start, run_stop, compression=self._compression, pipelined=self._pipelined )
+            for block_coord in run:
+                block_start, block_stop = voxels._block_bounds( block_coord, shape )
+                block_slicing = tuple( slice(a-r, b-r) for a,b,r in zip( block_start, block_stop, run_start ) )
+                block = run_volume[block_slicing].copy( order='F' )
+                self._block_cache.put( (self.uuid, self.data_name, block_coord), block )
+                copy_into_result( block_coord, block )
+
+        thread_pool = None
+        if self._num_threads > 1:
+            thread_pool = self._get_thread_pool()
+        voxels._run_in_thread_pool( self._connection, fetch_run, missing_runs, self._num_threads, thread_pool )
+        return result
+
+    def iter_blocks( self, roi=None, block_shape=None, order='F', prefetch=2 ):
+        """
+        Iterate over the given roi in block-aligned chunks, yielding ``(start, stop, ndarray)`` for each chunk.
+        While the caller processes one chunk, the next chunks are requested in the background.
+
+        Example:
+
+            .. code-block:: python
+
+                for start, stop, block in v.iter_blocks( block_shape=(256,256,256) ):
+                    process( block )
+
+        :param roi: Optional.  A ``(start, stop)`` pair (including the channel axis).  
+                    By default, the whole volume is iterated over.
+        :param block_shape: The chunk shape, excluding the channel axis.  
+                            Must be a multiple of the DVID block size (see ``voxels.get_ndarray_tiled()``).
+                            Chunk boundaries fall on a grid with this spacing (in volume coordinates), 
+                            so chunks at the edges of the roi may be smaller.
+        :param order: The scan order: 'F' (the first axis varies fastest) or 'C' (the last axis varies fastest).
+        :param prefetch: How many chunks (after the current one) to request in advance.
+                         At most this many chunks are held in memory (in addition to the chunk being processed).
+                         If prefetch > 0, this accessor's connection must be a ``DvidConnection``.
         """
-        return voxels.get_ndarray( self._connection, self.uuid, self.data_name, self.voxels_metadata, start, stop )
+        if roi is None:
+            roi = ( self.minindex, self.shape )
+        start, stop = map( tuple, roi )
+        voxels._validate_query_bounds( start, stop, self.shape, allow_channel_subset=True )
+        block_shape = voxels._validate_tile_shape( block_shape, len(start)-1 )
+        chunks = voxels._block_aligned_tiles( start, stop, block_shape, order )
+
+        def fetch_chunk( chunk ):
+            chunk_start, chunk_stop = chunk
+            return chunk_start, chunk_stop, self.get_ndarray( chunk_start, chunk_stop )
+
+        if prefetch == 0:
+            for chunk in chunks:
+                yield fetch_chunk( chunk )
+            return
+
+        assert isinstance( self._connection, voxels.DvidConnection ), \
+            "Prefetching requires a DvidConnection, which gives each thread its own HTTPConnection."
+
+        # Keep up to 'prefetch' requests in flight, and yield the results in order.
+        fetch_chunk = self._connection.releasing( fetch_chunk )
+        pool = ThreadPool( prefetch )
+        try:
+            pending = collections.deque()
+            chunks = iter(chunks)
+            for chunk in itertools.islice( chunks, prefetch ):
+                pending.append( pool.apply_async( fetch_chunk, (chunk,) ) )
+            while pending:
+                result = pending.popleft().get()
+                for chunk in itertools.islice( chunks, 1 ):
+                    pending.append( pool.apply_async( fetch_chunk, (chunk,) ) )
+                yield result
+        finally:
+            # If the caller stopped early, let the outstanding requests finish (so their connections remain usable).
+            pool.close()
+            pool.join()
+            self._release_thread_connections()
 
     def post_ndarray( self, start, stop, new_data ):
         """
         Overwrite subvolume specified by the given start and stop pixel coordinates with new_data.
+
+        If this accessor uses more than one thread, the data is uploaded concurrently in block-aligned 
+        pieces, each of which is retried individually if it fails.  See ``voxels.post_ndarray_chunked()``.
         """
-        voxels.post_ndarray( self._connection, self.uuid, self.data_name, self.voxels_metadata, start, stop, new_data )
+        if self._num_threads > 1:
+            voxels.post_ndarray_chunked( self._connection, self.uuid, self.data_name, self.voxels_metadata, 
+                                         start, stop, new_data, self._tile_shape, 
+                                         thread_pool=self._get_thread_pool(), compression=self._compression )
+        else:
+            voxels.post_ndarray( self._connection, self.uuid, self.data_name, self.voxels_metadata, 
+                                 start, stop, new_data, self._compression )
+        if self._block_cache is not None:
+            self._block_cache.invalidate( self.uuid, self.data_name, voxels._block_coords( start, stop ) )
         if ( numpy.array(stop) > self.shape ).any() or \
            ( numpy.array(start) < self.minindex ).any():
             # It looks like this post will UPDATE the volume's extents.
             # Therefore, RE-request this volume's metadata from DVID so we get the new volume shape
-            self.voxels_metadata = voxels.get_metadata( self._connection, self.uuid, self.data_name )        
+            if self._metadata_cache is not None:
+                self._metadata_cache.invalidate( self._connection, self.uuid, self.data_name )
+            self.voxels_metadata = voxels.get_metadata( self._connection, self.uuid, self.data_name, self._metadata_cache )        
 
     def __getitem__(self, slicing):
         """
@@ -98,9 +310,9 @@ class VoxelsAccessor(object):
                 a = v[...,10,:]
                 
                 # Note: DVID always returns all channels.
-                #       Here, you are permitted to slice into the channel axis,
-                #       but be aware that this implementation requests all 
-                #       channels and returns the ones you asked for.
+                #       Here, you are permitted to slice into the channel axis.
+                #       Only the channels you asked for are decoded and stored,
+                #       but all channels are still transferred.
                 blue = v[2]
                 
                 # Therefore, avoid this, since it results in 2 requests for the same data
@@ -111,15 +323,30 @@ class VoxelsAccessor(object):
                 rgb = v[:]
                 red, green, blue = rgb[0], rgb[1], rgb[2]
                 
-                # Similarly, you are permitted to use slices with steps, but be aware that 
-                # the entire bounding volume will be requested, and the sliced steps will be 
-                # extracted from the dense volume.
+                # Similarly, you are permitted to use slices with steps.
+                # Along the axes with the largest steps, only the selected planes are requested 
+                # (one request per plane, issued concurrently if the accessor uses several threads),
+                # if the data saved outweighs the cost of the extra requests.
+                # Along any other stepped axes, the dense volume is requested and the 
+                # sliced steps are extracted from it.
                 
-                # Extract the upper-left 10x10 tile of every other z-slice:
-                a = v[:,:10,:10,::2]
+                # Extract every 10th z-slice of the first 1000:
+                a = v[:,:,:,0:1000:10]
     
-                # The above is equivalent to this:
-                a = v[:,:10,:10,:][...,::2]            
+                # The above is equivalent to this (but for large volumes, transfers 10x less data):
+                a = v[:,:,:,0:1000][...,::10]
+        """
+        return self.get_sliced(slicing)
+
+    def get_sliced(self, slicing, out=None):
+        """
+        Same as ``__getitem__``, but optionally store the result in the given pre-allocated array.
+
+        :param slicing: Anything that can be passed to ``__getitem__``, e.g. ``numpy.s_[:, 10:20, ...]``
+        :param out: Optional.  An array with the shape and dtype of the sliced result.
+                    If the slicing has no steps, the data is decoded directly into this array.
+                    Otherwise, the data is retrieved as usual and then copied into it.
+        :returns: The sliced data (i.e. out, if it was provided)
         """
         shape = self.voxels_metadata.shape
         expanded_slicing = VoxelsAccessor._expand_slicing(slicing, shape)
@@ -129,8 +356,95 @@ class VoxelsAccessor(object):
         start = map( lambda s: s.start, request_slicing )
         stop = map( lambda s: s.stop, request_slicing )
 
-        retrieved_volume = self.get_ndarray(start, stop)
-        return retrieved_volume[result_slicing]
+        request_shape = numpy.subtract(stop, start)
+        split_axes = []
+        if self._block_cache is None:
+            split_axes = self._choose_strided_axes(result_slicing, request_shape, shape[0])
+
+        if out is None and not split_axes:
+            retrieved_volume = self.get_ndarray(start, stop)
+            return retrieved_volume[result_slicing]
+
+        result_shape = VoxelsAccessor._sliced_shape(request_shape, result_slicing)
+        if out is None:
+            out = numpy.ndarray( result_shape, dtype=self.voxels_metadata.dtype, order='F' )
+        assert out.shape == result_shape, \
+            "Wrong shape for out array: slicing {} has shape {}, but out has shape {}"\
+            "".format( slicing, result_shape, out.shape )
+
+        if split_axes:
+            self._get_strided(start, stop, result_slicing, split_axes, out)
+        elif VoxelsAccessor._is_dense_slicing(result_slicing, request_shape):
+            # Re-insert the dropped singleton axes as a view, and decode directly into it.
+            out_view = out[ tuple( slice(None) if isinstance(s, slice) else numpy.newaxis
+                                   for s in result_slicing ) ]
+            self.get_ndarray(start, stop, out=out_view)
+        else:
+            out[...] = self.get_ndarray(start, stop)[result_slicing]
+        return out
+
+    def _choose_strided_axes(self, result_slicing, request_shape, num_channels):
+        """
+        Choose the stepped (non-channel) axes along which only the selected planes should be requested.
+        Axes with larger steps are considered first.  Each axis is chosen if the bytes saved 
+        by splitting outweigh the cost of the extra requests (see STRIDED_REQUEST_COST_BYTES).
+        (Requesting slabs instead of single planes wouldn't save anything, 
+        since each slab would include the planes in between.)
+        """
+        stepped_axes = []
+        for axis, (s, n) in enumerate( zip(result_slicing, request_shape) ):
+            if axis > 0 and isinstance(s, slice) and s.step is not None and s.step > 1:
+                stepped_axes.append( axis )
+        stepped_axes.sort( key=lambda axis: result_slicing[axis].step, reverse=True )
+
+        # DVID always sends all channels.
+        transfer_bytes = numpy.prod( request_shape[1:] ) * num_channels * self.voxels_metadata.dtype.itemsize
+        split_axes = []
+        num_requests = 1
+        for axis in stepped_axes:
+            num_planes = len( range( *result_slicing[axis].indices( request_shape[axis] ) ) )
+            split_transfer_bytes = transfer_bytes * num_planes // request_shape[axis]
+            extra_requests = num_requests * (num_planes - 1)
+            if transfer_bytes - split_transfer_bytes <= extra_requests * self.STRIDED_REQUEST_COST_BYTES:
+                continue
+            num_requests *= num_planes
+            transfer_bytes = split_transfer_bytes
+            split_axes.append( axis )
+        return split_axes
+
+    def _get_strided(self, start, stop, result_slicing, split_axes, out):
+        """
+        Fill out with the result of a step-sliced read, requesting only the 
+        selected planes along each of the given split_axes.
+        """
+        # Each (non-dropped) axis of the request corresponds to an axis of the result.
+        result_axes = {}
+        for axis, s in enumerate(result_slicing):
+            if isinstance(s, slice):
+                result_axes[axis] = len(result_axes)
+
+        selected_planes = [ range( *result_slicing[axis].indices( stop[axis] - start[axis] ) ) 
+                            for axis in split_axes ]
+
+        def fetch_plane( plane_indexes ):
+            plane_start, plane_stop = list(start), list(stop)
+            plane_result_slicing = list(result_slicing)
+            out_slicing = [slice(None)] * out.ndim
+            for axis, planes, k in zip( split_axes, selected_planes, plane_indexes ):
+                plane_start[axis] = start[axis] + planes[k]
+                plane_stop[axis] = plane_start[axis] + 1
+                plane_result_slicing[axis] = slice(0, 1)
+                out_slicing[result_axes[axis]] = slice(k, k+1)
+            plane = voxels.get_ndarray( self._connection, self.uuid, self.data_name, 
+                                        self.voxels_metadata, plane_start, plane_stop, 
+                                        compression=self._compression, pipelined=self._pipelined )
+            out[tuple(out_slicing)] = plane[tuple(plane_result_slicing)]
+
+        plane_indexes = list( itertools.product( *[ range(len(planes)) for planes in selected_planes ] ) )
+        thread_pool = None
+        if self._num_threads > 1:
+            thread_pool = self._get_thread_pool()
+        voxels._run_in_thread_pool( self._connection, fetch_plane, plane_indexes, self._num_threads, thread_pool )
 
     def __setitem__(self, slicing, array_data):
         """
@@ -208,12 +522,53 @@ class VoxelsAccessor(object):
                 request_slicing.append( slice(s, s+1) )
                 result_slicing.append(0)
 
-        # First dimension is channel, which we must request in full.
-        request_slicing[0] = slice(0, shape[0])
-        result_slicing[0] = full_slicing[0]
+        # First dimension is channel, which (unlike the other axes) may be indexed from the end.
+        # Request only the selected range of channels if it's contiguous and non-empty.
+        # Otherwise, request all channels and extract the selected ones from the result.
+        channel_slicing = full_slicing[0]
+        if isinstance(channel_slicing, slice):
+            start, stop, step = channel_slicing.indices( shape[0] )
+            if step == 1 and start < stop:
+                request_slicing[0] = slice(start, stop)
+                result_slicing[0] = slice(0, stop-start)
+            else:
+                request_slicing[0] = slice(0, shape[0])
+                result_slicing[0] = channel_slicing
+        else:
+            channel = channel_slicing
+            if channel < 0:
+                channel += shape[0]
+            request_slicing[0] = slice(channel, channel+1)
 
         return tuple(request_slicing), tuple(result_slicing)
         
+    @classmethod
+    def _sliced_shape(cls, shape, slicing):
+        """
+        Return the shape of the result of applying the given 
+        slicing (a full tuple of ints and slices) to an array of the given shape.
+        """
+        result_shape = []
+        for s, n in zip(slicing, shape):
+            if isinstance(s, slice):
+                result_shape.append( len( range( *s.indices(n) ) ) )
+        return tuple(result_shape)
+
+    @classmethod
+    def _is_dense_slicing(cls, slicing, shape):
+        """
+        Return True if the given slicing (a full tuple of ints and slices) selects 
+        every element of an array with the given shape, 
+        i.e. it only drops singleton axes and doesn't use steps.
+        """
+        for s, n in zip(slicing, shape):
+            if isinstance(s, slice):
+                if s.indices(n) != (0, n, 1):
+                    return False
+            elif n != 1 or s not in (0, -1):
+                return False
+        return True
+
     @classmethod
     def _explicit_slicing(cls, slicing, shape):
         """
@@ -1,22 +1,21 @@
+import sys
 import json
+import types
 
 import numpy
-import jsonschema
-
-try:
-    import vigra
-    _have_vigra = True
-except ImportError:
-    _have_vigra = False
-    
-try:
-    import h5py
-    _have_h5py = True
-except:
-    _have_h5py = False
 
 import pydvid.util
-metadata_schema = pydvid.util.parse_schema( 'dvid-voxels-metadata-v0.01.schema.json' )
+
+# Note: The optional dependencies (vigra, h5py) are NOT imported here, 
+#  since they are slow to import and most clients don't need them.
+#  The methods that use them import them on first use.
+
+METADATA_SCHEMA_NAME = 'dvid-voxels-metadata-v0.01.schema.json'
+
+# Note: For backwards compatibility, this module also provides a ``metadata_schema`` attribute:
+#  the parsed metadata schema (shared with pydvid.util.get_schema(), so it must not be modified).
+#  It is parsed on first access, not on import (see _LazySchemaModule, below).
+#  (Validation uses pydvid.util.validate_json().)
 
 class VoxelsMetadata(dict):
     """
@@ -60,20 +59,23 @@ class VoxelsMetadata(dict):
         return self._axiskeys
     
 
-    def __init__(self, metadata):
+    def __init__(self, metadata, validate=True):
         """
         Constructor.
         
         :param metadata: Either a string containing the json text for the DVID metadata, 
                          or a corresponding dict of metadata (e.g. parsed from the json).
                          If a string is passed, invalid json will result in a ValueError exception.
+        :param validate: If False, skip the schema validation.  
+                         (Only for metadata that is known to be valid, e.g. a copy of a validated VoxelsMetadata.)
         """
         assert isinstance( metadata, (dict, str) ), "Expected metadata to be a dict or json str."
         if isinstance( metadata, str ):
             metadata = json.loads( metadata )
 
         # Check schema...
-        jsonschema.validate( metadata, metadata_schema )
+        if validate:
+            pydvid.util.validate_json( metadata, METADATA_SCHEMA_NAME )
 
         # Init base class: just copy original metadata
         super( VoxelsMetadata, self ).__init__( **metadata )
@@ -187,67 +189,100 @@ class VoxelsMetadata(dict):
             msg = "Don't support DVID typename '{}'".format( typename )
             raise Exception(msg)
     
-    if _have_vigra:
-        def create_axistags(self):
-            """
-            Generate a vigra.AxisTags object corresponding to this VoxelsMetadata.
-            (Requires vigra.)
-            """
-            tags = vigra.AxisTags()
-            tags.insert( 0, vigra.AxisInfo('c', typeFlags=vigra.AxisType.Channels) )
-            dtypes = []
-            channel_labels = []
-            for channel_fields in self["Values"]:
-                dtypes.append( numpy.dtype( channel_fields["DataType"] ).type )
-                channel_labels.append( channel_fields["Label"] )
-
-            # We monkey-patch the channel labels onto the axistags object as a new member
-            tags.channelLabels = channel_labels
-            for axisfields in self['Axes']:
-                key = str(axisfields["Label"]).lower()
-                res = axisfields["Resolution"]
-                tag = vigra.defaultAxistags(key)[0]
-                tag.resolution = res
-                tags.insert( len(tags), tag )
-                # TODO: Check resolution units, because apparently 
-                #        they can be different from one axis to the next...
-    
-            assert all( map( lambda dtype: dtype == dtypes[0], dtypes ) ), \
-                "Can't support heterogeneous channel types: {}".format( dtypes )
+    def create_axistags(self):
+        """
+        Generate a vigra.AxisTags object corresponding to this VoxelsMetadata.
+        (Requires vigra.)
+        """
+        import vigra
+        tags = vigra.AxisTags()
+        tags.insert( 0, vigra.AxisInfo('c', typeFlags=vigra.AxisType.Channels) )
+        dtypes = []
+        channel_labels = []
+        for channel_fields in self["Values"]:
+            dtypes.append( numpy.dtype( channel_fields["DataType"] ).type )
+            channel_labels.append( channel_fields["Label"] )
 
-            return tags
-        
-        @classmethod
-        def create_volumeinfo_from_axistags(cls, shape, dtype, axistags):
-            assert False, "TODO..."
-            
-
-    if _have_h5py:    
-        @classmethod
-        def create_from_h5_dataset(cls, dataset):
-            """
-            Create a VolumeInfo object to describe the given h5 dataset object.
-
-            :param dataset: An hdf5 dataset object that meets the following criteria:\n
-                            * Indexed in F-order
-                            * Has an 'axistags' attribute, produced using vigra.AxisTags.toJSON()
-                            * Has an explicit channel axis
-                     
-            (Requires h5py.)
-            """
-            dtype = dataset.dtype.type
-            shape = dataset.shape
-            if 'dvid_metadata' in dataset.attrs:
-                metadata_json = dataset.attrs['dvid_metadata']
-                metadata = json.loads( metadata_json )
-                return VoxelsMetadata( metadata )
-            elif _have_vigra and 'axistags' in dataset.attrs:
-                axistags = vigra.AxisTags.fromJSON( dataset.attrs['axistags'] )
-                return cls.create_volumeinfo_from_axistags( shape, dtype, axistags )
-            else:
-                # Choose default axiskeys
-                default_keys = 'cxyzt'
-                axiskeys = default_keys[:len(shape)]
-                return VoxelsMetadata.create_default_metadata( shape, dtype, axiskeys, 1.0, "" )
-    
+        # We monkey-patch the channel labels onto the axistags object as a new member
+        tags.channelLabels = channel_labels
+        for axisfields in self['Axes']:
+            key = str(axisfields["Label"]).lower()
+            res = axisfields["Resolution"]
+            tag = vigra.defaultAxistags(key)[0]
+            tag.resolution = res
+            tags.insert( len(tags), tag )
+            # TODO: Check resolution units, because apparently 
+            #        they can be different from one axis to the next...
+
+        assert all( map( lambda dtype: dtype == dtypes[0], dtypes ) ), \
+            "Can't support heterogeneous channel types: {}".format( dtypes )
+
+        return tags
     
+    @classmethod
+    def create_volumeinfo_from_axistags(cls, shape, dtype, axistags):
+        assert False, "TODO..."
+        
+
+    @classmethod
+    def create_from_h5_dataset(cls, dataset):
+        """
+        Create a VolumeInfo object to describe the given h5 dataset object.
+
+        :param dataset: An hdf5 dataset object that meets the following criteria:\n
+                        * Indexed in F-order
+                        * Has an 'axistags' attribute, produced using vigra.AxisTags.toJSON()
+                        * Has an explicit channel axis
+                 
+        (Requires h5py.)
+        """
+        dtype = dataset.dtype.type
+        shape = dataset.shape
+        if 'dvid_metadata' in dataset.attrs:
+            metadata_json = dataset.attrs['dvid_metadata']
+            metadata = json.loads( metadata_json )
+            return VoxelsMetadata( metadata )
+        elif 'axistags' in dataset.attrs and _have_vigra():
+            import vigra
+            axistags = vigra.AxisTags.fromJSON( dataset.attrs['axistags'] )
+            return cls.create_volumeinfo_from_axistags( shape, dtype, axistags )
+        else:
+            # Choose default axiskeys
+            default_keys = 'cxyzt'
+            axiskeys = default_keys[:len(shape)]
+            return VoxelsMetadata.create_default_metadata( shape, dtype, axiskeys, 1.0, "" )
+
+# Whether vigra can be imported.  (Determined on first use, since importing vigra is slow.)
+_vigra_available = None
+
+def _have_vigra():
+    global _vigra_available
+    if _vigra_available is None:
+        try:
+            import vigra
+            _vigra_available = True
+        except ImportError:
+            _vigra_available = False
+    return _vigra_available
+
+class _LazySchemaModule(types.ModuleType):
+    """
+    Replaces this module's module object in ``sys.modules``,
+    and provides the ``metadata_schema`` attribute, which is parsed on first access.
+    """
+    def __getattr__(self, name):
+        if name != 'metadata_schema':
+            raise AttributeError( "'module' object has no attribute '{}'".format( name ) )
+        # get_schema() caches the parsed schema.
+        return pydvid.util.get_schema( METADATA_SCHEMA_NAME )
+
+    def __dir__(self):
+        return sorted( self.__dict__.keys() + ['metadata_schema'] )
+
+_module = _LazySchemaModule( __name__, __doc__ )
+_module.__dict__.update( sys.modules[__name__].__dict__ )
+
+# Keep a reference to the original module object,
+#  since Python clears a module's globals when it is deleted.
+_module._original_module = sys.modules[__name__]
+sys.modules[__name__] = _module
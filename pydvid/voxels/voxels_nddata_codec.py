@@ -1,5 +1,8 @@
 import numpy
 
+from pydvid import compression
+from pydvid.errors import UnexpectedResponseError
+from pydvid.util import get_readinto
 from voxels_metadata import VoxelsMetadata
 
 class VoxelsNddataCodec(object):
@@ -7,6 +10,19 @@ class VoxelsNddataCodec(object):
     # Data is sent to/retrieved from the http response stream in chunks.
     STREAM_CHUNK_SIZE = 1000 # (bytes)
 
+    # Data is written to streams in chunks of this size (without copying).
+    STREAM_WRITE_CHUNK_SIZE = 1024*1024 # (bytes)
+
+    # Streams that support readinto() are read directly into the destination array, 
+    #  starting with small reads and doubling the read size (up to the max) 
+    #  as long as the stream keeps up.
+    READINTO_MIN_CHUNK_SIZE = 64*1024 # (bytes)
+    READINTO_MAX_CHUNK_SIZE = 16*1024*1024 # (bytes)
+
+    # When decoding into a non-contiguous array, data is staged through 
+    #  a scratch buffer of (approximately) this size.
+    DECODE_SCRATCH_SIZE = 8*1024*1024 # (bytes)
+
     # Defined here for clients to use.
     VOLUME_MIMETYPE = "application/octet-stream"
     
@@ -29,25 +45,118 @@ class VoxelsNddataCodec(object):
         array = numpy.ndarray( full_roi_shape,
                                dtype=self._voxels_metadata.dtype,
                                order='F' )
+        self.decode_into_ndarray(stream, array)
+        return array
 
-        buf = numpy.getbuffer(array)
-        self._read_to_buffer(buf, stream)
+    def decode_into_ndarray(self, stream, out, channel_start=0):
+        """
+        Decode the info in the given stream directly into the given pre-allocated array.
+        The array shape (excluding the channel dimension) determines how much data is read.
 
-        return array
+        The stream always contains ALL channels of the volume (interleaved, since DVID uses F-order).
+        If the array has fewer channels than the volume, only the channels 
+        ``[channel_start, channel_start + out.shape[0])`` are kept, 
+        and the others are discarded as they are read.
+
+        The array need not be contiguous (e.g. it may be a view into a larger array).
+        In that case, the data is read one slab (along the last axis) at a time 
+        into a scratch buffer and copied into place, so no full-size temporary is needed.
+        """
+        assert isinstance( out, numpy.ndarray ), \
+            "Expected a numpy.ndarray, not {}".format( type(out) )
+        assert out.dtype == self._voxels_metadata.dtype, \
+            "Wrong dtype.  Expected {}, got {}".format( self._voxels_metadata.dtype, out.dtype )
+        num_channels = self._voxels_metadata.shape[0]
+        assert 0 <= channel_start and channel_start + out.shape[0] <= num_channels, \
+            "Invalid channels: [{}, {}) for a volume with {} channels"\
+            "".format( channel_start, channel_start + out.shape[0], num_channels )
+
+        if out.flags['F_CONTIGUOUS']:
+            self._read_to_array(stream, out, channel_start)
+            return out
+
+        # Note that dvid uses fortran order indexing, so each slab along 
+        #  the last axis is a contiguous section of the stream.
+        plane_bytes = self.calculate_buffer_len( out.shape[:-1] )
+        slab_planes = max( 1, VoxelsNddataCodec.DECODE_SCRATCH_SIZE // max(1, plane_bytes) )
+        slab_planes = min( slab_planes, out.shape[-1] )
+        scratch = numpy.ndarray( out.shape[:-1] + (slab_planes,),
+                                 dtype=out.dtype,
+                                 order='F' )
+
+        for slab_start in range( 0, out.shape[-1], slab_planes ):
+            slab_stop = min( slab_start + slab_planes, out.shape[-1] )
+            # Slicing the last axis of an F-order array keeps it contiguous.
+            slab = scratch[..., :slab_stop-slab_start]
+            self._read_to_array( stream, slab, channel_start )
+            out[..., slab_start:slab_stop] = slab
+        return out
+
+    def _read_to_array(self, stream, array, channel_start):
+        """
+        Fill the given F-contiguous array with data from the stream.
+        If the array has fewer channels than the stream, only the selected channels are stored:
+        all channels are read (one chunk of voxels at a time) into a scratch buffer, 
+        and then the selected channels are copied into the array.
+        """
+        num_channels = self._voxels_metadata.shape[0]
+        if array.shape[0] == num_channels:
+            self._read_to_buffer(self._byte_view(array), stream)
+            return
+
+        # View the array as a 2D (channel, voxel) array.
+        array_voxels = array.reshape( (array.shape[0], -1), order='F' )
+        num_voxels = array_voxels.shape[1]
+        voxel_bytes = self.calculate_buffer_len( (num_channels,) )
+        chunk_voxels = max( 1, VoxelsNddataCodec.DECODE_SCRATCH_SIZE // voxel_bytes )
+        scratch = numpy.ndarray( (num_channels, min(chunk_voxels, num_voxels)),
+                                 dtype=array.dtype,
+                                 order='F' )
+
+        channel_stop = channel_start + array.shape[0]
+        for chunk_start in range( 0, num_voxels, chunk_voxels ):
+            chunk_stop = min( chunk_start + chunk_voxels, num_voxels )
+            chunk = scratch[:, :chunk_stop-chunk_start]
+            self._read_to_buffer(self._byte_view(chunk), stream)
+            array_voxels[:, chunk_start:chunk_stop] = chunk[channel_start:channel_stop]
 
     def encode_from_ndarray(self, stream, array):
         """
         Encode the array to the given bytestream.
+        The stream may be a file-like object (with a ``write()`` method), 
+        or an HTTPConnection whose request headers have already been sent (with a ``send()`` method).
         
         Prerequisites:
         - array must be a numpy.ndarray
         - array must have the same dtype as this codec's metainfo
         """
+        buf = self._array_buffer(array)
+        write = getattr(stream, 'write', None) or stream.send
+        self._send_from_buffer(buf, write)
+
+    def encode_compressed(self, array, encoding):
+        """
+        Encode the array and compress it with the given content-encoding (e.g. 'gzip').
+        The array is compressed in chunks, so no uncompressed copy of the encoded data is made.
+
+        :returns: A list of strings, which together contain the compressed data.
+        """
+        buf = self._array_buffer(array)
+        compressor = compression.get_compressor(encoding)
+        chunks = []
+        self._send_from_buffer(buf, lambda data: chunks.append( compressor.compress(data) ))
+        chunks.append( compressor.flush() )
+        return filter( None, chunks )
+
+    def _array_buffer(self, array):
+        """
+        Return a buffer of the raw bytes of the array, in F-order.
+        """
         # Check for bad input.
         assert isinstance( array, numpy.ndarray ), \
             "Expected a numpy.ndarray, not {}".format( type(array) )
         assert array.dtype == self._voxels_metadata.dtype, \
-            "Wrong dtype.  Expected {}, got {}".format( self._metainfo.dtype, array.dtype )
+            "Wrong dtype.  Expected {}, got {}".format( self._voxels_metadata.dtype, array.dtype )
 
         # Unfortunately, if the array isn't F_CONTIGUOUS, we have to copy it.
         if not array.flags['F_CONTIGUOUS']:
@@ -55,17 +164,29 @@ class VoxelsNddataCodec(object):
             array_copy[:] = array[:]
             array = array_copy
 
-        buf = numpy.getbuffer(array)
-        self._send_from_buffer(buf, stream)
+        return numpy.getbuffer(array)
 
     def calculate_buffer_len(self, shape):
         return numpy.prod(shape) * self._voxels_metadata.dtype.type().nbytes
 
+    @classmethod
+    def _byte_view(cls, array):
+        """
+        Return a writable, flat memoryview of the raw bytes of the given F-contiguous array.
+        """
+        assert array.flags['F_CONTIGUOUS']
+        return memoryview( array.reshape( -1, order='F' ).view(numpy.uint8) )
+
     @classmethod
     def _read_to_buffer(cls, buf, stream):
         """
-        Read the data from the stream into the given buffer.
+        Read the data from the stream into the given buffer (a writable memoryview).
         """
+        readinto = get_readinto(stream)
+        if readinto is not None:
+            cls._readinto_buffer(buf, readinto)
+            return
+
         # We could read it in one step, but instead we'll read it in chunks to avoid big temporaries.
         # (See below.)
         # buf[:] = stream.read( len(buf) )
@@ -80,15 +201,31 @@ class VoxelsNddataCodec(object):
             remaining_bytes -= next_chunk_bytes
 
     @classmethod
-    def _send_from_buffer(cls, buf, stream):
+    def _readinto_buffer(cls, buf, readinto):
+        """
+        Fill the given buffer using the given readinto() function, without any intermediate copies.
+        """
+        chunk_size = VoxelsNddataCodec.READINTO_MIN_CHUNK_SIZE
+        bytes_read = 0
+        while bytes_read < len(buf):
+            next_chunk_bytes = min( len(buf) - bytes_read, chunk_size )
+            received = readinto( buf[bytes_read:bytes_read+next_chunk_bytes] )
+            if not received:
+                raise UnexpectedResponseError( "Stream ended after {} bytes.  (Expected {} bytes.)"
+                                               "".format( bytes_read, len(buf) ) )
+            bytes_read += received
+            if received == next_chunk_bytes:
+                chunk_size = min( 2*chunk_size, VoxelsNddataCodec.READINTO_MAX_CHUNK_SIZE )
+
+    @classmethod
+    def _send_from_buffer(cls, buf, write):
         """
-        Write the given buffer out to the provided stream in chunks.
+        Write the given buffer out in chunks, using the provided write function.
+        Each chunk is a read-only buffer object that refers to the original data (not a copy).
         """
         remaining_bytes = len(buf)
         while remaining_bytes > 0:
-            next_chunk_bytes = min( remaining_bytes, VoxelsNddataCodec.STREAM_CHUNK_SIZE )
+            next_chunk_bytes = min( remaining_bytes, VoxelsNddataCodec.STREAM_WRITE_CHUNK_SIZE )
             chunk_start = len(buf)-remaining_bytes
-            chunk_stop = len(buf)-(remaining_bytes-next_chunk_bytes)
-            stream.write( buf[chunk_start:chunk_stop] )
+            write( buffer( buf, chunk_start, next_chunk_bytes ) )
             remaining_bytes -= next_chunk_bytes
-    
\ No newline at end of file
@@ -14,5 +14,5 @@ setup(name='pydvid',
       url='https://github.com/janelia-flyem/pydvid',
       packages=packages,
       package_data=package_data,
-      setup_requires=['jsonschema>=1.0']
+      setup_requires=['jsonschema>=2.0']
      )
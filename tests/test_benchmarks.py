@@ -0,0 +1,46 @@
+import json
+
+from benchmarks.run_benchmarks import BenchmarkConfig, run_benchmarks
+
+class TestBenchmarks(object):
+    """
+    Runs a tiny version of the benchmark suite, to make sure it still works.
+    (The timings themselves are not checked.)
+    """
+
+    def test_run_benchmarks(self):
+        config = BenchmarkConfig( port=8000,
+                                  volume_edge=32,
+                                  cutout_edges=(16, 32),
+                                  dtypes=('uint8',),
+                                  thread_counts=(1, 2),
+                                  keyvalue_sizes=(100,),
+                                  repeats=2,
+                                  same_process=True )
+        results = run_benchmarks( config )
+
+        # Must be serializable
+        results = json.loads( json.dumps( results ) )
+        assert results["config"]["volume_edge"] == 32
+
+        names = set( r["name"] for r in results["results"] )
+        assert names == set( [ "get_metadata", "get_ndarray", "post_ndarray", "getitem_slice",
+                               "keyvalue_get", "keyvalue_put", "keyvalue_get_values", "keyvalue_put_values" ] )
+
+        for result in results["results"]:
+            latency = result["latency_seconds"]
+            assert result["repeats"] == 2
+            assert 0 <= latency["min"] <= latency["p50"] <= latency["p99"] <= latency["max"]
+            if result["bytes_per_op"]:
+                assert result["gbps"] > 0
+
+        get_results = [ r for r in results["results"] if r["name"] == "get_ndarray" ]
+        assert len(get_results) == 4 # 2 edges x 2 thread counts
+        assert set( r["bytes_per_op"] for r in get_results ) == set( [16**3, 32**3] )
+
+if __name__ == "__main__":
+    import sys
+    import nose
+    sys.argv.append("--nocapture")    # Don't steal stdout.  Show it on the console as usual.
+    sys.argv.append("--nologcapture") # Don't set the logging level to DEBUG.  Leave it alone.
+    nose.run(defaultTest=__file__)
@@ -0,0 +1,157 @@
+import os
+import time
+import shutil
+import tempfile
+
+import numpy
+
+from pydvid.voxels import BlockCache, DiskBlockCache
+
+class TestBlockCache(object):
+
+    def test_lru_eviction(self):
+        block_nbytes = numpy.zeros( (1,32,32), dtype=numpy.uint8 ).nbytes
+        cache = BlockCache( max_bytes=3*block_nbytes )
+        for i in range(3):
+            cache.put( ('abc', 'grayscale', (i,0)), numpy.zeros( (1,32,32), dtype=numpy.uint8 ) )
+        assert len(cache) == 3
+        assert cache.current_bytes == 3*block_nbytes
+
+        # Touch block 0, so block 1 becomes the least recently used.
+        assert cache.get( ('abc', 'grayscale', (0,0)) ) is not None
+        cache.put( ('abc', 'grayscale', (3,0)), numpy.zeros( (1,32,32), dtype=numpy.uint8 ) )
+        assert len(cache) == 3
+        assert cache.get( ('abc', 'grayscale', (1,0)) ) is None
+        assert cache.get( ('abc', 'grayscale', (0,0)) ) is not None
+        assert cache.current_bytes == 3*block_nbytes
+
+    def test_oversized_block(self):
+        cache = BlockCache( max_bytes=100 )
+        cache.put( ('abc', 'grayscale', (0,0)), numpy.zeros( (1,32,32), dtype=numpy.uint8 ) )
+        assert len(cache) == 0
+        assert cache.current_bytes == 0
+
+    def test_blocks_are_readonly(self):
+        cache = BlockCache( max_bytes=10000 )
+        block = numpy.zeros( (1,32,32), dtype=numpy.uint8 )
+        cache.put( ('abc', 'grayscale', (0,0)), block )
+        assert not cache.get( ('abc', 'grayscale', (0,0)) ).flags.writeable
+
+    def test_invalidate(self):
+        cache = BlockCache( max_bytes=100000 )
+        for i in range(3):
+            cache.put( ('abc', 'grayscale', (i,0)), numpy.zeros( (1,32,32), dtype=numpy.uint8 ) )
+            cache.put( ('abc', 'labels', (i,0)), numpy.zeros( (1,32,32), dtype=numpy.uint8 ) )
+
+        cache.invalidate( 'abc', 'grayscale', [(1,0), (5,5)] )
+        assert cache.get( ('abc', 'grayscale', (1,0)) ) is None
+        assert cache.get( ('abc', 'grayscale', (0,0)) ) is not None
+        assert len(cache) == 5
+
+        cache.invalidate( 'abc', 'labels' )
+        assert len(cache) == 2
+        assert cache.current_bytes == 2*32*32
+
+class TestDiskBlockCache(object):
+
+    def setUp(self):
+        self._tmp_dir = tempfile.mkdtemp()
+        self.cache_dir = os.path.join( self._tmp_dir, 'cache' )
+
+    def tearDown(self):
+        shutil.rmtree(self._tmp_dir)
+
+    def test_roundtrip(self):
+        cache = DiskBlockCache( self.cache_dir, max_bytes=10*1024**2 )
+        block = numpy.asfortranarray( numpy.random.randint( 0, 255, (2,32,32,32) ).astype(numpy.uint8) )
+        assert cache.get( ('abc', 'grayscale', (1,2,3)) ) is None
+        cache.put( ('abc', 'grayscale', (1,2,3)), block )
+
+        # A second instance (e.g. in another process) sees the same blocks.
+        cache2 = DiskBlockCache( self.cache_dir, max_bytes=10*1024**2 )
+        cached_block = cache2.get( ('abc', 'grayscale', (1,2,3)) )
+        assert isinstance( cached_block, numpy.memmap )
+        assert not cached_block.flags.writeable
+        assert cached_block.flags['F_CONTIGUOUS']
+        assert (cached_block == block).all()
+        assert len(cache2) == 1
+        assert cache2.current_bytes > block.nbytes
+
+    def test_eviction(self):
+        block = numpy.zeros( (1,32,32,32), dtype=numpy.uint8 )
+        cache = DiskBlockCache( self.cache_dir, max_bytes=10*1024**2 )
+        cache.put( ('abc', 'grayscale', (0,0,0)), block )
+        file_size = cache.current_bytes
+
+        # Room for 4 blocks.  When a 5th is added, blocks are evicted until 
+        # the size is below the low-water mark, i.e. only 3 blocks remain.
+        cache.max_bytes = 4*file_size + 100
+        for i in range(4):
+            cache.put( ('abc', 'grayscale', (i,0,0)), block )
+            # Make sure the modification times differ
+            path = cache._block_path( ('abc', 'grayscale', (i,0,0)) )
+            os.utime( path, (time.time()-100+i, time.time()-100+i) )
+
+        # Re-writing a cached block doesn't count its size twice.
+        assert cache.current_bytes == 4*file_size
+
+        # Touch block 0, so blocks 1 and 2 become the least recently used.
+        assert cache.get( ('abc', 'grayscale', (0,0,0)) ) is not None
+        cache.put( ('abc', 'grayscale', (4,0,0)), block )
+        assert len(cache) == 3
+        assert cache.get( ('abc', 'grayscale', (1,0,0)) ) is None
+        assert cache.get( ('abc', 'grayscale', (2,0,0)) ) is None
+        assert cache.get( ('abc', 'grayscale', (0,0,0)) ) is not None
+        assert cache.current_bytes == 3*file_size
+
+        # The directory is only re-scanned when the cache is full again.
+        scans = []
+        original_scan = cache._scan
+        def recording_scan(*args):
+            scans.append( args )
+            return original_scan(*args)
+        cache._scan = recording_scan
+        cache.put( ('abc', 'grayscale', (5,0,0)), block )
+        assert len(scans) == 0
+        cache.put( ('abc', 'grayscale', (6,0,0)), block )
+        assert len(scans) == 1
+        assert cache.current_bytes <= cache.LOW_WATER_FRACTION * cache.max_bytes
+
+    def test_invalidate(self):
+        block = numpy.zeros( (1,32,32), dtype=numpy.uint8 )
+        cache = DiskBlockCache( self.cache_dir, max_bytes=10*1024**2 )
+        for i in range(3):
+            cache.put( ('abc', 'grayscale', (i,0)), block )
+            cache.put( ('abc', 'labels', (i,0)), block )
+        cache.invalidate( 'abc', 'grayscale', [(1,0)] )
+        assert cache.get( ('abc', 'grayscale', (1,0)) ) is None
+        assert len(cache) == 5
+        cache.invalidate( 'abc', 'labels' )
+        assert len(cache) == 2
+        assert cache.current_bytes == cache._scan()[1]
+        cache.clear()
+        assert len(cache) == 0
+        assert cache.current_bytes == 0
+
+    def test_backing_cache(self):
+        disk_cache = DiskBlockCache( self.cache_dir, max_bytes=10*1024**2 )
+        block = numpy.zeros( (1,32,32), dtype=numpy.uint8 )
+        BlockCache( 1024**2, backing_cache=disk_cache ).put( ('abc', 'grayscale', (0,0)), block )
+
+        # A new in-memory cache is populated from the backing cache.
+        cache = BlockCache( 1024**2, backing_cache=disk_cache )
+        assert cache.requires_locked_node
+        assert len(cache) == 0
+        assert cache.get( ('abc', 'grayscale', (0,0)) ) is not None
+        assert len(cache) == 1
+
+        cache.invalidate( 'abc', 'grayscale' )
+        assert len(cache) == 0
+        assert len(disk_cache) == 0
+
+if __name__ == "__main__":
+    import sys
+    import nose
+    sys.argv.append("--nocapture")    # Don't steal stdout.  Show it on the console as usual.
+    sys.argv.append("--nologcapture") # Don't set the logging level to DEBUG.  Leave it alone.
+    nose.run(defaultTest=__file__)
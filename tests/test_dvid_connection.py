@@ -0,0 +1,302 @@
+import os
+import shutil
+import time
+import tempfile
+import threading
+from multiprocessing.pool import ThreadPool
+
+import numpy
+
+from pydvid import general, voxels
+from pydvid.errors import ConnectionPoolTimeoutError
+from pydvid.dvid_connection import DvidConnection, DvidConnectionPool, PooledHTTPConnection
+from mockserver.h5mockserver import H5MockServer, H5MockServerDataFile, H5CutoutRequestHandler
+
+class TestDvidConnection(object):
+
+    @classmethod
+    def setupClass(cls):
+        """
+        Override.  Called by nosetests.
+        - Create an hdf5 file to store the test data
+        - Start the mock server, which serves the test data from the file.
+        """
+        cls._tmp_dir = tempfile.mkdtemp()
+        cls.test_filepath = os.path.join( cls._tmp_dir, "test_data.h5" )
+        cls._generate_testdata_h5(cls.test_filepath)
+        cls.server_proc, cls.shutdown_event = cls._start_mockserver( cls.test_filepath, same_process=True )
+
+    @classmethod
+    def teardownClass(cls):
+        """
+        Override.  Called by nosetests.
+        """
+        shutil.rmtree(cls._tmp_dir)
+        cls.shutdown_event.set()
+        cls.server_proc.join()
+
+    @classmethod
+    def _generate_testdata_h5(cls, test_filepath):
+        """
+        Generate a temporary hdf5 file for the mock server to use (and us to compare against)
+        """
+        data = numpy.indices( (10, 100, 200) ).astype( numpy.uint8 )
+        cls.original_data = data
+        cls.data_uuid = "abcde"
+        cls.data_name = "indices_data"
+        cls.voxels_metadata = voxels.VoxelsMetadata.create_default_metadata(data.shape, data.dtype, "cxyz", 1.0, "")
+
+        with H5MockServerDataFile( test_filepath ) as test_h5file:
+            test_h5file.add_node( "datasetA", cls.data_uuid )
+            test_h5file.add_volume( "datasetA", cls.data_name, data, cls.voxels_metadata )
+
+    @classmethod
+    def _start_mockserver(cls, h5filepath, same_process=False, disable_server_logging=True):
+        """
+        Start the mock DVID server in a separate process.
+
+        h5filepath: The file to serve up.
+        same_process: If True, start the server in this process as a
+                      separate thread (useful for debugging).
+                      Otherwise, start the server in its own process (default).
+        disable_server_logging: If true, disable the normal HttpServer logging of every request.
+
+        The server is threaded, so it keeps connections alive between requests.
+        """
+        return H5MockServer.create_and_start( h5filepath, "localhost", 8000, same_process, disable_server_logging, threaded=True )
+
+    def test_pool_reuses_connections(self):
+        pool = DvidConnectionPool( "localhost:8000", max_size=2 )
+        with pool.connection() as connection:
+            general.get_server_info( connection )
+        assert pool.num_checked_out == 0
+        assert pool.num_idle == 1
+        with pool.connection() as connection2:
+            assert connection2 is connection
+        pool.close()
+        assert pool.num_idle == 0
+
+    def test_pool_max_size(self):
+        pool = DvidConnectionPool( "localhost:8000", max_size=2 )
+        connection1 = pool.checkout()
+        connection2 = pool.checkout()
+        try:
+            pool.checkout( timeout=0.05 )
+        except ConnectionPoolTimeoutError:
+            pass
+        else:
+            assert False, "Expected the pool to be exhausted."
+
+        # A waiting thread gets the connection as soon as it is checked in.
+        waiting_result = []
+        waiting_thread = threading.Thread( target=lambda: waiting_result.append( pool.checkout() ) )
+        waiting_thread.start()
+        pool.checkin( connection1 )
+        waiting_thread.join()
+        assert waiting_result == [connection1]
+
+    def test_idle_eviction(self):
+        pool = DvidConnectionPool( "localhost:8000", idle_timeout=0.0 )
+        with pool.connection() as connection:
+            general.get_server_info( connection )
+        assert pool.num_idle == 0
+
+    def test_unfinished_response(self):
+        pool = DvidConnectionPool( "localhost:8000" )
+        connection = pool.checkout()
+        connection.request( "GET", "/api/server/info" )
+        response = connection.getresponse()
+        assert not response.will_close
+        response.read(5)
+        assert not connection.previous_response_finished()
+
+        # Connections with unfinished responses are not returned to the idle pool.
+        pool.checkin( connection )
+        assert pool.num_idle == 0
+
+    def test_request_after_partial_read(self):
+        """
+        If a keep-alive response was abandoned after a partial read,
+        the connection is re-opened for the next request instead of becoming unusable.
+        """
+        connection = PooledHTTPConnection( "localhost:8000" )
+        connection.request( "GET", "/api/server/info" )
+        response = connection.getresponse()
+        assert not response.will_close
+        response.read(5)
+        response.close()
+        assert not connection.previous_response_finished()
+
+        info = general.get_server_info( connection )
+        assert "Cores" in info
+
+        # Same thing if the partially read response was never closed.
+        connection.request( "GET", "/api/server/info" )
+        response = connection.getresponse()
+        response.read(5)
+
+        info = general.get_server_info( connection )
+        assert "Cores" in info
+        connection.close()
+
+    def test_keep_alive(self):
+        connection = PooledHTTPConnection( "localhost:8000" )
+        general.get_server_info( connection )
+        sock = connection.sock
+        assert sock is not None
+        general.get_server_info( connection )
+        assert connection.sock is sock, "Connection wasn't kept alive"
+        connection.close()
+
+    def test_stale_socket_retry(self):
+        """
+        If the server closes an idle keep-alive connection, the next (idempotent) request is sent again on a new socket.
+        """
+        original_timeout = H5CutoutRequestHandler.timeout
+        H5CutoutRequestHandler.timeout = 0.2
+        try:
+            connection = PooledHTTPConnection( "localhost:8000" )
+            general.get_server_info( connection )
+            sock = connection.sock
+            assert sock is not None
+
+            # Give the server time to close the idle connection.
+            time.sleep( 0.5 )
+            info = general.get_server_info( connection )
+            assert "Cores" in info
+            assert connection.sock is not sock
+            connection.close()
+        finally:
+            H5CutoutRequestHandler.timeout = original_timeout
+
+    def test_thread_churn(self):
+        """
+        Connections held by threads that have exited are returned to the pool.
+        """
+        connection = DvidConnection( "localhost:8000", max_size=2 )
+        for _ in range(5):
+            thread = threading.Thread( target=general.get_server_info, args=(connection,) )
+            thread.start()
+            thread.join()
+        assert connection.pool.num_checked_out <= 2
+
+        general.get_server_info( connection )
+        connection.release()
+        assert connection.pool.num_checked_out <= 1
+        connection.close()
+
+    def test_checkout_timeout(self):
+        """
+        If live threads hold all connections, a waiting thread eventually gives up.
+        """
+        connection = DvidConnection( "localhost:8000", max_size=1, checkout_timeout=0.2 )
+        general.get_server_info( connection )
+
+        errors = []
+        def get_info():
+            try:
+                general.get_server_info( connection )
+            except ConnectionPoolTimeoutError as ex:
+                errors.append( ex )
+        thread = threading.Thread( target=get_info )
+        thread.start()
+        thread.join( 5.0 )
+        assert not thread.is_alive(), "Thread is still waiting for a connection"
+        assert len(errors) == 1
+
+        # Once the connection is released, other threads can use it.
+        connection.release()
+        thread = threading.Thread( target=general.get_server_info, args=(connection,) )
+        thread.start()
+        thread.join()
+        connection.close()
+
+    def test_many_long_lived_threads(self):
+        """
+        By default, there's no limit on the number of threads that can hold a connection at once.
+        """
+        connection = DvidConnection( "localhost:8000" )
+        all_started = threading.Event()
+        barrier_lock = threading.Lock()
+        num_ready = [0]
+        errors = []
+        num_threads = 40
+        def get_info():
+            try:
+                general.get_server_info( connection )
+                with barrier_lock:
+                    num_ready[0] += 1
+                    if num_ready[0] == num_threads:
+                        all_started.set()
+                # Keep the connection until every thread has one.
+                all_started.wait( 10.0 )
+                general.get_server_info( connection )
+            except Exception as ex:
+                errors.append( ex )
+
+        threads = [ threading.Thread( target=get_info ) for _ in range(num_threads) ]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        assert not errors, errors
+        assert all_started.is_set()
+        connection.close()
+
+    def test_close_leaves_busy_threads_alone(self):
+        """
+        close() doesn't touch the connections of other live threads.
+        """
+        connection = DvidConnection( "localhost:8000" )
+        has_connection = threading.Event()
+        closed = threading.Event()
+        connections_used = []
+        def get_info_twice():
+            general.get_server_info( connection )
+            connections_used.append( connection._current_connection() )
+            has_connection.set()
+            closed.wait( 10.0 )
+            general.get_server_info( connection )
+            connections_used.append( connection._current_connection() )
+            connection.release()
+
+        thread = threading.Thread( target=get_info_twice )
+        thread.start()
+        has_connection.wait( 10.0 )
+        general.get_server_info( connection )
+        connection.close()
+        assert connection.pool.num_checked_out == 1
+        assert connection.pool.num_idle == 0
+        closed.set()
+        thread.join()
+
+        # The thread kept using the same (open) connection across close().
+        assert connections_used[0] is connections_used[1]
+        assert connection.pool.num_checked_out == 0
+        connection.close()
+
+    def test_worker_threads_release_connections(self):
+        """
+        Long-lived pool threads don't keep their connections between tasks,
+        so several thread pools can take turns using the same (small) connection pool.
+        """
+        connection = DvidConnection( "localhost:8000", max_size=2, checkout_timeout=1.0 )
+        thread_pools = [ ThreadPool(2) for _ in range(3) ]
+        try:
+            for thread_pool in thread_pools:
+                a = voxels.get_ndarray_tiled( connection, self.data_uuid, self.data_name, self.voxels_metadata,
+                                              (0,0,0,0), (3,10,100,200), (32,32,32), thread_pool=thread_pool )
+                assert (a == self.original_data).all()
+                assert connection.pool.num_checked_out == 0
+        finally:
+            for thread_pool in thread_pools:
+                thread_pool.close()
+                thread_pool.join()
+            connection.close()
+
+if __name__ == "__main__":
+    import sys
+    import nose
+    sys.argv.append("--nocapture")    # Don't steal stdout.  Show it on the console as usual.
+    sys.argv.append("--nologcapture") # Don't set the logging level to DEBUG.  Leave it alone.
+    nose.run(defaultTest=__file__)
@@ -0,0 +1,555 @@
+import os
+import shutil
+import socket
+import time
+import httplib
+import tempfile
+import threading
+import contextlib
+
+import h5py
+import numpy
+
+from pydvid import general, voxels, keyvalue
+from pydvid.errors import DvidHttpError
+from pydvid.dvid_connection import DvidConnection
+from pydvid.compression import get_response_stream
+from pydvid.voxels.voxels_nddata_codec import VoxelsNddataCodec
+from mockserver.h5mockserver import H5MockServer, H5MockServerDataFile, H5CutoutRequestHandler, SimulatedNetwork, \
+                                    volume_storage_options, _RequestBody
+
+class TestThreadedH5MockServer(object):
+    """
+    Tests for the mock server's threaded mode.
+    """
+
+    @classmethod
+    def setupClass(cls):
+        """
+        Override.  Called by nosetests.
+        - Create an hdf5 file to store the test data
+        - Start the mock server (in threaded mode), which serves the test data from the file.
+        """
+        cls._tmp_dir = tempfile.mkdtemp()
+        cls.test_filepath = os.path.join( cls._tmp_dir, "test_data.h5" )
+        cls._generate_testdata_h5(cls.test_filepath)
+        cls.server_proc, cls.shutdown_event = H5MockServer.create_and_start( cls.test_filepath, "localhost", 8000,
+                                                                             same_process=True,
+                                                                             disable_server_logging=True,
+                                                                             threaded=True )
+
+    @classmethod
+    def teardownClass(cls):
+        """
+        Override.  Called by nosetests.
+        """
+        shutil.rmtree(cls._tmp_dir)
+        cls.shutdown_event.set()
+        cls.server_proc.join()
+
+    @classmethod
+    def _generate_testdata_h5(cls, test_filepath):
+        """
+        Generate a temporary hdf5 file for the mock server to use (and us to compare against)
+        """
+        data = numpy.random.randint( 0, 255, size=(1, 128, 128, 32) ).astype( numpy.uint8 )
+        cls.original_data = data
+        cls.data_uuid = "abcde"
+        cls.data_name = "random_data"
+        cls.keyvalue_name = "kv_store"
+        cls.voxels_metadata = voxels.VoxelsMetadata.create_default_metadata(data.shape, data.dtype, "cxyz", 1.0, "")
+
+        # A huge (but empty) volume, which occupies almost no disk space.
+        cls.huge_data_name = "huge_data"
+        cls.huge_metadata = voxels.VoxelsMetadata.create_default_metadata( (1, 100000, 100000, 100000), numpy.uint16, "cxyz", 1.0, "" )
+
+        with H5MockServerDataFile( test_filepath, h5_compression='gzip' ) as test_h5file:
+            test_h5file.add_node( "datasetA", cls.data_uuid )
+            test_h5file.add_volume( "datasetA", cls.data_name, data, cls.voxels_metadata )
+            test_h5file.add_volume( "datasetA", cls.huge_data_name, None, cls.huge_metadata )
+            test_h5file.add_keyvalue_group( "datasetA", cls.keyvalue_name )
+
+    def test_concurrent_requests(self):
+        """
+        A client that is slow to send its request must not block other clients.
+        """
+        stalled_sock = socket.create_connection( ("localhost", 8000) )
+        try:
+            # Send an incomplete request.  (The server waits for the rest of the headers.)
+            stalled_sock.sendall( "GET /api/server/info HTTP/1.0\r\n" )
+
+            connection = httplib.HTTPConnection( "localhost:8000", timeout=5.0 )
+            info = general.get_server_info( connection )
+            assert "Cores" in info
+
+            # Now finish the stalled request.  It is served, too.
+            stalled_sock.sendall( "\r\n" )
+            stalled_sock.settimeout( 5.0 )
+            response = httplib.HTTPResponse( stalled_sock )
+            response.begin()
+            assert response.status == httplib.OK
+            response.read()
+        finally:
+            stalled_sock.close()
+
+    def test_unknown_node(self):
+        connection = httplib.HTTPConnection( "localhost:8000" )
+        try:
+            keyvalue.get_value( connection, "fffff", self.keyvalue_name, "some_key" )
+        except DvidHttpError as ex:
+            assert ex.status_code == httplib.NOT_FOUND
+        else:
+            assert False, "Expected a DvidHttpError"
+
+    def test_huge_volume(self):
+        connection = httplib.HTTPConnection( "localhost:8000" )
+        start = (0, 50000, 99990, 1234)
+        stop = (1, 50100, 100000, 1334)
+        empty = voxels.get_ndarray( connection, self.data_uuid, self.huge_data_name, self.huge_metadata, start, stop )
+        assert empty.shape == (1, 100, 10, 100)
+        assert (empty == 0).all()
+
+        new_data = numpy.asfortranarray( numpy.random.randint( 0, 10000, size=empty.shape ).astype( numpy.uint16 ) )
+        voxels.post_ndarray( connection, self.data_uuid, self.huge_data_name, self.huge_metadata, start, stop, new_data )
+        read_data = voxels.get_ndarray( connection, self.data_uuid, self.huge_data_name, self.huge_metadata, start, stop )
+        assert (read_data == new_data).all()
+
+        # Only the written chunks are stored.
+        assert os.path.getsize( self.test_filepath ) < 10*1024**2
+
+    def test_keep_alive_post(self):
+        """
+        POSTed data is received straight into the array (with readinto), and the connection stays open afterwards.
+        """
+        start = (0, 3000, 4000, 5000)
+        stop = (1, 3100, 4100, 5100)
+        new_data = numpy.asfortranarray( numpy.random.randint( 0, 10000, size=numpy.subtract(stop, start) ).astype( numpy.uint16 ) )
+
+        received_sizes = []
+        original_readinto = _RequestBody._readinto
+        def recording_readinto( body, buf ):
+            received = original_readinto( body, buf )
+            received_sizes.append( received )
+            return received
+        _RequestBody._readinto = recording_readinto
+        connection = httplib.HTTPConnection( "localhost:8000" )
+        try:
+            voxels.post_ndarray( connection, self.data_uuid, self.huge_data_name, self.huge_metadata, start, stop, new_data )
+            sock = connection.sock
+            read_data = voxels.get_ndarray( connection, self.data_uuid, self.huge_data_name, self.huge_metadata, start, stop )
+        finally:
+            _RequestBody._readinto = original_readinto
+        assert (read_data == new_data).all()
+        assert sock is not None and connection.sock is sock, "Connection wasn't kept alive"
+        assert sum( received_sizes ) == new_data.nbytes
+        assert len( received_sizes ) < new_data.nbytes // VoxelsNddataCodec.STREAM_CHUNK_SIZE
+
+    def test_slab_streaming(self):
+        """
+        Subvolumes are sent in slabs.  Check various slab sizes, with bounds that aren't chunk-aligned.
+        """
+        connection = httplib.HTTPConnection( "localhost:8000" )
+        start = (0, 1000, 2000, 1234)
+        stop = (1, 1040, 2030, 1334)
+        new_data = numpy.asfortranarray( numpy.random.randint( 0, 10000, size=numpy.subtract(stop, start) ).astype( numpy.uint16 ) )
+        voxels.post_ndarray( connection, self.data_uuid, self.huge_data_name, self.huge_metadata, start, stop, new_data )
+
+        plane_bytes = 40*30*2
+        original_slab_size = H5CutoutRequestHandler.STREAM_SLAB_SIZE
+        try:
+            for slab_size in [1, plane_bytes, 7*plane_bytes, 50*plane_bytes, original_slab_size]:
+                H5CutoutRequestHandler.STREAM_SLAB_SIZE = slab_size
+                for compression in [None, 'gzip']:
+                    read_data = voxels.get_ndarray( connection, self.data_uuid, self.huge_data_name, self.huge_metadata,
+                                                    start, stop, compression=compression )
+                    assert (read_data == new_data).all(), \
+                        "Wrong data with slab size {} and compression {}".format( slab_size, compression )
+        finally:
+            H5CutoutRequestHandler.STREAM_SLAB_SIZE = original_slab_size
+
+        # Even if a single plane is larger than STREAM_SLAB_SIZE, slabs are whole chunks thick,
+        # so each chunk is read only once.  (The roi spans 4 chunks along the last axis.)
+        reads = []
+        original_read_direct = h5py.Dataset.read_direct
+        def recording_read_direct( dataset, *args, **kwargs ):
+            reads.append( args[1] )
+            return original_read_direct( dataset, *args, **kwargs )
+        H5CutoutRequestHandler.STREAM_SLAB_SIZE = plane_bytes // 2
+        h5py.Dataset.read_direct = recording_read_direct
+        try:
+            read_data = voxels.get_ndarray( connection, self.data_uuid, self.huge_data_name, self.huge_metadata, start, stop )
+        finally:
+            h5py.Dataset.read_direct = original_read_direct
+            H5CutoutRequestHandler.STREAM_SLAB_SIZE = original_slab_size
+        assert (read_data == new_data).all()
+        assert [ s[-1] for s in reads ] == [ slice(1234, 1248), slice(1248, 1280), slice(1280, 1312), slice(1312, 1334) ]
+
+        # Compressed responses are streamed, too, so their length isn't known in advance.
+        response = voxels.get_subvolume_response( connection, self.data_uuid, self.huge_data_name,
+                                                  start, stop, compression='gzip' )
+        with contextlib.closing( response ):
+            assert response.getheader( "Content-Encoding" ) == 'gzip'
+            assert response.getheader( "Transfer-Encoding" ) == 'chunked'
+            assert response.getheader( "Content-Length" ) is None
+            codec = VoxelsNddataCodec( self.huge_metadata )
+            read_data = codec.decode_to_ndarray( get_response_stream( response ), new_data.shape )
+        assert (read_data == new_data).all()
+
+    def test_slab_scratch_is_bounded(self):
+        """
+        If a whole chunk row doesn't fit in MAX_STREAM_SCRATCH_SIZE, slabs are thinner than one chunk,
+        and the server's scratch buffers stay small.
+        """
+        connection = httplib.HTTPConnection( "localhost:8000" )
+        start = (0, 3000, 2000, 1234)
+        stop = (1, 3040, 2030, 1334)
+        new_data = numpy.asfortranarray( numpy.random.randint( 0, 10000, size=numpy.subtract(stop, start) ).astype( numpy.uint16 ) )
+        voxels.post_ndarray( connection, self.data_uuid, self.huge_data_name, self.huge_metadata, start, stop, new_data )
+
+        plane_bytes = 40*30*2
+        scratch_sizes = []
+        buffer_sizes = []
+        original_read_direct = h5py.Dataset.read_direct
+        def recording_read_direct( dataset, dest, *args, **kwargs ):
+            scratch_sizes.append( dest.nbytes )
+            return original_read_direct( dataset, dest, *args, **kwargs )
+        original_iter_slab_buffers = H5CutoutRequestHandler._iter_slab_buffers
+        def recording_iter_slab_buffers( handler, *args ):
+            for buf in original_iter_slab_buffers( handler, *args ):
+                buffer_sizes.append( len(buf) )
+                yield buf
+
+        original_slab_size = H5CutoutRequestHandler.STREAM_SLAB_SIZE
+        original_max_scratch_size = H5CutoutRequestHandler.MAX_STREAM_SCRATCH_SIZE
+        H5CutoutRequestHandler.STREAM_SLAB_SIZE = 3*plane_bytes
+        H5CutoutRequestHandler.MAX_STREAM_SCRATCH_SIZE = 10*plane_bytes
+        h5py.Dataset.read_direct = recording_read_direct
+        H5CutoutRequestHandler._iter_slab_buffers = recording_iter_slab_buffers
+        try:
+            read_data = voxels.get_ndarray( connection, self.data_uuid, self.huge_data_name, self.huge_metadata, start, stop )
+        finally:
+            h5py.Dataset.read_direct = original_read_direct
+            H5CutoutRequestHandler._iter_slab_buffers = original_iter_slab_buffers
+            H5CutoutRequestHandler.STREAM_SLAB_SIZE = original_slab_size
+            H5CutoutRequestHandler.MAX_STREAM_SCRATCH_SIZE = original_max_scratch_size
+
+        assert (read_data == new_data).all()
+        assert max( scratch_sizes ) <= 10*plane_bytes, scratch_sizes
+        assert max( buffer_sizes ) <= 3*plane_bytes, buffer_sizes
+        assert sum( buffer_sizes ) == new_data.nbytes
+
+    def test_write_during_streamed_read(self):
+        """
+        A write that arrives while a read of the same region is being sent
+        doesn't change the data in the middle of the response.
+        """
+        start = (0, 5000, 5000, 5000)
+        stop = (1, 5064, 5064, 5128)
+        old_data = numpy.asfortranarray( numpy.random.randint( 0, 10000, size=numpy.subtract(stop, start) ).astype( numpy.uint16 ) )
+        new_data = numpy.asfortranarray( numpy.random.randint( 0, 10000, size=numpy.subtract(stop, start) ).astype( numpy.uint16 ) )
+        connection = httplib.HTTPConnection( "localhost:8000" )
+        voxels.post_ndarray( connection, self.data_uuid, self.huge_data_name, self.huge_metadata, start, stop, old_data )
+
+        # After the first slab has been sent, post new data (from another thread) and give it time to finish.
+        write_connection = httplib.HTTPConnection( "localhost:8000" )
+        write_thread = threading.Thread( target=voxels.post_ndarray, 
+                                         args=( write_connection, self.data_uuid, self.huge_data_name, 
+                                                self.huge_metadata, start, stop, new_data ) )
+        original_iter_slab_buffers = H5CutoutRequestHandler._iter_slab_buffers
+        def interrupted_iter_slab_buffers( handler, *args ):
+            for buf in original_iter_slab_buffers( handler, *args ):
+                yield buf
+                if not write_thread.ident:
+                    write_thread.start()
+                    write_thread.join( 0.5 )
+
+        # One slab per chunk (4 along the last axis)
+        original_slab_size = H5CutoutRequestHandler.STREAM_SLAB_SIZE
+        H5CutoutRequestHandler.STREAM_SLAB_SIZE = 1
+        H5CutoutRequestHandler._iter_slab_buffers = interrupted_iter_slab_buffers
+        try:
+            read_data = voxels.get_ndarray( connection, self.data_uuid, self.huge_data_name, self.huge_metadata, start, stop )
+        finally:
+            H5CutoutRequestHandler._iter_slab_buffers = original_iter_slab_buffers
+            H5CutoutRequestHandler.STREAM_SLAB_SIZE = original_slab_size
+            write_thread.join()
+        assert (read_data == old_data).all()
+
+        read_data = voxels.get_ndarray( connection, self.data_uuid, self.huge_data_name, self.huge_metadata, start, stop )
+        assert (read_data == new_data).all()
+
+    def test_stalled_reader_doesnt_block_writers(self):
+        """
+        If a client stops reading a volume response, the server gives up on it (after the socket timeout),
+        so writes to the volume aren't blocked forever.
+        """
+        start = (0, 7000, 7000, 7000)
+        stop = (1, 7512, 7512, 7064) # 32MB: much more than fits in the socket buffers
+        original_timeout = H5CutoutRequestHandler.timeout
+        assert original_timeout is not None
+        H5CutoutRequestHandler.timeout = 0.5
+        try:
+            stalled_connection = httplib.HTTPConnection( "localhost:8000" )
+            response = voxels.get_subvolume_response( stalled_connection, self.data_uuid, self.huge_data_name, start, stop )
+            response.read( 100 ) # ...and then stop reading.
+
+            new_data = numpy.ones( (1, 10, 10, 10), dtype=numpy.uint16, order='F' )
+            write_connection = httplib.HTTPConnection( "localhost:8000" )
+            write_thread = threading.Thread( target=voxels.post_ndarray,
+                                             args=( write_connection, self.data_uuid, self.huge_data_name, self.huge_metadata,
+                                                    start, (1, 7010, 7010, 7010), new_data ) )
+            write_thread.start()
+            write_thread.join( 10.0 )
+            assert not write_thread.is_alive(), "Write is still blocked by the stalled read."
+            stalled_connection.close()
+        finally:
+            H5CutoutRequestHandler.timeout = original_timeout
+
+    def test_error_during_streamed_read(self):
+        """
+        If the server fails after the response headers were sent, the client gets 
+        an incomplete response (not an error page mixed into the data), and doesn't hang.
+        """
+        start = (0, 6000, 6000, 6000)
+        stop = (1, 6064, 6064, 6128)
+        data = numpy.asfortranarray( numpy.random.randint( 0, 10000, size=numpy.subtract(stop, start) ).astype( numpy.uint16 ) )
+        connection = httplib.HTTPConnection( "localhost:8000", timeout=10.0 )
+        voxels.post_ndarray( connection, self.data_uuid, self.huge_data_name, self.huge_metadata, start, stop, data )
+
+        original_iter_slab_buffers = H5CutoutRequestHandler._iter_slab_buffers
+        def failing_iter_slab_buffers( handler, *args ):
+            for buf in original_iter_slab_buffers( handler, *args ):
+                yield buf
+                raise IOError( "Simulated read error" )
+
+        original_slab_size = H5CutoutRequestHandler.STREAM_SLAB_SIZE
+        H5CutoutRequestHandler.STREAM_SLAB_SIZE = 1
+        H5CutoutRequestHandler._iter_slab_buffers = failing_iter_slab_buffers
+        try:
+            response = voxels.get_subvolume_response( connection, self.data_uuid, self.huge_data_name, start, stop )
+            try:
+                response.read()
+            except httplib.IncompleteRead as ex:
+                received = ex.partial
+            else:
+                assert False, "Expected an incomplete response"
+        finally:
+            H5CutoutRequestHandler._iter_slab_buffers = original_iter_slab_buffers
+            H5CutoutRequestHandler.STREAM_SLAB_SIZE = original_slab_size
+        expected = numpy.getbuffer( data )[:]
+        assert 0 < len(received) < len(expected)
+        assert received == expected[:len(received)]
+
+    def test_parallel_reads_and_writes(self):
+        """
+        Many threads reading and writing disjoint parts of the volume
+        (and separate keys of a keyvalue store) at once.
+        """
+        connection = DvidConnection( "localhost:8000", max_size=8 )
+        errors = []
+
+        def work( thread_index ):
+            try:
+                # Each thread owns one z-slab.
+                start = (0, 0, 0, 4*thread_index)
+                stop = (1, 128, 128, 4*(thread_index+1))
+                new_data = numpy.asfortranarray( numpy.random.randint( 0, 255, size=numpy.subtract(stop, start) ).astype( numpy.uint8 ) )
+                voxels.post_ndarray( connection, self.data_uuid, self.data_name, self.voxels_metadata, start, stop, new_data )
+                read_data = voxels.get_ndarray( connection, self.data_uuid, self.data_name, self.voxels_metadata, start, stop )
+                assert (read_data == new_data).all(), "Thread {}: wrong voxel data".format( thread_index )
+
+                key = "key_{}".format( thread_index )
+                value = "value {}".format( thread_index ) * 1000
+                keyvalue.put_value( connection, self.data_uuid, self.keyvalue_name, key, value )
+                assert keyvalue.get_value( connection, self.data_uuid, self.keyvalue_name, key ) == value, \
+                    "Thread {}: wrong value".format( thread_index )
+            except Exception as ex:
+                errors.append( ex )
+            finally:
+                connection.release()
+
+        threads = [ threading.Thread( target=work, args=(i,) ) for i in range(8) ]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        connection.close()
+        assert not errors, "Errors in worker threads: {}".format( errors )
+
+class TestSimulatedNetwork(object):
+    """
+    Tests for the mock server's network simulation.
+    Each test starts its own server, with different network conditions.
+    """
+
+    @classmethod
+    def setupClass(cls):
+        """
+        Override.  Called by nosetests.
+        - Create an hdf5 file to store the test data
+        """
+        cls._tmp_dir = tempfile.mkdtemp()
+        cls.test_filepath = os.path.join( cls._tmp_dir, "test_data.h5" )
+
+        data = numpy.random.randint( 0, 255, size=(1, 64, 64, 64) ).astype( numpy.uint8 )
+        cls.original_data = data
+        cls.data_uuid = "abcde"
+        cls.data_name = "random_data"
+        cls.keyvalue_name = "kv_store"
+        cls.voxels_metadata = voxels.VoxelsMetadata.create_default_metadata(data.shape, data.dtype, "cxyz", 1.0, "")
+
+        with H5MockServerDataFile( cls.test_filepath ) as test_h5file:
+            test_h5file.add_node( "datasetA", cls.data_uuid )
+            test_h5file.add_volume( "datasetA", cls.data_name, data, cls.voxels_metadata )
+            test_h5file.add_keyvalue_group( "datasetA", cls.keyvalue_name )
+
+    @classmethod
+    def teardownClass(cls):
+        """
+        Override.  Called by nosetests.
+        """
+        shutil.rmtree(cls._tmp_dir)
+
+    @contextlib.contextmanager
+    def _server(self, network):
+        server_thread, shutdown_event = H5MockServer.create_and_start( self.test_filepath, "localhost", 8000,
+                                                                       same_process=True, network=network )
+        try:
+            yield
+        finally:
+            shutdown_event.set()
+            server_thread.join()
+
+    def test_latency(self):
+        with self._server( SimulatedNetwork( latency=0.1, jitter=0.05 ) ):
+            connection = httplib.HTTPConnection( "localhost:8000" )
+            start = time.time()
+            general.get_server_info( connection )
+            duration = time.time() - start
+        assert duration >= 0.1, "Request took only {} seconds".format( duration )
+
+    def test_bandwidth(self):
+        value = "x" * 50000
+        with self._server( SimulatedNetwork( bandwidth=250000 ) ):
+            connection = httplib.HTTPConnection( "localhost:8000" )
+            keyvalue.put_value( connection, self.data_uuid, self.keyvalue_name, "key", value )
+            start = time.time()
+            assert keyvalue.get_value( connection, self.data_uuid, self.keyvalue_name, "key" ) == value
+            duration = time.time() - start
+        # 50 kB at 250 kB/s
+        assert duration >= 0.18, "Request took only {} seconds".format( duration )
+
+    def test_server_errors(self):
+        with self._server( SimulatedNetwork( error_rate=1.0 ) ):
+            connection = httplib.HTTPConnection( "localhost:8000" )
+            try:
+                general.get_server_info( connection )
+            except DvidHttpError as ex:
+                assert ex.status_code == httplib.SERVICE_UNAVAILABLE
+            else:
+                assert False, "Expected a DvidHttpError"
+
+    def test_connection_resets(self):
+        with self._server( SimulatedNetwork( reset_rate=1.0 ) ):
+            connection = httplib.HTTPConnection( "localhost:8000" )
+            try:
+                general.get_server_info( connection )
+            except (socket.error, httplib.HTTPException):
+                pass
+            else:
+                assert False, "Expected the connection to be reset"
+
+    def test_deterministic_faults(self):
+        def choose_faults( seed ):
+            network = SimulatedNetwork( jitter=0.1, error_rate=0.2, reset_rate=0.2, seed=seed )
+            return [ network.next_request() for _ in range(50) ]
+        assert choose_faults( 123 ) == choose_faults( 123 )
+        faults = [ fault for _, fault in choose_faults( 123 ) ]
+        assert SimulatedNetwork.SERVER_ERROR in faults
+        assert SimulatedNetwork.CONNECTION_RESET in faults
+        assert None in faults
+
+    def test_upload_retries(self):
+        """
+        Chunked uploads survive an unreliable network (by retrying).
+        """
+        new_data = numpy.asfortranarray( numpy.random.randint( 0, 255, size=self.original_data.shape ).astype( numpy.uint8 ) )
+        original_delay = voxels.voxels.UPLOAD_RETRY_DELAY
+        voxels.voxels.UPLOAD_RETRY_DELAY = 0.001
+        try:
+            with self._server( SimulatedNetwork( error_rate=0.2, reset_rate=0.2, seed=0 ) ):
+                connection = DvidConnection( "localhost:8000" )
+                voxels.post_ndarray_chunked( connection, self.data_uuid, self.data_name, self.voxels_metadata, 
+                                             (0,0,0,0), new_data.shape, new_data, chunk_shape=(32,32,32),
+                                             num_threads=2, max_retries=10 )
+                connection.close()
+
+            with self._server( None ):
+                connection = httplib.HTTPConnection( "localhost:8000" )
+                read_data = voxels.get_ndarray( connection, self.data_uuid, self.data_name, self.voxels_metadata,
+                                                (0,0,0,0), new_data.shape )
+            assert (read_data == new_data).all()
+        finally:
+            voxels.voxels.UPLOAD_RETRY_DELAY = original_delay
+
+class TestH5MockServerDataFile(object):
+
+    def setUp(self):
+        self._tmp_dir = tempfile.mkdtemp()
+        self.test_filepath = os.path.join( self._tmp_dir, "test_data.h5" )
+
+    def tearDown(self):
+        shutil.rmtree( self._tmp_dir )
+
+    def test_storage_options(self):
+        options = volume_storage_options( (3, 0, 0, 0), 32 )
+        assert options['chunks'] == (3, 32, 32, 32)
+        assert options['maxshape'] == (None, None, None, None)
+        assert options['compression'] is None
+
+        # Chunks are clipped to the (non-empty) initial extent.
+        options = volume_storage_options( (1, 100, 100, 5), (16, 16, 16), 'gzip' )
+        assert options['chunks'] == (1, 16, 16, 5)
+        assert options['compression'] == 'gzip'
+
+        # Non-spatial axes (e.g. time) are chunked one plane at a time.
+        options = volume_storage_options( (4, 10, 100, 200, 3), 32 )
+        assert options['chunks'] == (4, 10, 32, 32, 1)
+        options = volume_storage_options( (4, 0, 0, 0, 0), 32 )
+        assert options['chunks'] == (4, 32, 32, 32, 1)
+
+    def test_file_size(self):
+        """
+        Small volumes aren't padded out to whole blocks on disk.
+        """
+        data = numpy.zeros( (4, 10, 100, 200, 3), dtype=numpy.uint32 )
+        metadata = voxels.VoxelsMetadata.create_default_metadata( data.shape, data.dtype, "cxyzt", 1.0, "" )
+        with H5MockServerDataFile( self.test_filepath ) as test_h5file:
+            test_h5file.add_node( "datasetA", "abcde" )
+            test_h5file.add_volume( "datasetA", "vol", data, metadata )
+
+        # Partial chunks along y and z cost some padding, but not much.
+        file_size = os.path.getsize( self.test_filepath )
+        assert file_size < 1.5 * data.nbytes, \
+            "File is {} bytes for {} bytes of data".format( file_size, data.nbytes )
+
+    def test_volume_layout(self):
+        data = numpy.random.randint( 0, 255, size=(2, 100, 50, 40) ).astype( numpy.uint8 )
+        metadata = voxels.VoxelsMetadata.create_default_metadata( data.shape, data.dtype, "cxyz", 1.0, "" )
+        with H5MockServerDataFile( self.test_filepath, block_size=16, h5_compression='gzip' ) as test_h5file:
+            test_h5file.add_node( "datasetA", "abcde" )
+            test_h5file.add_volume( "datasetA", "vol", data, metadata )
+
+        with h5py.File( self.test_filepath, 'r' ) as f:
+            dset = f['/all_nodes/abcde/vol']
+            assert dset.chunks == (2, 16, 16, 16)
+            assert dset.compression == 'gzip'
+            assert dset.maxshape == (None, None, None, None)
+            assert (dset[:] == data).all()
+
+if __name__ == "__main__":
+    import sys
+    import nose
+    sys.argv.append("--nocapture")    # Don't steal stdout.  Show it on the console as usual.
+    sys.argv.append("--nologcapture") # Don't set the logging level to DEBUG.  Leave it alone.
+    nose.run(defaultTest=__file__)
@@ -0,0 +1,75 @@
+import os
+import sys
+import json
+import subprocess
+
+# The package's parent directory, so the subprocesses import this copy of pydvid.
+_REPO_DIR = os.path.split( os.path.dirname( os.path.abspath(__file__) ) )[0]
+
+# Modules that are slow to import, and must not be imported unless they are actually needed.
+HEAVY_MODULES = ['numpy', 'h5py', 'vigra', 'jsonschema']
+
+class TestImportTime(object):
+    """
+    Guards against regressions in the time needed to import pydvid.
+    Each import is measured in a fresh interpreter.
+    """
+
+    # Generous, to avoid spurious failures on a busy machine.
+    # (Importing the full package with its dependencies takes several times longer than importing keyvalue.)
+    MAX_KEYVALUE_IMPORT_SECONDS = 0.25
+    NUM_RUNS = 3
+
+    def _import_in_subprocess(self, statement):
+        """
+        Execute the given import statement in a new interpreter.
+        Returns the time it took, and the set of modules that were loaded.
+        """
+        script = ( "import sys, time, json\n"
+                   "start = time.time()\n"
+                   "{statement}\n"
+                   "duration = time.time() - start\n"
+                   "sys.stdout.write( json.dumps( [duration, sorted(sys.modules.keys())] ) )\n"
+                   "".format( statement=statement ) )
+        output = subprocess.check_output( [sys.executable, "-c", script], cwd=_REPO_DIR )
+        duration, modules = json.loads( output )
+        return duration, set(modules)
+
+    def test_package_import_is_lazy(self):
+        _, modules = self._import_in_subprocess( "import pydvid" )
+        loaded = [ m for m in HEAVY_MODULES + ['pydvid.voxels', 'pydvid.keyvalue'] if m in modules ]
+        assert not loaded, "Importing pydvid also imported: {}".format( loaded )
+
+    def test_keyvalue_import(self):
+        _, modules = self._import_in_subprocess( "import pydvid.keyvalue" )
+        loaded = [ m for m in HEAVY_MODULES + ['pydvid.voxels'] if m in modules ]
+        assert not loaded, "Importing pydvid.keyvalue also imported: {}".format( loaded )
+
+    def test_voxels_import(self):
+        # numpy is required by voxels, but the optional dependencies are loaded on first use.
+        _, modules = self._import_in_subprocess( "import pydvid.voxels" )
+        loaded = [ m for m in ['h5py', 'vigra', 'jsonschema'] if m in modules ]
+        assert not loaded, "Importing pydvid.voxels also imported: {}".format( loaded )
+
+    def test_schema_is_parsed_lazily(self):
+        _, modules = self._import_in_subprocess( "import pydvid.voxels, pydvid.util\n"
+                                                 "assert not pydvid.util._schemas, 'Schema was parsed on import'" )
+        assert 'pydvid.voxels.voxels_metadata' in modules
+
+    def test_keyvalue_import_time(self):
+        duration = min( self._import_in_subprocess( "import pydvid.keyvalue" )[0] for _ in range(self.NUM_RUNS) )
+        assert duration < self.MAX_KEYVALUE_IMPORT_SECONDS, \
+            "Importing pydvid.keyvalue took {:.3f} seconds (limit: {} seconds)"\
+            "".format( duration, self.MAX_KEYVALUE_IMPORT_SECONDS )
+
+    def test_lazy_attribute_access(self):
+        _, modules = self._import_in_subprocess( "import pydvid; pydvid.voxels.VoxelsAccessor" )
+        assert 'pydvid.voxels' in modules
+        assert 'pydvid.keyvalue' not in modules
+
+if __name__ == "__main__":
+    import sys
+    import nose
+    sys.argv.append("--nocapture")    # Don't steal stdout.  Show it on the console as usual.
+    sys.argv.append("--nologcapture") # Don't set the logging level to DEBUG.  Leave it alone.
+    nose.run(defaultTest=__file__)
@@ -1,4 +1,5 @@
 import os
+import io
 import shutil
 import tempfile
 import httplib
@@ -6,6 +7,8 @@ import httplib
 import h5py
 
 from pydvid import keyvalue
+from pydvid.errors import DvidHttpError
+from pydvid.dvid_connection import DvidConnection
 from mockserver.h5mockserver import H5MockServer, H5MockServerDataFile
 
 class TestKeyValue(object):
@@ -81,6 +84,72 @@ class TestKeyValue(object):
         value = keyvalue.get_value( self.client_connection, self.data_uuid, self.data_name, 'key_abc' )
         assert value == 'abcdefghijklmnopqrstuvwxyz'
 
+    def test_batch(self):
+        data_name = "batch_keyvalue_stuff"
+        keyvalue.create_new( self.client_connection, self.data_uuid, data_name )
+        connection = DvidConnection( "localhost:8000" )
+
+        mapping = { 'key_{}'.format(i) : 'value_{}'.format(i) for i in range(20) }
+        errors = keyvalue.put_values( connection, self.data_uuid, data_name, mapping, num_threads=4 )
+        assert errors == {}
+
+        # Missing keys are reported individually, without aborting the batch.
+        keys = mapping.keys() + ['missing_key']
+        values, errors = keyvalue.get_values( connection, self.data_uuid, data_name, keys, num_threads=4 )
+        assert values == mapping
+        assert errors.keys() == ['missing_key']
+        assert isinstance( errors['missing_key'], DvidHttpError )
+
+        # Serial iteration with a plain HTTPConnection
+        results = list( keyvalue.iter_values( self.client_connection, self.data_uuid, data_name, ['key_1', 'key_2'], num_threads=1 ) )
+        assert results == [ ('key_1', 'value_1', None), ('key_2', 'value_2', None) ]
+        connection.close()
+
+    def test_stream_file(self):
+        data_name = "file_keyvalue_stuff"
+        keyvalue.create_new( self.client_connection, self.data_uuid, data_name )
+        # (The mock server stores values as strings, so avoid NUL bytes.)
+        value = ''.join( chr( 32 + (i*7919) % 95 ) for i in range( 100*1000 + 7 ) )
+        src_path = os.path.join( self._tmp_dir, "value_src.bin" )
+        dst_path = os.path.join( self._tmp_dir, "value_dst.bin" )
+        with open( src_path, 'wb' ) as f:
+            f.write( value )
+
+        progress = []
+        keyvalue.put_value_from_file( self.client_connection, self.data_uuid, data_name, 'big_key', src_path,
+                                      buffer_size=4096, progress_callback=lambda *args: progress.append(args) )
+        assert progress[-1] == (len(value), len(value))
+        assert len(progress) == len(value) // 4096 + 1
+
+        del progress[:]
+        nbytes = keyvalue.get_value_to_file( self.client_connection, self.data_uuid, data_name, 'big_key', dst_path,
+                                             buffer_size=4096, progress_callback=lambda *args: progress.append(args) )
+        assert nbytes == len(value)
+        assert progress[-1] == (len(value), len(value))
+        with open( dst_path, 'rb' ) as f:
+            assert f.read() == value
+
+        # File-like objects work, too
+        keyvalue.put_value_from_file( self.client_connection, self.data_uuid, data_name, 'small_key', io.BytesIO('abcdef') )
+        out = io.BytesIO()
+        keyvalue.get_value_to_file( self.client_connection, self.data_uuid, data_name, 'small_key', out )
+        assert out.getvalue() == 'abcdef'
+
+        # If the file grows while it is being sent, only the original size is sent.
+        class GrowingFile(io.BytesIO):
+            def readinto(self, b):
+                position = self.tell()
+                self.seek( 0, os.SEEK_END )
+                self.write( 'ghi' )
+                self.seek( position )
+                return io.BytesIO.readinto(self, b)
+
+        del progress[:]
+        keyvalue.put_value_from_file( self.client_connection, self.data_uuid, data_name, 'small_key', GrowingFile('abcdef'),
+                                      progress_callback=lambda *args: progress.append(args) )
+        assert progress == [ (6, 6) ]
+        assert keyvalue.get_value( self.client_connection, self.data_uuid, data_name, 'small_key' ) == 'abcdef'
+
 if __name__ == "__main__":
     import sys
     import nose
@@ -0,0 +1,249 @@
+import os
+import shutil
+import tempfile
+import time
+import httplib
+import threading
+
+import numpy
+
+from pydvid import general, keyvalue, voxels
+from pydvid.nonblocking import NonBlockingClient, _Exchange, _PendingResult
+from mockserver.h5mockserver import H5MockServer, H5MockServerDataFile, H5CutoutRequestHandler
+
+class TestNonBlockingClient(object):
+
+    @classmethod
+    def setupClass(cls):
+        """
+        Override.  Called by nosetests.
+        - Create an hdf5 file to store the test data
+        - Start the mock server, which serves the test data from the file.
+        """
+        cls._tmp_dir = tempfile.mkdtemp()
+        cls.test_filepath = os.path.join( cls._tmp_dir, "test_data.h5" )
+        cls._generate_testdata_h5(cls.test_filepath)
+        cls.server_proc, cls.shutdown_event = cls._start_mockserver( cls.test_filepath, same_process=True )
+        cls.client_connection = httplib.HTTPConnection( "localhost:8000" )
+
+    @classmethod
+    def teardownClass(cls):
+        """
+        Override.  Called by nosetests.
+        """
+        shutil.rmtree(cls._tmp_dir)
+        cls.shutdown_event.set()
+        cls.server_proc.join()
+
+    @classmethod
+    def _generate_testdata_h5(cls, test_filepath):
+        """
+        Generate a temporary hdf5 file for the mock server to use (and us to compare against)
+        """
+        data = numpy.indices( (10, 100, 200) ).astype( numpy.uint8 )
+        cls.original_data = data
+        cls.data_uuid = "abcde"
+        cls.data_name = "indices_data"
+        cls.keyvalue_name = "my_keyvalue_stuff"
+        cls.voxels_metadata = voxels.VoxelsMetadata.create_default_metadata(data.shape, data.dtype, "cxyz", 1.0, "")
+
+        with H5MockServerDataFile( test_filepath ) as test_h5file:
+            test_h5file.add_node( "datasetA", cls.data_uuid )
+            test_h5file.add_volume( "datasetA", cls.data_name, data, cls.voxels_metadata )
+
+    @classmethod
+    def _start_mockserver(cls, h5filepath, same_process=False, disable_server_logging=True):
+        """
+        Start the mock DVID server in a separate process.
+
+        h5filepath: The file to serve up.
+        same_process: If True, start the server in this process as a
+                      separate thread (useful for debugging).
+                      Otherwise, start the server in its own process (default).
+        disable_server_logging: If true, disable the normal HttpServer logging of every request.
+
+        The server is threaded, so it keeps connections alive between requests.
+        """
+        return H5MockServer.create_and_start( h5filepath, "localhost", 8000, same_process, disable_server_logging, threaded=True )
+
+    def test_get_ndarray(self):
+        with NonBlockingClient( "localhost:8000", max_concurrency=4 ) as client:
+            metadata = client.get_metadata( self.data_uuid, self.data_name ).get()
+            assert metadata.shape == self.original_data.shape
+
+            results = []
+            for x in range(10):
+                start, stop = (0, x, 0, 0), (3, x+1, 100, 200)
+                results.append( client.get_ndarray( self.data_uuid, self.data_name, metadata, start, stop ) )
+            for x, result in enumerate(results):
+                assert (result.get() == self.original_data[:, x:x+1]).all()
+
+    def test_keyvalue(self):
+        keyvalue.create_new( self.client_connection, self.data_uuid, self.keyvalue_name )
+        with NonBlockingClient( "localhost:8000", max_concurrency=4 ) as client:
+            puts = [ client.put_value( self.data_uuid, self.keyvalue_name, 'key_{}'.format(i), 'value_{}'.format(i) )
+                     for i in range(10) ]
+            for result in puts:
+                result.get()
+            gets = [ client.get_value( self.data_uuid, self.keyvalue_name, 'key_{}'.format(i) )
+                     for i in range(10) ]
+            assert [ result.get() for result in gets ] == [ 'value_{}'.format(i) for i in range(10) ]
+
+    def test_requests_share_one_thread(self):
+        """
+        The basic calls don't need a thread per request: they're all handled by the client's I/O thread.
+        (The server's own handler threads run in this process too, so only the client's threads are counted.)
+        """
+        def client_threads():
+            return [ t for t in threading.enumerate() if t.name.startswith( "DVID request loop" ) ]
+        keyvalue_name = "fan_out_keyvalue"
+        keyvalue.create_new( self.client_connection, self.data_uuid, keyvalue_name )
+        with NonBlockingClient( "localhost:8000", max_concurrency=8 ) as client:
+            puts = [ client.put_value( self.data_uuid, keyvalue_name, 'key_{}'.format(i), 'value_{}'.format(i) )
+                     for i in range(100) ]
+            gets = []
+            for i, result in enumerate(puts):
+                result.get()
+                gets.append( client.get_value( self.data_uuid, keyvalue_name, 'key_{}'.format(i) ) )
+            assert len( client_threads() ) == 1 and client._thread_pool is None
+            assert [ result.get() for result in gets ] == [ 'value_{}'.format(i) for i in range(100) ]
+
+            # Same for volume data (and server info).
+            metadata = client.get_metadata( self.data_uuid, self.data_name ).get()
+            received = []
+            info = client.get_server_info( callback=received.append ).get()
+            assert received == [info]
+            results = [ client.get_ndarray( self.data_uuid, self.data_name, metadata, (0, x, 0, 0), (3, x+1, 100, 200) )
+                        for x in range(10) ]
+            for x, result in enumerate(results):
+                assert (result.get() == self.original_data[:, x:x+1]).all()
+            assert len( client_threads() ) == 1 and client._thread_pool is None
+        assert not client_threads()
+
+    def test_idle_connections_closed_by_server(self):
+        """
+        The I/O thread keeps connections alive, and copes with the server closing them while they're idle.
+        """
+        num_connections = [0]
+        original_finish_request = H5MockServer.finish_request
+        def counting_finish_request( server, *args ):
+            num_connections[0] += 1
+            return original_finish_request( server, *args )
+
+        original_timeout = H5CutoutRequestHandler.timeout
+        H5CutoutRequestHandler.timeout = 0.2
+        H5MockServer.finish_request = counting_finish_request
+        try:
+            with NonBlockingClient( "localhost:8000", max_concurrency=4 ) as client:
+                for _ in range(3):
+                    results = [ client.get_server_info() for _ in range(8) ]
+                    assert all( "Cores" in result.get() for result in results )
+                    # Give the server time to close the idle connections.
+                    time.sleep( 0.5 )
+        finally:
+            H5MockServer.finish_request = original_finish_request
+            H5CutoutRequestHandler.timeout = original_timeout
+
+        # Each batch needed at most max_concurrency connections.
+        assert num_connections[0] <= 3*4, num_connections[0]
+
+    def test_chunked_response_framing(self):
+        """
+        The end of a chunked response is found, no matter how the data arrives.
+        """
+        response_data = ( "HTTP/1.1 200 OK\r\nTransfer-Encoding: chunked\r\n\r\n"
+                          "5\r\nhello\r\n7;ext=1\r\n, world\r\n0\r\nX-Trailer: 1\r\n\r\n" )
+        for piece_size in [1, 2, 3, 7, len(response_data)]:
+            exchange = _Exchange( "localhost", "GET", "/", {}, [], None, _PendingResult() )
+            exchange.start( reused_socket=False )
+            pieces = [ response_data[i:i+piece_size] for i in range(0, len(response_data), piece_size) ]
+            complete = [ exchange.receive( piece ) for piece in pieces ]
+            assert complete[-1] and not any( complete[:-1] ), "Wrong framing with piece size {}".format( piece_size )
+            assert not exchange.extra_bytes
+            assert exchange.get_response().read() == "hello, world"
+
+    def test_errors_are_reraised(self):
+        with NonBlockingClient( "localhost:8000" ) as client:
+            result = client.get_metadata( self.data_uuid, "no_such_data" )
+            try:
+                result.get()
+            except Exception:
+                pass
+            else:
+                assert False, "Expected the error to be re-raised by get()"
+
+    def test_accessor(self):
+        with NonBlockingClient( "localhost:8000", max_concurrency=4 ) as client:
+            v = client.voxels_accessor( self.data_uuid, self.data_name )
+            pending = [ v[:, 3, 10:20, z] for z in range(5) ]
+            for z, result in enumerate(pending):
+                assert (result.get() == self.original_data[:, 3, 10:20, z]).all()
+
+            # Write, then read back
+            new_data = numpy.ones( (3,2,2,2), dtype=numpy.uint8 )
+            v.post_ndarray( (0,0,0,0), (3,2,2,2), new_data ).get()
+            assert (v.get_ndarray( (0,0,0,0), (3,2,2,2) ).get() == 1).all()
+            v[:, 0:2, 0:2, 0:2] = self.original_data[:, 0:2, 0:2, 0:2]
+            assert (v[:, 0:2, 0:2, 0:2].get() == self.original_data[:, 0:2, 0:2, 0:2]).all()
+
+    def test_accessor_iter_blocks(self):
+        """
+        iter_blocks() yields the data itself, not AsyncResults.
+        """
+        with NonBlockingClient( "localhost:8000", max_concurrency=2 ) as client:
+            v = client.voxels_accessor( self.data_uuid, self.data_name )
+            for prefetch in [0, 2]:
+                num_blocks = 0
+                for start, stop, block in v.iter_blocks( block_shape=(32,32,64), prefetch=prefetch ):
+                    assert isinstance( block, numpy.ndarray )
+                    assert (block == self.original_data[ tuple( slice(*b) for b in zip(start, stop) ) ]).all()
+                    num_blocks += 1
+                assert num_blocks == 1*4*4
+
+    def test_accessor_settings(self):
+        """
+        The blocking methods use the accessor's state, including settings that were changed later on.
+        """
+        with NonBlockingClient( "localhost:8000", max_concurrency=2 ) as client:
+            v = client.voxels_accessor( self.data_uuid, self.data_name )
+            v.STRIDED_REQUEST_COST_BYTES = 1
+            assert v._blocking.STRIDED_REQUEST_COST_BYTES == 1
+            assert v._blocking.shape == v.shape
+            assert voxels.VoxelsAccessor.STRIDED_REQUEST_COST_BYTES != 1
+
+            # Attributes set by the blocking methods are stored in the accessor.
+            v._blocking.voxels_metadata = v.voxels_metadata
+            assert v._blocking.__dict__.keys() == ['_accessor']
+            assert (v[:, 3, 10:20:3, 0:5:2].get() == self.original_data[:, 3, 10:20:3, 0:5:2]).all()
+
+    def test_accessor_after_all_workers_are_busy(self):
+        """
+        Once every worker has used a connection, the accessor can still be created.
+        (Workers return their connections to the pool after each request.)
+        """
+        with NonBlockingClient( "localhost:8000", max_concurrency=2 ) as client:
+            client.connection.checkout_timeout = 5.0
+
+            # Make sure both workers send a request.
+            started = []
+            all_started = threading.Event()
+            def occupy_worker( connection ):
+                general.get_server_info( connection )
+                started.append( threading.current_thread() )
+                if len(started) == 2:
+                    all_started.set()
+                all_started.wait( 5.0 )
+            for result in [ client.submit( occupy_worker ) for _ in range(2) ]:
+                result.get()
+            assert client.connection.pool.num_checked_out == 0
+
+            v = client.voxels_accessor( self.data_uuid, self.data_name )
+            assert v.shape == self.original_data.shape
+            assert (v[:, 3, 10:20, 0].get() == self.original_data[:, 3, 10:20, 0]).all()
+
+if __name__ == "__main__":
+    import sys
+    import nose
+    sys.argv.append("--nocapture")    # Don't steal stdout.  Show it on the console as usual.
+    sys.argv.append("--nologcapture") # Don't set the logging level to DEBUG.  Leave it alone.
+    nose.run(defaultTest=__file__)
@@ -0,0 +1,51 @@
+import jsonschema
+
+from pydvid import util
+
+class TestSchemaValidation(object):
+
+    def teardown(self):
+        util.set_schema_validation( 1.0 )
+
+    def test_validators_are_cached(self):
+        schema_name = 'dvid-server-info-v0.01.schema.json'
+        assert util.get_schema( schema_name ) is util.get_schema( schema_name )
+        assert util.get_validator( schema_name ) is util.get_validator( schema_name )
+        assert util.get_schema( schema_name ) == util.parse_schema( schema_name )
+
+    def test_metadata_schema_attribute(self):
+        # Still available for backwards compatibility.
+        from pydvid.voxels import voxels_metadata
+        schema_name = 'dvid-voxels-metadata-v0.01.schema.json'
+        assert voxels_metadata.metadata_schema is util.get_schema( schema_name )
+
+    def test_validation_switch(self):
+        schema_name = 'dvid-voxels-metadata-v0.01.schema.json'
+        invalid_metadata = { "Axes" : "not a list" }
+        try:
+            util.validate_json( invalid_metadata, schema_name )
+        except jsonschema.ValidationError:
+            pass
+        else:
+            assert False, "Expected a ValidationError"
+
+        # Disabled: no error
+        util.set_schema_validation( False )
+        util.validate_json( invalid_metadata, schema_name )
+
+        # Sampled: some payloads are checked, others aren't.
+        util.set_schema_validation( 0.5 )
+        num_errors = 0
+        for _ in range(100):
+            try:
+                util.validate_json( invalid_metadata, schema_name )
+            except jsonschema.ValidationError:
+                num_errors += 1
+        assert 0 < num_errors < 100
+
+if __name__ == "__main__":
+    import sys
+    import nose
+    sys.argv.append("--nocapture")    # Don't steal stdout.  Show it on the console as usual.
+    sys.argv.append("--nologcapture") # Don't set the logging level to DEBUG.  Leave it alone.
+    nose.run(defaultTest=__file__)
@@ -1,4 +1,6 @@
 import os
+import sys
+import socket
 import shutil
 import tempfile
 import httplib
@@ -7,7 +9,20 @@ import numpy
 import h5py
 
 from pydvid import voxels
-from mockserver.h5mockserver import H5MockServer, H5MockServerDataFile
+from pydvid.dvid_connection import DvidConnection
+from mockserver.h5mockserver import H5MockServer, H5MockServerDataFile, H5CutoutRequestHandler
+
+class RecordingConnection(httplib.HTTPConnection):
+    """
+    An HTTPConnection that remembers the uris of all requests sent through it.
+    """
+    def __init__(self, *args, **kwargs):
+        httplib.HTTPConnection.__init__(self, *args, **kwargs)
+        self.requested_uris = []
+
+    def request(self, method, url, *args, **kwargs):
+        self.requested_uris.append( url )
+        httplib.HTTPConnection.request(self, method, url, *args, **kwargs)
 
 class TestVoxelsAccessor(object):
     
@@ -100,6 +115,214 @@ class TestVoxelsAccessor(object):
         # Compare to file
         self._check_subvolume(self.test_filepath, self.data_uuid, self.data_name, start, stop, subvolume)
      
+    def test_get_ndarray_tiled(self):
+        """
+        Get some data from the server in several concurrent block-aligned tiles and check it.
+        """
+        start, stop = (0,1,5,40,0), (4,10,100,200,3)
+        connection = DvidConnection( "localhost:8000" )
+        try:
+            subvolume = voxels.get_ndarray_tiled( connection, self.data_uuid, self.data_name, self.voxels_metadata,
+                                                  start, stop, tile_shape=(32,32,32,32), num_threads=4 )
+        finally:
+            connection.close()
+        assert subvolume.flags['F_CONTIGUOUS']
+        self._check_subvolume(self.test_filepath, self.data_uuid, self.data_name, start, stop, subvolume)
+
+    def test_get_ndarray_tiled_accessor(self):
+        start, stop = (0,1,5,40,0), (4,10,100,200,3)
+        connection = DvidConnection( "localhost:8000", max_size=32, checkout_timeout=5.0 )
+        try:
+            with voxels.VoxelsAccessor( connection, self.data_uuid, self.data_name, num_threads=3, tile_shape=(32,32,64,32) ) as dvid_vol:
+                subvolume = dvid_vol.get_ndarray( start, stop )
+                self._check_subvolume(self.test_filepath, self.data_uuid, self.data_name, start, stop, subvolume)
+
+                # Slicing uses the same tiled requests
+                subvolume = dvid_vol[:, 1:10, 5:100, 40:200, :]
+                self._check_subvolume(self.test_filepath, self.data_uuid, self.data_name, start, stop, subvolume)
+
+            # Closing the accessor returns its threads' connections to the pool.
+            # (Only this thread's connection is still checked out.)
+            assert connection.pool.num_checked_out == 1
+
+            # Many short-lived accessors don't exhaust the pool (of 32 connections).
+            for _ in range(12):
+                with voxels.VoxelsAccessor( connection, self.data_uuid, self.data_name, num_threads=3, tile_shape=(32,32,64,32) ) as dvid_vol:
+                    dvid_vol.get_ndarray( start, stop )
+            assert connection.pool.num_checked_out == 1
+        finally:
+            connection.close()
+
+    def test_get_ndarray_into_out(self):
+        """
+        Decode the data into a view of a caller-provided array.
+        """
+        start, stop = (0,9,5,50,0), (4,10,20,150,3)
+        shape = tuple( numpy.subtract(stop, start) )
+        big_array = numpy.zeros( (4,3,30,120,3), dtype=numpy.uint32, order='F' )
+        out = big_array[:, 1:2, 5:20, 10:110, :]
+
+        dvid_vol = voxels.VoxelsAccessor( self.client_connection, self.data_uuid, self.data_name )
+        subvolume = dvid_vol.get_ndarray( start, stop, out=out )
+        assert subvolume is out
+        assert out.shape == shape
+        self._check_subvolume(self.test_filepath, self.data_uuid, self.data_name, start, stop, out)
+        assert (big_array[:, 0] == 0).all()
+
+    def test_get_ndarray_channel_subset(self):
+        """
+        Only the requested channels are returned (and stored) by get_ndarray().
+        """
+        start, stop = (2,9,5,50,0), (3,10,20,150,3)
+        dvid_vol = voxels.VoxelsAccessor( self.client_connection, self.data_uuid, self.data_name )
+        subvolume = dvid_vol.get_ndarray( start, stop )
+        assert subvolume.shape == (1,1,15,100,3)
+        self._check_subvolume(self.test_filepath, self.data_uuid, self.data_name, start, stop, subvolume)
+
+        # Also with a non-contiguous out array
+        big_array = numpy.zeros( (1,3,30,120,3), dtype=numpy.uint32, order='F' )
+        out = big_array[:, 1:2, 5:20, 10:110, :]
+        dvid_vol.get_ndarray( start, stop, out=out )
+        self._check_subvolume(self.test_filepath, self.data_uuid, self.data_name, start, stop, out)
+
+    def test_get_ndarray_pipelined(self):
+        start, stop = (0,9,5,50,0), (4,10,20,150,3)
+        dvid_vol = voxels.VoxelsAccessor( self.client_connection, self.data_uuid, self.data_name, pipelined=True )
+        subvolume = dvid_vol.get_ndarray( start, stop )
+        self._check_subvolume(self.test_filepath, self.data_uuid, self.data_name, start, stop, subvolume)
+
+    def test_get_sliced_into_out(self):
+        dvid_vol = voxels.VoxelsAccessor( self.client_connection, self.data_uuid, self.data_name )
+
+        # Dense slicing (with a dropped axis): decoded directly into out
+        out = numpy.zeros( (4,1,200,3), dtype=numpy.uint32 )
+        result = dvid_vol.get_sliced( numpy.s_[0:4, 9:10, 3, :, :], out=out )
+        assert result is out
+        start, stop = (0,9,3,0,0), (4,10,4,200,3)
+        self._check_subvolume(self.test_filepath, self.data_uuid, self.data_name, start, stop, out[:,:,numpy.newaxis])
+
+        # Stepped slicing: retrieved and copied into out
+        out = numpy.zeros( (2,3,3,10,3), dtype=numpy.uint32 )
+        dvid_vol.get_sliced( numpy.s_[0:4:2, 1:10:3, 5:20:5, 50:150:10], out=out )
+        stored_volume = self._get_subvolume_from_file(self.test_filepath, self.data_uuid, self.data_name, 
+                                                      (0,)*5, self.original_data.shape)
+        assert (out == stored_volume[0:4:2, 1:10:3, 5:20:5, 50:150:10]).all()
+
+    def test_block_cache(self):
+        """
+        Reads are served from the block cache, which is invalidated by writes through the same accessor.
+        """
+        cache = voxels.BlockCache( max_bytes=100*1024**2 )
+        cached_vol = voxels.VoxelsAccessor( self.client_connection, self.data_uuid, self.data_name, block_cache=cache )
+        start, stop = (0,0,30,40,0), (4,3,70,80,2)
+        original_subvolume = cached_vol.get_ndarray( start, stop )
+        self._check_subvolume(self.test_filepath, self.data_uuid, self.data_name, start, stop, original_subvolume)
+        assert len(cache) == 3*2
+
+        # Overlapping read with a different shape is served from the cache (and is correct).
+        subvolume = cached_vol[:, 1:2, 40:60, 50:70, 1]
+        assert (subvolume == original_subvolume[:, 1:2, 10:30, 10:30, 1]).all()
+
+        # Modify the data behind the cache's back: the cached accessor doesn't see it.
+        uncached_vol = voxels.VoxelsAccessor( self.client_connection, self.data_uuid, self.data_name )
+        new_data = numpy.random.randint( 0,1000, (4,1,10,10,1) ).astype( numpy.uint32 )
+        uncached_vol.post_ndarray( (0,1,40,50,1), (4,2,50,60,2), new_data )
+        subvolume = cached_vol.get_ndarray( start, stop )
+        assert (subvolume == original_subvolume).all()
+
+        # Writing through the cached accessor invalidates the affected blocks.
+        cached_vol.post_ndarray( (0,1,40,50,1), (4,2,50,60,2), new_data )
+        assert len(cache) == 3*2 - 1
+        subvolume = cached_vol.get_ndarray( start, stop )
+        self._check_subvolume(self.test_filepath, self.data_uuid, self.data_name, start, stop, subvolume)
+        assert (subvolume[:, 1:2, 10:20, 10:20, 1:2] == new_data).all()
+
+    def test_block_cache_fetches_only_missing_blocks(self):
+        """
+        Only the blocks that aren't in the cache are requested, even if they are far apart.
+        """
+        connection = RecordingConnection( "localhost:8000" )
+        cache = voxels.BlockCache( max_bytes=100*1024**2 )
+        cached_vol = voxels.VoxelsAccessor( connection, self.data_uuid, self.data_name, block_cache=cache )
+        start, stop = (0,0,0,0,0), (4,10,64,64,3)
+        cached_vol.get_ndarray( start, stop )
+        assert len(cache) == 4
+
+        # Remove two opposite corners of the roi from the cache.
+        cache.invalidate( self.data_uuid, self.data_name, [(0,0,0,0), (0,1,1,0)] )
+        connection.requested_uris = []
+        subvolume = cached_vol.get_ndarray( start, stop )
+        assert connection.requested_uris == [ "/api/node/abcde/indices_data/raw/0_1_2_3/10_32_32_3/0_0_0_0",
+                                              "/api/node/abcde/indices_data/raw/0_1_2_3/10_32_32_3/0_32_32_0" ]
+        self._check_subvolume(self.test_filepath, self.data_uuid, self.data_name, start, stop, subvolume)
+        assert len(cache) == 4
+
+    def test_disk_block_cache(self):
+        """
+        Blocks stored in a disk cache are re-used by other accessors (and caches) later on.
+        """
+        cache_dir = os.path.join( self._tmp_dir, 'block_cache' )
+        start, stop = (0,0,70,120,0), (4,3,90,150,2)
+        cached_vol = voxels.VoxelsAccessor( self.client_connection, self.data_uuid, self.data_name, 
+                                            block_cache=voxels.DiskBlockCache( cache_dir, 10*1024**2, requires_locked_node=False ) )
+        original_subvolume = cached_vol.get_ndarray( start, stop )
+        self._check_subvolume(self.test_filepath, self.data_uuid, self.data_name, start, stop, original_subvolume)
+
+        # Modify the data on the server, and read via a new (in-memory) cache backed by the same directory.
+        uncached_vol = voxels.VoxelsAccessor( self.client_connection, self.data_uuid, self.data_name )
+        new_data = numpy.random.randint( 0,1000, (4,1,10,10,1) ).astype( numpy.uint32 )
+        uncached_vol.post_ndarray( (0,1,75,125,1), (4,2,85,135,2), new_data )
+
+        cache = voxels.BlockCache( 1024**2, voxels.DiskBlockCache( cache_dir, 10*1024**2, requires_locked_node=False ) )
+        cached_vol2 = voxels.VoxelsAccessor( self.client_connection, self.data_uuid, self.data_name, block_cache=cache )
+        subvolume = cached_vol2.get_ndarray( start, stop )
+        assert (subvolume == original_subvolume).all()
+
+        # The mock server's nodes are never locked, so this is not permitted by default.
+        try:
+            voxels.VoxelsAccessor( self.client_connection, self.data_uuid, self.data_name, 
+                                   block_cache=voxels.DiskBlockCache( cache_dir, 10*1024**2 ) )
+        except AssertionError:
+            pass
+        else:
+            assert False, "Expected an AssertionError for an unlocked node."
+
+    def test_block_aligned_tiles(self):
+        tiles = voxels.voxels._block_aligned_tiles( (0,10,0), (2,70,40), (32,32) )
+        assert tiles == [ ((0,10,0), (2,32,32)),
+                          ((0,32,0), (2,64,32)),
+                          ((0,64,0), (2,70,32)),
+                          ((0,10,32), (2,32,40)),
+                          ((0,32,32), (2,64,40)),
+                          ((0,64,32), (2,70,40)) ], tiles
+
+        tiles = voxels.voxels._block_aligned_tiles( (0,10,0), (2,70,40), (32,32), order='C' )
+        assert tiles == [ ((0,10,0), (2,32,32)),
+                          ((0,10,32), (2,32,40)),
+                          ((0,32,0), (2,64,32)),
+                          ((0,32,32), (2,64,40)),
+                          ((0,64,0), (2,70,32)),
+                          ((0,64,32), (2,70,40)) ], tiles
+
+    def test_iter_blocks(self):
+        connection = DvidConnection( "localhost:8000" )
+        dvid_vol = voxels.VoxelsAccessor( connection, self.data_uuid, self.data_name )
+        start, stop = (0,2,10,20,0), (4,9,70,150,3)
+        expected_chunks = voxels.voxels._block_aligned_tiles( start, stop, (32,32,64,32), order='C' )
+
+        for prefetch in (0, 2):
+            chunks = []
+            for chunk_start, chunk_stop, block in dvid_vol.iter_blocks( (start, stop), (32,32,64,32), 'C', prefetch ):
+                assert block.shape == tuple( numpy.subtract( chunk_stop, chunk_start ) )
+                self._check_subvolume(self.test_filepath, self.data_uuid, self.data_name, chunk_start, chunk_stop, block)
+                chunks.append( (chunk_start, chunk_stop) )
+            assert chunks == expected_chunks
+
+        # Stopping early is okay.
+        for _ in dvid_vol.iter_blocks( block_shape=(32,32,32,32) ):
+            break
+        connection.close()
+
     def _test_retrieve_volume(self, h5filename, uuid, data_name, start, stop):
         """
         h5filename: The h5 file to compare against
@@ -126,6 +349,135 @@ class TestVoxelsAccessor(object):
         # Check file
         self._check_subvolume(self.test_filepath, self.data_uuid, self.data_name, start, stop, subvolume)        
  
+    def test_post_ndarray_bad_data(self):
+        """
+        Data that doesn't match the roi is rejected before anything is sent,
+        and a failure while sending closes the connection, so it remains usable.
+        """
+        connection = httplib.HTTPConnection( "localhost:8000" )
+        metadata = voxels.get_metadata( connection, self.data_uuid, self.data_name )
+        start, stop = (0,9,5,50,0), (4,10,20,150,3)
+        shape = tuple( numpy.subtract( stop, start ) )
+        for bad_data in [ numpy.zeros( shape, dtype=numpy.uint8 ),
+                          numpy.zeros( (2,1,15,100,6), dtype=numpy.uint32 ) ]:
+            try:
+                voxels.post_ndarray( connection, self.data_uuid, self.data_name, metadata, start, stop, bad_data )
+            except AssertionError:
+                pass
+            else:
+                assert False, "Expected an AssertionError for data with shape {} and dtype {}"\
+                              "".format( bad_data.shape, bad_data.dtype )
+            voxels.get_metadata( connection, self.data_uuid, self.data_name )
+
+        class FailingConnection(httplib.HTTPConnection):
+            def send(self, data):
+                if isinstance( data, buffer ):
+                    raise socket.error( "Simulated network failure" )
+                httplib.HTTPConnection.send(self, data)
+
+        # The server quietly drops the truncated request (no error response, no traceback).
+        server_errors = []
+        def record_send_error( handler, code, *args ):
+            server_errors.append( code )
+        def record_handle_error( server, request, client_address ):
+            server_errors.append( sys.exc_info()[1] )
+        original_send_error = H5CutoutRequestHandler.send_error
+        original_handle_error = H5MockServer.handle_error
+        H5CutoutRequestHandler.send_error = record_send_error
+        H5MockServer.handle_error = record_handle_error
+        try:
+            connection = FailingConnection( "localhost:8000" )
+            try:
+                voxels.post_ndarray( connection, self.data_uuid, self.data_name, metadata, start, stop, 
+                                     numpy.zeros( shape, dtype=numpy.uint32 ) )
+            except socket.error:
+                pass
+            else:
+                assert False, "Expected a socket.error"
+            assert connection.sock is None
+            voxels.get_metadata( connection, self.data_uuid, self.data_name )
+        finally:
+            H5CutoutRequestHandler.send_error = original_send_error
+            H5MockServer.handle_error = original_handle_error
+        assert not server_errors, server_errors
+
+    def test_compressed_transfer(self):
+        """
+        Write and read a subvolume with gzip compression.
+        """
+        start, stop = (0,9,5,50,0), (4,10,20,150,3)
+        shape = numpy.subtract( stop, start )
+        subvolume = numpy.random.randint( 0,10, shape ).astype( numpy.uint32 )
+
+        dvid_vol = voxels.VoxelsAccessor( self.client_connection, self.data_uuid, self.data_name, compression='gzip' )
+        dvid_vol.post_ndarray(start, stop, subvolume)
+        self._check_subvolume(self.test_filepath, self.data_uuid, self.data_name, start, stop, subvolume)
+
+        response = voxels.get_subvolume_response( self.client_connection, self.data_uuid, self.data_name, 
+                                                  start, stop, compression='gzip' )
+        assert response.getheader('Content-Encoding') == 'gzip'
+        response.read()
+
+        retrieved = dvid_vol.get_ndarray(start, stop)
+        assert (retrieved == subvolume).all()
+        retrieved = dvid_vol[1:3, 9, 5:20, 50:150]
+        assert (retrieved == subvolume[1:3, 0]).all()
+
+        # Receive in a background thread while decompressing.
+        dvid_vol = voxels.VoxelsAccessor( self.client_connection, self.data_uuid, self.data_name, 
+                                          compression='gzip', pipelined=True )
+        retrieved = dvid_vol[1:3, 9, 5:20, 50:150]
+        assert (retrieved == subvolume[1:3, 0]).all()
+
+    def test_post_ndarray_chunked(self):
+        start, stop = (0,2,10,20,0), (4,9,70,150,3)
+        shape = numpy.subtract( stop, start )
+        subvolume = numpy.random.randint( 0,1000, shape ).astype( numpy.uint32 )
+
+        connection = DvidConnection( "localhost:8000" )
+        with voxels.VoxelsAccessor( connection, self.data_uuid, self.data_name, 
+                                    num_threads=4, tile_shape=(32,32,64,32) ) as dvid_vol:
+            dvid_vol.post_ndarray(start, stop, subvolume)
+            self._check_subvolume(self.test_filepath, self.data_uuid, self.data_name, start, stop, subvolume)
+
+            # Slicing with an integer index drops that axis from the data
+            start, stop = (0,2,10,20,2), (4,9,70,150,3)
+            subvolume = numpy.random.randint( 0,1000, numpy.subtract( stop, start ) ).astype( numpy.uint32 )
+            dvid_vol[:, 2:9, 10:70, 20:150, 2] = subvolume[..., 0]
+            self._check_subvolume(self.test_filepath, self.data_uuid, self.data_name, start, stop, subvolume)
+        connection.close()
+
+    def test_post_ndarray_chunked_retry(self):
+        """
+        Pieces that fail with a transient error are retried individually.
+        """
+        start, stop = (0,2,10,20,0), (4,9,70,150,3)
+        shape = numpy.subtract( stop, start )
+        subvolume = numpy.random.randint( 0,1000, shape ).astype( numpy.uint32 )
+        metadata = voxels.get_metadata( self.client_connection, self.data_uuid, self.data_name )
+
+        original_post_ndarray = voxels.voxels.post_ndarray
+        original_retry_delay = voxels.voxels.UPLOAD_RETRY_DELAY
+        attempts = []
+        def flaky_post_ndarray( *args ):
+            attempts.append( args[4] )
+            if attempts.count( args[4] ) == 1:
+                raise socket.error( "Connection reset by peer" )
+            original_post_ndarray( *args )
+
+        voxels.voxels.post_ndarray = flaky_post_ndarray
+        voxels.voxels.UPLOAD_RETRY_DELAY = 0.0
+        try:
+            voxels.post_ndarray_chunked( self.client_connection, self.data_uuid, self.data_name, metadata,
+                                         start, stop, subvolume, (32,32,64,32), num_threads=1 )
+        finally:
+            voxels.voxels.post_ndarray = original_post_ndarray
+            voxels.voxels.UPLOAD_RETRY_DELAY = original_retry_delay
+
+        num_chunks = len( voxels.voxels._block_aligned_tiles( start, stop, (32,32,64,32) ) )
+        assert len(attempts) == 2*num_chunks
+        self._check_subvolume(self.test_filepath, self.data_uuid, self.data_name, start, stop, subvolume)
+
     def test_post_slicing(self):
         # Cutout dims
         start, stop = (0,9,5,50,0), (4,10,20,150,3)
@@ -229,6 +581,21 @@ class TestVoxelsAccessor(object):
         start, stop = (1,9,5,50,0), (3,10,20,150,3)
         self._check_subvolume(self.test_filepath, self.data_uuid, self.data_name, start, stop, subvolume)
 
+    def test_get_negative_channel_slicing(self):
+        """
+        Channels may be indexed from the end, as with numpy arrays.
+        """
+        dvid_vol = voxels.VoxelsAccessor( self.client_connection, self.data_uuid, self.data_name )
+        full_stored_volume = self._get_subvolume_from_file(self.test_filepath, self.data_uuid, self.data_name,
+                                                           (0,)*5, self.original_data.shape)
+        for slicing in [ numpy.s_[-1], numpy.s_[-2:], numpy.s_[-3:-1, 9:10, 5:20], numpy.s_[1:-1],
+                         numpy.s_[-1:-3], numpy.s_[::2] ]:
+            subvolume = dvid_vol[slicing]
+            expected = full_stored_volume[slicing]
+            assert subvolume.shape == expected.shape, \
+                "Wrong shape for {}: {} != {}".format( slicing, subvolume.shape, expected.shape )
+            assert (subvolume == expected).all()
+
     def test_get_stepped_slicing(self):
         """
         """
@@ -246,6 +613,78 @@ class TestVoxelsAccessor(object):
         assert subvolume.dtype == stored_stepped_volume.dtype
         assert (subvolume == stored_stepped_volume).all()
 
+    def test_metadata_cache(self):
+        class RecordingConnection(httplib.HTTPConnection):
+            def __init__(self, *args, **kwargs):
+                httplib.HTTPConnection.__init__(self, *args, **kwargs)
+                self.statuses = []
+            def getresponse(self, *args, **kwargs):
+                response = httplib.HTTPConnection.getresponse(self, *args, **kwargs)
+                self.statuses.append( response.status )
+                return response
+
+        connection = RecordingConnection( "localhost:8000" )
+        cache = voxels.MetadataCache( ttl=1000.0, trusted=True )
+        v1 = voxels.VoxelsAccessor( connection, self.data_uuid, self.data_name, metadata_cache=cache )
+        v2 = voxels.VoxelsAccessor( connection, self.data_uuid, self.data_name, metadata_cache=cache )
+        assert connection.statuses == [httplib.OK]
+        assert v1.voxels_metadata == v2.voxels_metadata
+        assert v1.voxels_metadata is not v2.voxels_metadata
+        assert v2.shape == self.original_data.shape
+
+        # Expired entries are re-validated with a conditional request.
+        cache.ttl = 0.0
+        v3 = voxels.VoxelsAccessor( connection, self.data_uuid, self.data_name, metadata_cache=cache )
+        assert connection.statuses == [httplib.OK, httplib.NOT_MODIFIED]
+        assert v3.shape == self.original_data.shape
+
+        # Invalidated entries are requested again.
+        cache.ttl = 1000.0
+        cache.invalidate( "localhost:8000", self.data_uuid )
+        assert len(cache) == 0
+        voxels.VoxelsAccessor( connection, self.data_uuid, self.data_name, metadata_cache=cache )
+        assert connection.statuses == [httplib.OK, httplib.NOT_MODIFIED, httplib.OK]
+        assert len(cache) == 1
+
+    def test_get_stepped_slicing_requests(self):
+        """
+        Stepped slicing only requests the selected planes along the most-stepped axes.
+        """
+        connection = RecordingConnection( "localhost:8000" )
+        dvid_vol = voxels.VoxelsAccessor( connection, self.data_uuid, self.data_name )
+        full_stored_volume = self._get_subvolume_from_file(self.test_filepath, self.data_uuid, self.data_name, 
+                                                           (0,)*5, self.original_data.shape)
+        stored_stepped_volume = full_stored_volume[:, 1:10:3, 5:20:5, 50:150:10, 1]
+
+        # This read is small, so splitting it isn't worth the extra requests.
+        connection.requested_uris = []
+        subvolume = dvid_vol[:, 1:10:3, 5:20:5, 50:150:10, 1]
+        assert len(connection.requested_uris) == 1
+        assert (subvolume == stored_stepped_volume).all()
+
+        # Pretend requests are cheap.
+        dvid_vol.STRIDED_REQUEST_COST_BYTES = 1000
+        connection.requested_uris = []
+        subvolume = dvid_vol[:, 1:10:3, 5:20:5, 50:150:10, 1]
+
+        # Splitting z (step 10) into 10 planes pays off, but splitting y (step 5) as well 
+        # would save less than the cost of the 20 extra requests.
+        assert len(connection.requested_uris) == 10
+        assert connection.requested_uris[0] == "/api/node/abcde/indices_data/raw/0_1_2_3/9_15_1_1/1_5_50_1"
+        assert connection.requested_uris[1] == "/api/node/abcde/indices_data/raw/0_1_2_3/9_15_1_1/1_5_60_1"
+        assert subvolume.shape == stored_stepped_volume.shape
+        assert (subvolume == stored_stepped_volume).all()
+
+        # There is no fixed limit on the number of requests.
+        dvid_vol.STRIDED_REQUEST_COST_BYTES = 100
+        connection.requested_uris = []
+        subvolume = dvid_vol[:, ::5, ::20, ::5, :]
+
+        # y (step 20), x (step 5) and z (step 5) are all split, into 5*2*40 planes.
+        assert len(connection.requested_uris) == 400
+        assert connection.requested_uris[0] == "/api/node/abcde/indices_data/raw/0_1_2_3/1_1_1_3/0_0_0_0"
+        assert (subvolume == full_stored_volume[:, ::5, ::20, ::5, :]).all()
+
     def _check_subvolume(self, h5filename, uuid, data_name, start, stop, subvolume):
         """
         Compare a given subvolume to an hdf5 dataset.  Assert if they don't match.
@@ -1,7 +1,11 @@
+import io
 import StringIO
 
 import numpy
 
+from pydvid import compression
+from pydvid.errors import UnexpectedResponseError
+from pydvid.util import PipelinedStream
 from pydvid.voxels import VoxelsMetadata
 from pydvid.voxels.voxels_nddata_codec import VoxelsNddataCodec
 
@@ -36,6 +40,172 @@ class TestVoxelsNddataCodec(object):
              
             self._assert_matching(roundtrip_data, data)
  
+    def test_decode_into_view(self):
+        data = numpy.random.randint(0,255, (3,100,200)).astype(numpy.uint16)
+        metadata = VoxelsMetadata.create_default_metadata(data.shape, data.dtype, 'cxy', 1.0, "nanometers")
+        codec = VoxelsNddataCodec( metadata )
+
+        stream = StringIO.StringIO()
+        codec.encode_from_ndarray(stream, data)
+        stream.seek(0)
+
+        # Decode into a non-contiguous view of a bigger array, in small slabs.
+        big_array = numpy.zeros( (3,120,220), dtype=numpy.uint16, order='F' )
+        view = big_array[:, 10:110, 20:220]
+        assert not view.flags['F_CONTIGUOUS']
+        original_scratch_size = VoxelsNddataCodec.DECODE_SCRATCH_SIZE
+        VoxelsNddataCodec.DECODE_SCRATCH_SIZE = 3*100*2*7
+        try:
+            codec.decode_into_ndarray(stream, view)
+        finally:
+            VoxelsNddataCodec.DECODE_SCRATCH_SIZE = original_scratch_size
+
+        assert (big_array[:, 10:110, 20:220] == data).all(), "data didn't match"
+        assert (big_array[:, :10] == 0).all()
+        assert (big_array[:, 110:] == 0).all()
+        assert (big_array[:, :, :20] == 0).all()
+
+    def test_decode_channel_subset(self):
+        data = numpy.random.randint(0,255, (4,100,200)).astype(numpy.uint16)
+        metadata = VoxelsMetadata.create_default_metadata(data.shape, data.dtype, 'cxy', 1.0, "nanometers")
+        codec = VoxelsNddataCodec( metadata )
+
+        stream = StringIO.StringIO()
+        codec.encode_from_ndarray(stream, data)
+        stream.seek(0)
+
+        # Keep only channels 1 and 2, decoding a few voxels at a time.
+        out = numpy.zeros( (2,100,200), dtype=numpy.uint16, order='F' )
+        original_scratch_size = VoxelsNddataCodec.DECODE_SCRATCH_SIZE
+        VoxelsNddataCodec.DECODE_SCRATCH_SIZE = 4*2*999
+        try:
+            codec.decode_into_ndarray(stream, out, channel_start=1)
+        finally:
+            VoxelsNddataCodec.DECODE_SCRATCH_SIZE = original_scratch_size
+
+        assert (out == data[1:3]).all(), "data didn't match"
+        assert stream.read() == "", "Expected the whole stream to be consumed"
+
+    def test_compressed_roundtrip(self):
+        data = numpy.zeros( (1,100,200), dtype=numpy.uint32 )
+        data[:, 10:20, 30:170] = 7
+        metadata = VoxelsMetadata.create_default_metadata(data.shape, data.dtype, 'cxy', 1.0, "nanometers")
+        codec = VoxelsNddataCodec( metadata )
+
+        chunks = codec.encode_compressed( data, 'gzip' )
+        compressed = ''.join( chunks )
+        assert len(compressed) < codec.calculate_buffer_len( data.shape ) // 10
+
+        # Append some junk after the compressed data, which must not be read.
+        stream = StringIO.StringIO( compressed + "junk" )
+        original_read_size = compression.DecompressingStream.READ_CHUNK_SIZE
+        compression.DecompressingStream.READ_CHUNK_SIZE = 100
+        try:
+            decompressing_stream = compression.DecompressingStream( stream, 'gzip', len(compressed) )
+            roundtrip_data = codec.decode_to_ndarray( decompressing_stream, data.shape )
+            assert decompressing_stream.read() == ""
+        finally:
+            compression.DecompressingStream.READ_CHUNK_SIZE = original_read_size
+        assert (roundtrip_data == data).all(), "data didn't match"
+        assert stream.read() == "junk"
+
+    def test_pipelined_stream(self):
+        data = numpy.random.randint(0,255, (3,100,200)).astype(numpy.uint16)
+        metadata = VoxelsMetadata.create_default_metadata(data.shape, data.dtype, 'cxy', 1.0, "nanometers")
+        codec = VoxelsNddataCodec( metadata )
+
+        stream = io.BytesIO()
+        codec.encode_from_ndarray(stream, data)
+        stream.seek(0)
+
+        # Use small buffers, so the ring of buffers is recycled many times.
+        pipelined_stream = PipelinedStream( stream, buffer_size=1000, num_buffers=3 )
+        out = numpy.zeros( (3,120,200), dtype=numpy.uint16, order='F' )
+        codec.decode_into_ndarray( pipelined_stream, out[:, 10:110] )
+        assert pipelined_stream.read() == ""
+        pipelined_stream.close()
+        assert (out[:, 10:110] == data).all(), "data didn't match"
+
+    def test_pipelined_stream_error(self):
+        class FailingStream(object):
+            def read(self, n):
+                raise IOError("Connection reset")
+            def close(self):
+                pass
+
+        pipelined_stream = PipelinedStream( FailingStream(), buffer_size=1000, num_buffers=2 )
+        try:
+            pipelined_stream.read(10)
+        except IOError:
+            pass
+        else:
+            assert False, "Expected the receiver's error to be re-raised by read()"
+        pipelined_stream.close()
+
+        # Closing early stops the background thread.
+        pipelined_stream = PipelinedStream( io.BytesIO( 'x'*10000 ), buffer_size=1000, num_buffers=2 )
+        assert pipelined_stream.read(5) == 'xxxxx'
+        pipelined_stream.close()
+        assert not pipelined_stream._thread.is_alive()
+
+    def test_readinto_roundtrip(self):
+        """
+        Streams with readinto() are decoded directly into the result array.
+        """
+        data = numpy.random.randint(0,255, (3,100,200)).astype(numpy.uint32)
+        metadata = VoxelsMetadata.create_default_metadata(data.shape, data.dtype, 'cxy', 1.0, "nanometers")
+        codec = VoxelsNddataCodec( metadata )
+
+        stream = StringIO.StringIO()
+        codec.encode_from_ndarray(stream, data)
+        stream = io.BytesIO( stream.getvalue() )
+        roundtrip_data = codec.decode_to_ndarray(stream, data.shape)
+        assert roundtrip_data.flags['F_CONTIGUOUS']
+        self._assert_matching(roundtrip_data, data)
+
+    def test_readinto_truncated_stream(self):
+        data = numpy.random.randint(0,255, (3,100,200)).astype(numpy.uint8)
+        metadata = VoxelsMetadata.create_default_metadata(data.shape, data.dtype, 'cxy', 1.0, "nanometers")
+        codec = VoxelsNddataCodec( metadata )
+
+        stream = StringIO.StringIO()
+        codec.encode_from_ndarray(stream, data)
+        stream = io.BytesIO( stream.getvalue()[:-10] )
+        try:
+            codec.decode_to_ndarray(stream, data.shape)
+        except UnexpectedResponseError:
+            pass
+        else:
+            assert False, "Expected an error for the truncated stream."
+
+    def test_encode_to_send_function(self):
+        """
+        Connections that only provide send() receive the array data in zero-copy chunks.
+        """
+        class FakeConnection(object):
+            def __init__(self):
+                self.chunks = []
+            def send(self, data):
+                self.chunks.append( str(data) )
+
+        data = numpy.random.randint(0,255, (3,100,200)).astype(numpy.uint16)
+        metadata = VoxelsMetadata.create_default_metadata(data.shape, data.dtype, 'cxy', 1.0, "nanometers")
+        codec = VoxelsNddataCodec( metadata )
+
+        connection = FakeConnection()
+        original_chunk_size = VoxelsNddataCodec.STREAM_WRITE_CHUNK_SIZE
+        VoxelsNddataCodec.STREAM_WRITE_CHUNK_SIZE = 10000
+        try:
+            codec.encode_from_ndarray(connection, data)
+        finally:
+            VoxelsNddataCodec.STREAM_WRITE_CHUNK_SIZE = original_chunk_size
+
+        assert len(connection.chunks) == 12
+        body = "".join( connection.chunks )
+        assert len(body) == codec.calculate_buffer_len( data.shape )
+        roundtrip_data = codec.decode_to_ndarray(StringIO.StringIO(body), data.shape)
+        self._assert_matching(roundtrip_data, data)
+
     def _assert_matching(self, data, expected):
         assert expected is not data
         assert expected.dtype == data.dtype